@@ -3,8 +3,14 @@
 #################################################################################
 ## Imports
 #################################################################################
+import os
 import re
 import json
+import time
+import random
+import hashlib
+import threading
+import contextlib
 import subprocess
 from enum import Enum, IntFlag
 from datetime import datetime, timezone
@@ -15,6 +21,55 @@ from datetime import datetime, timezone
 #################################################################################
 RCLONE = "rclone"
 
+#format of the times kept in the file records, see parsetime
+TIMEFMT = "%Y-%m-%d %H:%M:%S.%f"
+
+#rclone reports this precision (100 years) for backends without modtimes
+MODTIMENOTSUPPORTED = 100 * 365 * 24 * 3600 * 10**9
+
+#hash types in the order we would like to use them, roughly cheapest to
+#compute locally first (weak hashes like crc32 last)
+HASHPREF = ("xxh3", "xxh128", "quickxor", "md5", "sha1", "blake3", "dropbox",
+            "sha256", "sha512", "hidrive", "mailru", "whirlpool", "crc32")
+
+#backend specific flag for the upload chunk size, keyed by the backend type
+#from 'rclone config dump' (features only has the remote's configured name)
+CHUNKFLAGS = {"drive": "--drive-chunk-size", "s3": "--s3-chunk-size", "b2": "--b2-chunk-size",
+              "onedrive": "--onedrive-chunk-size", "dropbox": "--dropbox-chunk-size",
+              "azureblob": "--azureblob-chunk-size", "gcs": "--gcs-chunk-size",
+              "swift": "--swift-chunk-size"}
+
+#ways to list the whole remote: a plain recursive walk, one ListR call that
+#gets big pages of the whole bucket (s3, b2, gcs, ...) or a walk with many
+#directories listed in parallel (drive and others without ListR). partitioned
+#lists each top level dir recursively in its own rclone, LISTWORKERS at a time
+LISTSTRATEGIES = {"recursive": [], "fast-list": ["--fast-list"], "walk": ["--checkers", "32"], "partitioned": []}
+LISTWORKERS = 8
+
+#lsjson of up to this many names looks each one up (--no-traverse), more
+#are found by listing the dirs they are in
+NOTRAVERSEMAX = 1000
+
+#rclone's exit codes for a dir/file that doesn't exist
+DIRNOTFOUND = 3
+FILENOTFOUND = 4
+
+#rclone's exit code when --max-duration stopped it
+DURATIONEXCEEDED = 10
+
+#errors the backends report through rclone when they are throttling us. only
+#their own error strings, a file name in the output (ie '429.jpg') mustn't count
+RATELIMITRX = re.compile(rb'rateLimitExceeded|userRateLimitExceeded|Error 429\b|HTTP error 429\b|status code:? 429\b|'
+                         rb'429 Too Many Requests|TooManyRequests|too_many_requests|too_many_write_operations|'
+                         rb'activityLimitReached|\bSlowDown\b|RequestLimitExceeded|ThrottlingException')
+
+SIZESUFFIX = {"B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40, "P": 1 << 50}
+
+#older rclone versions report hashes in lsjson under these names
+HASHNAMES = {"MD5": "md5", "SHA-1": "sha1", "Whirlpool": "whirlpool", "CRC-32": "crc32",
+             "DropboxHash": "dropbox", "QuickXorHash": "quickxor", "MailruHash": "mailru",
+             "SHA-256": "sha256"}
+
 
 #################################################################################
 ## Enums
@@ -30,6 +85,10 @@ class Action(Enum):
     copyto = 1
     deletefrom = 2
     conflict = 3
+    copydir = 4
+    purge = 5
+    settime = 6
+    dupcopy = 7
 
 
 #################################################################################
@@ -73,26 +132,546 @@ def parsetime(dtstr):
     x = [int(i) for i in x[:7]]
 
     dstr = "%04d-%02d-%02d %02d:%02d:%02d.%06d%s" % (*x[:7], tz)
-    dt = datetime.strptime(dstr, "%Y-%m-%d %H:%M:%S.%f" + tzp)
+    dt = datetime.strptime(dstr, TIMEFMT + tzp)
+
+    return dt.astimezone().strftime(TIMEFMT)
+
+
+#################################################################################
+## parsesize helper function
+#################################################################################
+def parsesize(sz):
+    #rclone style sizes, ie 1024, 10K, 256M, 1.5G (binary multiples)
+    if(isinstance(sz, int)):
+        return sz
+
+    sz = sz.strip()
+    m = re.fullmatch(r'([0-9]*\.?[0-9]+)\s*([BKMGTP]?)(i?B)?', sz, re.IGNORECASE)
+    if(not m):
+        raise ValueError("Size '%s' malformated" % sz)
+
+    return int(float(m.group(1)) * SIZESUFFIX[(m.group(2) or "B").upper()])
+
 
-    return dt.astimezone().strftime("%Y-%m-%d %H:%M:%S.%f")
+#################################################################################
+## hash helper functions
+#################################################################################
+def hashkey(hashtype):
+    #name of the key the hash is stored under in a file's record (ie md5sum)
+    if(not hashtype):
+        return None
+    return hashtype + "sum"
+
+def pick_hash(localhashes, remotehashes):
+    common = set(localhashes) & set(remotehashes)
+    for h in HASHPREF:
+        if(h in common):
+            return h
+    return None
+
+
+#################################################################################
+## Filter rules (rclone filter file syntax)
+#################################################################################
+def glob_to_regex(pattern):
+    #follows rclone's filter glob rules:
+    #  a leading '/' anchors to the root otherwise it matches at any dir level
+    #  '*' and '?' don't match '/', '**' matches anything, {a,b} alternates
+    if(pattern.startswith("/")):
+        rx = "^"
+        pattern = pattern[1:]
+    else:
+        rx = "(^|/)"
+
+    i = 0
+    braces = 0
+    while(i < len(pattern)):
+        c = pattern[i]
+        if(c == "*"):
+            if(pattern[i:i+2] == "**"):
+                rx += ".*"
+                i += 1
+            else:
+                rx += "[^/]*"
+        elif(c == "?"):
+            rx += "[^/]"
+        elif(c == "["):
+            j = pattern.find("]", i + 1)
+            if(j == -1):
+                raise ValueError("Unterminated '[' in filter pattern '%s'" % pattern)
+            rx += pattern[i:j+1]
+            i = j
+        elif(c == "{"):
+            braces += 1
+            rx += "("
+        elif(c == "}" and braces):
+            braces -= 1
+            rx += ")"
+        elif(c == "," and braces):
+            rx += "|"
+        elif(c == "\\" and i + 1 < len(pattern)):
+            i += 1
+            rx += re.escape(pattern[i])
+        else:
+            rx += re.escape(c)
+        i += 1
+
+    if(braces):
+        raise ValueError("Unterminated '{' in filter pattern '%s'" % pattern)
+
+    return re.compile(rx + "$")
+
+def implied_dirs(pattern):
+    #dirs an include rule keeps so rclone can get to the files it matches,
+    #ie '/a/b/*.txt' -> '/a/b/', '/a/' (rclone's globToDirGlobs)
+    out = []
+    i = pattern.rfind("/")
+    while(i > 0):
+        pattern = pattern[:i]
+        out.append(pattern + "/")
+        i = pattern.rfind("/")
+    return out
+
+class FilterRules():
+    def __init__(self, rules=()):
+        self.rules = []
+        for r in rules:
+            self.add(r)
+
+    def add(self, rule):
+        rule = rule.strip()
+        if(not rule or rule[0] in "#;"):
+            return
+        if(rule == "!"):
+            self.rules = []
+            return
+        if(rule[:2] not in ("+ ", "- ")):
+            raise ValueError("Malformed filter rule '%s'" % rule)
+
+        pattern = rule[2:]
+        if(rule[0] == "+"):
+            for d in implied_dirs(pattern):
+                self.rules.append((True, True, glob_to_regex(d)))
+        #'dir/' and 'dir/**' style rules are the only ones that can prune a whole dir
+        isdirrule = pattern.endswith("/") or pattern.endswith("/**")
+        self.rules.append((rule[0] == "+", isdirrule, glob_to_regex(pattern)))
+
+    def included(self, path, isdir=False):
+        if(isdir):
+            path = path.rstrip("/") + "/"
+        for (include, isdirrule, rx) in self.rules:
+            if(isdir and not isdirrule):
+                continue
+            if(rx.search(path)):
+                return include
+        return True
+
+    @classmethod
+    def fromfile(cls, filename):
+        with open(filename, "r") as f:
+            return cls(f.readlines())
+
+
+#################################################################################
+## Native local walk
+#################################################################################
+def walk_local(root, rules=None, path=""):
+    #yields (relative path, os.stat_result) for each file, never descends into
+    #dirs excluded by the rules and like rclone skips symlinks
+    try:
+        entries = sorted(os.scandir(os.path.join(root, path)), key=lambda e: e.name)
+    except FileNotFoundError:
+        return
+
+    for e in entries:
+        name = path + "/" + e.name if path else e.name
+        if(e.is_symlink()):
+            continue
+        if(e.is_dir()):
+            if(rules and not rules.included(name, isdir=True)):
+                continue
+            yield from walk_local(root, rules, name)
+        elif(not rules or rules.included(name)):
+            yield (name, e.stat(follow_symlinks=False))
+
+
+#################################################################################
+## Metrics
+#################################################################################
+#counters summed from the final --stats of every rclone process
+STATSKEYS = ("bytes", "transfers", "checks", "deletes", "renames", "errors", "serverSideCopies")
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = dict.fromkeys(STATSKEYS + ("rcloneruns", "ratelimited", "failed"), 0)
+        self.phases = {}
+        self.live = {}
+        self.extra = {}
+        self.outputs = {}
+        self.labels = {}
+        self.lastwrite = 0
+
+    def inc(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def update(self, sid, stats):
+        #stats of a still running rclone process
+        with self.lock:
+            self.live[sid] = stats
+        self.write(final=False)
+
+    def finish(self, sid):
+        with self.lock:
+            stats = self.live.pop(sid, None) or {}
+            for k in STATSKEYS:
+                self.counters[k] += stats.get(k, 0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+            self.write(final=False)
+
+    def snapshot(self):
+        with self.lock:
+            j = dict(self.counters)
+            for stats in self.live.values():
+                for k in STATSKEYS:
+                    j[k] += stats.get(k, 0)
+            j['duration'] = time.time() - self.start
+            j['phases'] = dict(self.phases)
+            j['running'] = bool(self.live)
+            j.update(self.extra)
+
+        #rates over the time actually spent applying changes
+        secs = j['phases'].get('apply') or j['duration']
+        j['bytespersec'] = j['bytes'] / secs if secs else 0.0
+        j['filespersec'] = j['transfers'] / secs if secs else 0.0
+        j['timestamp'] = time.time()
+        return j
+
+    def toprom(self, j):
+        lbl = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(self.labels.items()))
+        out = []
+
+        def metric(name, mtype, value, extra=""):
+            l = ",".join(x for x in (lbl, extra) if x)
+            out.append("# TYPE rclone_bisync_%s %s" % (name, mtype))
+            out.append("rclone_bisync_%s{%s} %s" % (name, l, value))
+
+        for k in STATSKEYS + ("rcloneruns", "ratelimited", "failed"):
+            metric(k.lower() + "_total", "counter", j[k])
+        metric("duration_seconds", "gauge", "%.3f" % j['duration'])
+        metric("bytes_per_second", "gauge", "%.1f" % j['bytespersec'])
+        metric("files_per_second", "gauge", "%.3f" % j['filespersec'])
+        metric("running", "gauge", int(j['running']))
+        metric("last_update_timestamp_seconds", "gauge", "%.0f" % j['timestamp'])
+        out.append("# TYPE rclone_bisync_phase_seconds gauge")
+        for ph in sorted(j['phases']):
+            l = ",".join(x for x in (lbl, 'phase="%s"' % ph) if x)
+            out.append("rclone_bisync_phase_seconds{%s} %.3f" % (l, j['phases'][ph]))
+        if(j.get('concurrency')):
+            #what the adaptive transfers/workers ended up at, the trace is in the json
+            out.append("# TYPE rclone_bisync_concurrency gauge")
+            for sc in sorted(j['concurrency']):
+                l = ",".join(x for x in (lbl, 'class="%s"' % sc) if x)
+                out.append("rclone_bisync_concurrency{%s} %d" % (l, j['concurrency'][sc]['final']))
+
+        return "\n".join(out) + "\n"
+
+    def write(self, final=True):
+        #live updates are throttled, the final one always goes out
+        if(not self.outputs or (not final and time.time() - self.lastwrite < 5)):
+            return
+        self.lastwrite = time.time()
+
+        j = self.snapshot()
+        if(final):
+            j['running'] = False
+        for (fmt, filename) in self.outputs.items():
+            if(not filename):
+                continue
+            data = self.toprom(j) if fmt == "prom" else json.dumps(j, indent=4, sort_keys=True) + "\n"
+            #write + rename so the textfile collector never sees half a file
+            tmp = "%s.%d.tmp" % (filename, os.getpid())
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, filename)
+
+def parse_jsonlog(line):
+    #returns (level, msg, stats) for a --use-json-log line
+    try:
+        j = json.loads(line)
+    except ValueError:
+        return (None, line.decode('utf-8', 'replace').rstrip("\n"), None)
+    if(not isinstance(j, dict)):
+        return (None, line.decode('utf-8', 'replace').rstrip("\n"), None)
+
+    return (j.get('level'), j.get('msg', "").rstrip("\n"), j.get('stats'))
+
+metrics = Metrics()
+
+
+#################################################################################
+## Request scheduler
+#################################################################################
+class TokenBucket():
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self):
+        while(True):
+            with self.lock:
+                self._refill(time.monotonic())
+                if(self.tokens >= 1):
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        #the backend told us to slow down, make everyone sharing this bucket wait
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0)
+
+class Scheduler():
+    #every rclone call goes through here and rate limit errors are retried
+    #instead of being fatal. rclone itself holds each call to the remote's
+    #requests per second (--tpslimit), the token bucket only spaces out the
+    #rclone processes started against the same remote. processes running side
+    #by side split the rate between them so together they stay within it
+    def __init__(self, rate=None, burst=None, retries=8, basedelay=1.0, maxdelay=120.0):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.basedelay = basedelay
+        self.maxdelay = maxdelay
+        self.buckets = {}
+        self.running = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def setrate(self, key, rate, burst=None):
+        with self.lock:
+            if(rate):
+                self.buckets[key] = TokenBucket(rate, burst)
+            else:
+                self.buckets.pop(key, None)
+
+    def bucket(self, key):
+        with self.lock:
+            if(key not in self.buckets and self.rate):
+                self.buckets[key] = TokenBucket(self.rate, self.burst)
+            return self.buckets.get(key)
+
+    @contextlib.contextmanager
+    def share(self, key, n):
+        #up to n more rclone processes are about to run side by side against
+        #key, each of them only gets its share of the rate from the start
+        with self.lock:
+            self.slots[key] = self.slots.get(key, 0) + n
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.slots[key] -= n
+
+    def tpsargs(self, key, b):
+        #--tpslimit for one more process against key, the rate split over the
+        #processes running (or announced with share()) there
+        with self.lock:
+            self.running[key] = self.running.get(key, 0) + 1
+            n = max(self.running[key], self.slots.get(key, 0))
+        return ["--tpslimit", "%g" % (b.rate / n), "--tpslimit-burst", str(max(1, int(b.burst / n)))]
+
+    def backoff(self, attempt):
+        #"full jitter", spreads the retries of concurrent callers out
+        return random.uniform(0, min(self.maxdelay, self.basedelay * (2 ** attempt)))
+
+    def _exec(self, cmd, onstderr):
+        if(not onstderr):
+            return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        #stream stderr (ie rclone's stats) as it is written, stdout is drained
+        #by a thread so neither pipe can fill up and block rclone
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = []
+        t = threading.Thread(target=lambda: out.append(p.stdout.read()))
+        t.start()
+        err = []
+        for l in p.stderr:
+            err.append(l)
+            onstderr(l)
+        t.join()
+        p.wait()
+
+        return subprocess.CompletedProcess(cmd, p.returncode, out[0], b''.join(err))
+
+    def run(self, cmd, key=None, onstderr=None, mx=None):
+        #mx is the Metrics the call is counted in, the module's by default
+        mx = mx or metrics
+        attempt = 0
+        while(True):
+            b = self.bucket(key) if key else None
+            run = cmd
+            if(b):
+                b.acquire()
+                run = cmd[:1] + self.tpsargs(key, b) + cmd[1:]
+
+            mx.inc('rcloneruns')
+            try:
+                rv = self._exec(run, onstderr)
+            finally:
+                if(b):
+                    with self.lock:
+                        self.running[key] -= 1
+            if(rv.returncode == 0):
+                return rv
+
+            if(not israteerror(rv.stderr) or attempt >= self.retries):
+                raise subprocess.CalledProcessError(rv.returncode, cmd, rv.stdout, rv.stderr)
+
+            if(b):
+                b.drain()
+            mx.inc('ratelimited')
+            delay = self.backoff(attempt)
+            attempt += 1
+            print("Rate limited by '%s', retry %d/%d in %.1fs" % (key, attempt, self.retries, delay))
+            time.sleep(delay)
+
+def israteerror(stderr):
+    return bool(stderr and RATELIMITRX.search(stderr))
+
+def remotename(path):
+    #'gdrive:some/dir' -> 'gdrive', local paths (incl. 'C:\\x') -> None
+    m = re.match(r'^([^/\\:]{2,}):', path)
+    return m.group(1) if m else None
+
+#shared by all rclone objects so several syncs against one remote share a bucket
+scheduler = Scheduler()
+
+
+#################################################################################
+## filesfrom helper
+#################################################################################
+@contextlib.contextmanager
+def filesfrom(names, suffix=".files"):
+    #temp file with one name per line for --files-from-raw (or rules for
+    #--filter-from), None if no names
+    if(names is None):
+        yield None
+        return
+
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", prefix="rclone_bisync.", suffix=suffix) as ff:
+        for name in names:
+            ff.write(name + "\n")
+        ff.flush()
+        yield ff.name
+
+
+def list_strategy(features):
+    #best listing strategy for a backend going by its features
+    if((features.get('Features') or {}).get('ListR')):
+        return "fast-list"
+    return "partitioned"
+
+def partition_rules(rules, d):
+    #rewrites filter rules for a listing rooted at the top level dir 'd'
+    #instead of the root, None if a rule can't be rewritten (ie '/**/x' or
+    #'{a/b,c}' could match across the partition's top)
+    out = []
+    for rule in rules:
+        rule = rule.strip()
+        if(not rule or rule[0] in "#;" or rule == "!"):
+            out.append(rule)
+            continue
+
+        sign, pat = rule[:2], rule[2:]
+        if(pat in ("**", "/**")):
+            #everything, at any level
+            out.append(sign + "/**")
+            continue
+        anchored = pat.startswith("/")
+        first, sep, rest = pat.lstrip("/").partition("/")
+        if("**" in first or "{" in first or (sep and not rest and anchored)):
+            return None
+
+        #the part after 'd/' anchored to the partition's top
+        inside = sep and rest and glob_to_regex("/" + first).search(d)
+        if(not anchored):
+            out.append(rule)
+        if(inside):
+            out.append(sign + "/" + rest)
+
+    return out
+
+def pick_dup(recs, rid=None):
+    #one record for a name the remote has several files under, the one with
+    #the object ID rid if there is one, else the newest (then the lowest ID)
+    #so the pick doesn't depend on the listing order. the rest are kept in
+    #its 'dups' (without their own, recs may be a pick plus its dups)
+    recs = sorted(({k: r[k] for k in r if k != 'dups'} for r in recs), key=lambda r: r.get('id') or "")
+    recs.sort(key=lambda r: r['time'], reverse=True)
+    recs.sort(key=lambda r: r.get('id') != rid if rid else False)
+    return dict(recs[0], dups=recs[1:])
+
+def subtree_rules(rules, path):
+    #partition_rules() a dir level at a time for a listing rooted at 'path'
+    for d in path.split("/"):
+        if(rules is None):
+            break
+        rules = partition_rules(rules, d)
+    return rules
+
+def subpath(target, d):
+    #'gdrive:' + 'a/b' -> 'gdrive:a/b', '/x' + 'a/b' -> '/x/a/b'
+    return target + d if target.endswith(":") else target.rstrip("/") + "/" + d
 
 
 #################################################################################
 ### RClone Class
 #################################################################################
 class rclone():
-    def __init__(self, local, remote, googledocs=False, dryrun=False):
+    def __init__(self, local, remote, googledocs=False, dryrun=False, filterfile=None, hashtype="md5", sched=None, featurecache=None,
+                 mx=None):
         self.local = local
         self.remote = remote
         self.gdocs = googledocs
         self.dryrun = dryrun
+        self.filterfile = filterfile
+        self.hashtype = hashtype
+        self.liststrategy = "recursive"
+        self.listworkers = LISTWORKERS
+        #features keyed by path, handed in and saved by the caller so the
+        #backends only have to be probed once
+        self._features = featurecache if featurecache is not None else {}
+        self._rules = None
+        self.scheduler = sched or scheduler
+        self.metrics = mx or metrics
 
     def __str__(self):
-        t = {'local': self.local, 'remote': self.remote, 'gdocs': self.gdocs, 'dryrun': self.dryrun}
+        t = {'local': self.local, 'remote': self.remote, 'gdocs': self.gdocs, 'dryrun': self.dryrun,
+             'filterfile': self.filterfile, 'hashtype': self.hashtype}
         return str(t)
 
-    def lsjson(self, direction, includegdocs=False):
+    def features(self, direction):
         if(direction == Direction.local):
             target = self.local
         elif(direction == Direction.remote):
@@ -100,11 +679,205 @@ class rclone():
         else:
             raise ValueError("Invalid direction arg")
 
-        cmd = [RCLONE, "lsjson", "--hash", "--recursive", target]
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        if(target not in self._features):
+            cmd = [RCLONE, "backend", "features", target]
+            rv = self._run(cmd, direction)
+            self._features[target] = json.loads(rv.stdout)
+
+        return self._features[target]
+
+    def pick_liststrategy(self, strategy="auto"):
+        if(strategy == "auto"):
+            strategy = list_strategy(self.features(Direction.remote))
+        if(strategy not in LISTSTRATEGIES):
+            raise ValueError("Unknown listing strategy '%s'" % strategy)
+        self.liststrategy = strategy
+        return strategy
+
+    def benchmark_listing(self, strategies=LISTSTRATEGIES):
+        #times a full listing of the remote with each strategy, returns
+        #{strategy: (seconds, number of files)}
+        org = self.liststrategy
+        results = {}
+        try:
+            for strategy in strategies:
+                self.liststrategy = strategy
+                start = time.monotonic()
+                l = self.lsjson(Direction.remote, includegdocs=True)
+                results[strategy] = (time.monotonic() - start, len(l))
+        finally:
+            self.liststrategy = org
+        return results
+
+    def precision(self, direction):
+        #modtime precision in seconds, None if the backend has no modtimes
+        p = self.features(direction).get('Precision')
+        if(p is None or p >= MODTIMENOTSUPPORTED):
+            return None
+        return p / 1e9
+
+    def negotiate_hash(self):
+        lh = self.features(Direction.local).get('Hashes') or []
+        rh = self.features(Direction.remote).get('Hashes') or []
+        self.hashtype = pick_hash(lh, rh)
+
+        return self.hashtype
+
+    def filterrules(self):
+        if(self._rules is None):
+            if(self.filterfile):
+                self._rules = FilterRules.fromfile(self.filterfile)
+            else:
+                self._rules = FilterRules()
+        return self._rules
+
+    def local_fingerprint(self):
+        #stat only walk of the local tree (no hashing), any add/delete/rename/
+        #modify of an included file changes the fingerprint
+        h = hashlib.sha1()
+        for (name, st) in walk_local(self.local, self.filterrules()):
+            h.update(("%s\0%d\0%d\n" % (name, st.st_size, st.st_mtime_ns)).encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+
+    def remote_fingerprint(self):
+        #'about' is a single API call where supported, otherwise fall back to a
+        #count+size of the remote which still skips hashing
+        if(self.features(Direction.remote).get('Features', {}).get('About')):
+            cmd = [RCLONE, "about", "--json", self.remote]
+        else:
+            cmd = [RCLONE, "size", "--json", self.remote]
+            self._addfilter(cmd)
+
+        rv = self._run(cmd, Direction.remote)
+        j = json.loads(rv.stdout)
+        return hashlib.sha1(json.dumps(j, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lsjson(self, direction, includegdocs=False, names=None, path=None):
+        #names limits the listing to just those files (looked up directly
+        #instead of walking the whole tree), path to the files under that dir
+        if(direction == Direction.local):
+            target = self.local
+        elif(direction == Direction.remote):
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
+
+        if(path and names is None):
+            return self._lsjson_subtree(direction, target, path)
+
+        if(direction == Direction.remote and names is None and self.liststrategy == "partitioned"):
+            return self._lsjson_partitioned()
+
+        with filesfrom(names) as ff:
+            cmd = [RCLONE, "lsjson", "--recursive", target]
+            if(self.hashtype):
+                #only ask for the hash we compare on, otherwise local computes them all
+                cmd[2:2] = ["--hash", "--hash-type", self.hashtype]
+            if(ff):
+                cmd[2:2] = ["--files-from-raw", ff] + (["--no-traverse"] if len(names) <= NOTRAVERSEMAX else [])
+            elif(direction == Direction.remote):
+                cmd[2:2] = LISTSTRATEGIES[self.liststrategy]
+            self._addfilter(cmd)
+            rv = self._run(cmd, direction)
 
         return self._parse_lsjson(rv.stdout, target)
 
+    def _lsjson_partitioned(self):
+        #the top level on its own, then each dir under it listed recursively
+        #by its own rclone so the remote's listing calls are spread over
+        #several processes
+        rules = []
+        if(self.filterfile):
+            with open(self.filterfile, "r") as f:
+                rules = f.readlines()
+
+        cmd = [RCLONE, "lsjson", self.remote]
+        if(self.hashtype):
+            cmd[2:2] = ["--hash", "--hash-type", self.hashtype]
+        self._addfilter(cmd)
+        rv = self._run(cmd, Direction.remote)
+
+        dirs = [f['Path'] for f in json.loads(rv.stdout) if f['IsDir']]
+        parts = {d: partition_rules(rules, d) for d in dirs}
+        if(None in parts.values()):
+            #a rule can't be split up, list it all in one go
+            self.liststrategy = "recursive"
+            try:
+                return self.lsjson(Direction.remote)
+            finally:
+                self.liststrategy = "partitioned"
+
+        lsj = self._parse_lsjson(rv.stdout, self.remote)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.listworkers) as pool, \
+             self.scheduler.share(remotename(self.remote), min(self.listworkers, len(dirs))):
+            for (d, part) in zip(dirs, pool.map(lambda d: self._lsjson_partition(d, parts[d]), dirs)):
+                for name in part:
+                    lsj[d + "/" + name] = part[name]
+
+        return lsj
+
+    def _lsjson_partition(self, d, rules):
+        with filesfrom(rules or None, ".filter") as ff:
+            cmd = [RCLONE, "lsjson", "--recursive", subpath(self.remote, d)]
+            if(self.hashtype):
+                cmd[2:2] = ["--hash", "--hash-type", self.hashtype]
+            if(ff):
+                cmd[1:1] = ["--filter-from", ff]
+            rv = self._run(cmd, Direction.remote)
+
+        return self._parse_lsjson(rv.stdout, self.remote)
+
+    def subtree_filter(self, path):
+        #the filter rules rewritten for a command rooted at the dir 'path', []
+        #without any and None when a rule can't be rewritten
+        rules = []
+        if(self.filterfile):
+            with open(self.filterfile, "r") as f:
+                rules = f.readlines()
+        return subtree_rules(rules, path)
+
+    def _lsjson_subtree(self, direction, target, path):
+        #just the dir 'path' listed with the filter rules rewritten to match,
+        #names are still relative to the root
+        prefix = path + "/"
+        sub = self.subtree_filter(path)
+        if(sub is None):
+            #a rule can't be rewritten, list it all and keep the subtree
+            lsj = self.lsjson(direction, includegdocs=True)
+            return {name: lsj[name] for name in lsj if name.startswith(prefix)}
+
+        with filesfrom(sub or None, ".filter") as ff:
+            cmd = [RCLONE, "lsjson", "--recursive", subpath(target, path)]
+            if(self.hashtype):
+                cmd[2:2] = ["--hash", "--hash-type", self.hashtype]
+            if(direction == Direction.remote):
+                cmd[2:2] = LISTSTRATEGIES[self.liststrategy]
+            if(ff):
+                cmd[1:1] = ["--filter-from", ff]
+            try:
+                rv = self._run(cmd, direction)
+            except subprocess.CalledProcessError as e:
+                if(e.returncode != DIRNOTFOUND):
+                    raise
+                #not on this side (yet)
+                return {}
+
+        lsj = self._parse_lsjson(rv.stdout, target)
+        return {prefix + name: lsj[name] for name in lsj}
+
+    def localrecord(self, name):
+        #record like _parse_lsjson's for a local file (without the hash) using
+        #a single stat, None if the file doesn't exist
+        try:
+            st = os.stat(os.path.join(self.local, name))
+        except FileNotFoundError:
+            return None
+
+        ns = st.st_mtime_ns
+        dt = datetime.fromtimestamp(ns // 1000000000).replace(microsecond=(ns // 1000) % 1000000)
+        return {'size': st.st_size, 'time': dt.strftime(TIMEFMT)}
+
     def lsl(self, direction, includegdocs=False):
         if(direction == Direction.local):
             target = self.local
@@ -116,8 +889,9 @@ class rclone():
         cmd = [RCLONE, "lsl", target]
         if(not includegdocs):
             cmd.insert(1, "--drive-skip-gdocs")
+        self._addfilter(cmd)
 
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        rv = self._run(cmd, direction)
 
         return self._parse_lsl(rv.stdout)
 
@@ -132,8 +906,9 @@ class rclone():
         cmd = [RCLONE, "md5sum", target]
         if(includegdocs):
             cmd.insert(1, "--drive-skip-gdocs")
+        self._addfilter(cmd)
 
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        rv = self._run(cmd, direction)
         return self._parse_md5sum(rv.stdout)
 
     def sync(self, direction):
@@ -151,10 +926,55 @@ class rclone():
             cmd.insert(1, "--dry-run")
         if(not self.gdocs):
             cmd.insert(1, "--drive-skip-gdocs")
+        self._addfilter(cmd)
+
+        rv = self._runlogged(cmd, Direction.remote)
+
+    def backendtype(self):
+        #type of the remote's backend ('drive', 's3', ...), 'gdrive:dir' only
+        #names the remote so look it up in the config, ':s3:bucket' names the type
+        if(self.remote.startswith(":")):
+            return self.remote[1:].split(":", 1)[0].split(",", 1)[0]
+        name = remotename(self.remote)
+        if(name is None):
+            return "local"
+        key = "type:" + name
+        if(key not in self._features):
+            rv = self._run([RCLONE, "config", "dump"], Direction.remote)
+            self._features[key] = json.loads(rv.stdout).get(name, {}).get('type')
+        return self._features[key]
+
+    def chunkargs(self, chunksize):
+        flag = CHUNKFLAGS.get(self.backendtype()) if chunksize else None
+        if(not flag or not chunksize):
+            return []
+        return [flag, chunksize]
+
+    def copyfiles(self, names, direction, extraargs=()):
+        #one rclone process for a whole batch of files, lets rclone run the
+        #transfers in parallel instead of paying process/API start up per file
+        if(direction == Direction.local):
+            source = self.remote
+            target = self.local
+        elif(direction == Direction.remote):
+            source = self.local
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
 
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        with filesfrom(names) as ff:
+            cmd = [RCLONE, "copy", "--files-from-raw", ff, "--no-traverse", *extraargs, source, target]
+            if(self.dryrun):
+                cmd.insert(1, "--dry-run")
+            if(not self.gdocs):
+                cmd.insert(1, "--drive-skip-gdocs")
+            self._addfilter(cmd)
 
-    def copyto(self, name, direction):
+            print("cmd = '%s' (%d files)" % (" ".join(cmd), len(names)))
+            rv = self._runlogged(cmd, Direction.remote)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def copyto(self, name, direction, extraargs=()):
         if(direction == Direction.local):
             source = self.remote
             target = self.local
@@ -167,16 +987,16 @@ class rclone():
         source += "/" + name
         target += "/" + name
         
-        cmd = [RCLONE, "copyto", source, target]
+        cmd = [RCLONE, "copyto", *extraargs, source, target]
         if(self.dryrun):
             cmd.insert(1, "--dry-run")
         if(not self.gdocs):
             cmd.insert(1, "--drive-skip-gdocs")
+        self._addfilter(cmd)
 
         print("cmd = '%s'" % (" ".join(cmd)))
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        rv = self._runlogged(cmd, Direction.remote)
         self._dumpoutput("STDOUT:", rv.stdout)
-        self._dumpoutput("STDERR:", rv.stderr)
 
     def delete(self, name, direction):
         if(direction == Direction.local):
@@ -195,9 +1015,195 @@ class rclone():
             cmd.insert(1, "--drive-skip-gdocs")
 
         print("cmd = '%s'" % (" ".join(cmd)))
-        rv = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        rv = self._runlogged(cmd, direction)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def _run(self, cmd, direction, onstderr=None):
+        #local only operations aren't rate limited
+        key = remotename(self.remote) if direction != Direction.local else None
+        return self.scheduler.run(cmd, key, onstderr, self.metrics)
+
+    def copydir(self, name, direction, extraargs=()):
+        #a whole new dir in one go, see copyto
+        if(direction == Direction.local):
+            source = self.remote
+            target = self.local
+        elif(direction == Direction.remote):
+            source = self.local
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
+
+        source += "/" + name
+        target += "/" + name
+
+        #the root's rules would be matched against paths relative to the dir
+        sub = self.subtree_filter(name)
+        if(sub is None):
+            raise ValueError("The filter rules can't be applied to just '%s'" % name)
+
+        with filesfrom(sub or None, ".filter") as ff:
+            cmd = [RCLONE, "copy", *extraargs, source, target]
+            if(self.dryrun):
+                cmd.insert(1, "--dry-run")
+            if(not self.gdocs):
+                cmd.insert(1, "--drive-skip-gdocs")
+            if(ff):
+                cmd[1:1] = ["--filter-from", ff]
+
+            print("cmd = '%s'" % (" ".join(cmd)))
+            rv = self._runlogged(cmd, Direction.remote)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def servercopy(self):
+        #whether the remote can copy a file to another path without downloading it
+        return bool((self.features(Direction.remote).get('Features') or {}).get('Copy'))
+
+    def dupcopy(self, source, name, direction):
+        #copies 'source' to 'name' within the one side, for content that's
+        #already there (server side on the remote)
+        if(direction == Direction.local):
+            target = self.local
+        elif(direction == Direction.remote):
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
+
+        cmd = [RCLONE, "copyto", target + "/" + source, target + "/" + name]
+        if(self.dryrun):
+            cmd.insert(1, "--dry-run")
+
+        print("cmd = '%s'" % (" ".join(cmd)))
+        rv = self._runlogged(cmd, direction)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def isfile(self, direction, name):
+        #True if name is a file on that side, False for a dir or if it isn't there
+        target = self.local if direction == Direction.local else self.remote
+        try:
+            rv = self._run([RCLONE, "lsjson", "--stat", subpath(target, name)], direction)
+        except subprocess.CalledProcessError as e:
+            if(e.returncode in (DIRNOTFOUND, FILENOTFOUND)):
+                return False
+            raise
+        return not json.loads(rv.stdout)['IsDir']
+
+    def readfile(self, name):
+        #contents of a single (small) file on the remote, None if it isn't there
+        cmd = [RCLONE, "cat", self.remote + "/" + name]
+        try:
+            rv = self._run(cmd, Direction.remote)
+        except subprocess.CalledProcessError as e:
+            if(e.returncode in (DIRNOTFOUND, FILENOTFOUND)):
+                return None
+            raise
+        return rv.stdout
+
+    def writefile(self, name, data):
+        #replaces a single file on the remote with data (bytes), not a dry run
+        #thing as it's only used for our own bookkeeping
+        import tempfile
+        with tempfile.NamedTemporaryFile("wb", prefix="rclone_bisync.") as tf:
+            tf.write(data)
+            tf.flush()
+            cmd = [RCLONE, "copyto", tf.name, self.remote + "/" + name]
+            self._run(cmd, Direction.remote)
+
+    def deletefile(self, name):
+        #skips the trash so the remote's 'about' totals aren't changed by it
+        cmd = [RCLONE, "deletefile", "--drive-use-trash=false", self.remote + "/" + name]
+        try:
+            self._run(cmd, Direction.remote)
+        except subprocess.CalledProcessError as e:
+            if(e.returncode not in (DIRNOTFOUND, FILENOTFOUND)):
+                raise
+
+    def dedupe(self, name, mode):
+        #merges/renames files with the same name under the remote dir 'name',
+        #see 'rclone dedupe' for the modes
+        target = self.remote + "/" + name if name else self.remote
+        cmd = [RCLONE, "dedupe", "--dedupe-mode", mode, target]
+        if(self.dryrun):
+            cmd.insert(1, "--dry-run")
+
+        print("cmd = '%s'" % (" ".join(cmd)))
+        rv = self._runlogged(cmd, Direction.remote)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def settime(self, name, direction, t):
+        #only updates the modtime, for when the contents are already the same
+        if(direction == Direction.local):
+            target = self.local
+        elif(direction == Direction.remote):
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
+
+        target += "/" + name
+
+        cmd = [RCLONE, "touch", "--no-create", "--localtime", "--timestamp", t.replace(" ", "T"), target]
+        if(self.dryrun):
+            cmd.insert(1, "--dry-run")
+
+        print("cmd = '%s'" % (" ".join(cmd)))
+        rv = self._runlogged(cmd, direction)
         self._dumpoutput("STDOUT:", rv.stdout)
-        self._dumpoutput("STDERR:", rv.stderr)
+
+    def purge(self, name, direction):
+        #removes a dir and everything in it, purge ignores filters (and would
+        #take local symlinks rclone never listed with it) so locally or with
+        #filter rules for the dir fall back to deleting just the listed files +
+        #empty dirs
+        if(direction == Direction.local):
+            target = self.local
+        elif(direction == Direction.remote):
+            target = self.remote
+        else:
+            raise ValueError("Invalid direction arg")
+
+        target += "/" + name
+
+        #the root's rules would be matched against paths relative to the dir
+        sub = self.subtree_filter(name)
+        if(sub is None):
+            raise ValueError("The filter rules can't be applied to just '%s'" % name)
+
+        with filesfrom(sub or None, ".filter") as ff:
+            if(ff or direction == Direction.local):
+                cmd = [RCLONE, "delete", "--rmdirs", target]
+                if(ff):
+                    cmd[1:1] = ["--filter-from", ff]
+            else:
+                cmd = [RCLONE, "purge", target]
+            if(self.dryrun):
+                cmd.insert(1, "--dry-run")
+
+            print("cmd = '%s'" % (" ".join(cmd)))
+            rv = self._runlogged(cmd, direction)
+        self._dumpoutput("STDOUT:", rv.stdout)
+
+    def _runlogged(self, cmd, direction):
+        #transfers run with json logging so their --stats can be picked up
+        cmd[1:1] = ["--use-json-log", "--stats", "1s", "--stats-log-level", "NOTICE"]
+        sid = object()
+
+        def onstderr(line):
+            (level, msg, stats) = parse_jsonlog(line)
+            if(stats):
+                self.metrics.update(sid, stats)
+            elif(msg):
+                print("    %s: %s" % (level, msg) if level else "    " + msg)
+
+        try:
+            return self._run(cmd, direction, onstderr)
+        finally:
+            self.metrics.finish(sid)
+
+    def _addfilter(self, cmd):
+        # filter rules are passed before the positional args so rclone
+        # prunes excluded subtrees while listing/transferring
+        if(self.filterfile):
+            cmd[1:1] = ["--filter-from", self.filterfile]
 
     def _parse_lsl(self, pipe):
         lsl = {}
@@ -220,6 +1226,7 @@ class rclone():
 
     def _parse_lsjson(self, pipe, target):
         lsj = {}
+        hk = hashkey(self.hashtype)
         j = json.loads(pipe)
 
         for f in j:
@@ -227,27 +1234,35 @@ class rclone():
                 continue
 
             n = f['Path']
-            lsj[n] = {}
+            r = {}
 
-            lsj[n]['size'] = f['Size']
+            r['size'] = f['Size']
             try:
-                lsj[n]['time'] = parsetime(f['ModTime'])
+                r['time'] = parsetime(f['ModTime'])
             except Exception as e:
                 print("ModTime failed to parse most likely:")
                 print("Modtime(dtstr) =", f['ModTime'])
                 print("e =", e)
                 raise(e)
 
-            if('Hashes' in f):
-                lsj[n]['md5sum'] = f['Hashes']['MD5']
-            else:
-                lsj[n]['md5sum'] = None
+            if(hk):
+                r[hk] = None
+                for h in f.get('Hashes') or {}:
+                    if(HASHNAMES.get(h, h.lower()) == self.hashtype):
+                        r[hk] = f['Hashes'][h] or None
 
             if(target == self.remote):
                 if('openxmlformats' in f['MimeType']):
-                    lsj[n]['gdoc'] = True
+                    r['gdoc'] = True
                 else:
-                    lsj[n]['gdoc'] = False
+                    r['gdoc'] = False
+                if(f.get('ID')):
+                    r['id'] = f['ID']
+
+            if(n in lsj):
+                #the same name twice in a dir (drive allows it)
+                r = pick_dup([lsj[n]] + lsj[n].pop('dups', []) + [r])
+            lsj[n] = r
 
         return lsj
 
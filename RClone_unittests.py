@@ -3,9 +3,16 @@
 #################################################################################
 ## Imports
 #################################################################################
+import os
+import sys
 import json
+import time
+import tempfile
 import unittest
-from RClone import rclone, parsetime
+import subprocess
+from RClone import rclone, parsetime, parsesize, pick_hash, hashkey, FilterRules, walk_local
+from RClone import Scheduler, TokenBucket, israteerror, remotename, Metrics, parse_jsonlog
+from RClone import Direction, list_strategy, partition_rules, subtree_rules, pick_dup, DIRNOTFOUND, NOTRAVERSEMAX
 
 
 class RClone__parse_lsjson(unittest.TestCase):
@@ -26,6 +33,426 @@ class RClone__parse_lsjson(unittest.TestCase):
 
         self.assertEqual(res, tstres)
 
+    def test__parse_lsjson_quickxor(self):
+        rc = rclone('local', 'remote', hashtype="quickxor")
+
+        orgdata = [
+            {"Path" : "file1", "Name" : "file1", "Size" : 200, "MimeType" : "application/octet-stream", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False, "Hashes" : {"QuickXorHash":"84c9c0969da606c489af7c673a305759c1b0c3b5"}},
+            {"Path" : "file2", "Name" : "file2", "Size" : 100, "MimeType" : "application/octet-stream", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False, "Hashes" : {"quickxor":"c9c0969da606c489af7c673a305759c1b0c3b584"}},
+            {"Path" : "file3", "Name" : "file3", "Size" : 100, "MimeType" : "application/octet-stream", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False, "Hashes" : {"quickxor":""}},
+        ]
+        tstres = {
+            "file1" : {'size' : 200, 'time' : "2017-12-20 18:38:49.460000", 'quickxorsum' : "84c9c0969da606c489af7c673a305759c1b0c3b5"},
+            "file2" : {'size' : 100, 'time' : "2017-12-20 18:38:49.460000", 'quickxorsum' : "c9c0969da606c489af7c673a305759c1b0c3b584"},
+            "file3" : {'size' : 100, 'time' : "2017-12-20 18:38:49.460000", 'quickxorsum' : None},
+        }
+
+        bdata = json.dumps(orgdata).encode('utf-8')
+        res = rc._parse_lsjson(bdata, 'local')
+
+        self.assertEqual(res, tstres)
+
+    def test__parse_lsjson_nohash(self):
+        rc = rclone('local', 'remote', hashtype=None)
+
+        orgdata = [
+            {"Path" : "file1", "Name" : "file1", "Size" : 200, "MimeType" : "application/octet-stream", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False},
+        ]
+        tstres = {
+            "file1" : {'size' : 200, 'time' : "2017-12-20 18:38:49.460000"},
+        }
+
+        bdata = json.dumps(orgdata).encode('utf-8')
+        res = rc._parse_lsjson(bdata, 'local')
+
+        self.assertEqual(res, tstres)
+
+    def test__parse_lsjson_dups(self):
+        rc = rclone('local', 'gdrive:', hashtype=None)
+
+        orgdata = [
+            {"Path" : "a", "Size" : 1, "MimeType" : "text/plain", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False, "ID": "2"},
+            {"Path" : "a", "Size" : 2, "MimeType" : "text/plain", "ModTime" : "2017-12-21T18:38:49.46-07:00", "IsDir": False, "ID": "3"},
+            {"Path" : "a", "Size" : 3, "MimeType" : "text/plain", "ModTime" : "2017-12-20T18:38:49.46-07:00", "IsDir": False, "ID": "1"},
+        ]
+
+        #the newest one whatever order they're listed in
+        for data in (orgdata, orgdata[::-1]):
+            res = rc._parse_lsjson(json.dumps(data).encode('utf-8'), 'gdrive:')
+            self.assertEqual(res['a']['id'], "3")
+            self.assertEqual([d['id'] for d in res['a']['dups']], ["1", "2"])
+
+        #unless the last sync was of another one
+        r = pick_dup([res['a']] + res['a']['dups'], "2")
+        self.assertEqual(r['id'], "2")
+        #the old pick goes into the dups without its own
+        self.assertEqual(len(r['dups']), len(res['a']['dups']))
+        self.assertFalse(any('dups' in d for d in r['dups']))
+
+class RClone_pick_hash(unittest.TestCase):
+    def test_pick_hash_md5(self):
+        self.assertEqual(pick_hash(["md5", "sha1", "crc32", "quickxor"], ["md5"]), "md5")
+
+    def test_pick_hash_cheapest(self):
+        self.assertEqual(pick_hash(["md5", "sha1", "crc32", "quickxor"], ["sha1", "quickxor"]), "quickxor")
+
+    def test_pick_hash_none_shared(self):
+        self.assertEqual(pick_hash(["md5", "sha1"], ["dropbox"]), None)
+        self.assertEqual(pick_hash(["md5", "sha1"], []), None)
+
+    def test_hashkey(self):
+        self.assertEqual(hashkey("md5"), "md5sum")
+        self.assertEqual(hashkey(None), None)
+
+class RClone__addfilter(unittest.TestCase):
+    def test__addfilter_none(self):
+        rc = rclone('local', 'remote')
+        cmd = ["rclone", "lsjson", "--hash", "--recursive", "local"]
+        rc._addfilter(cmd)
+        self.assertEqual(cmd, ["rclone", "lsjson", "--hash", "--recursive", "local"])
+
+    def test__addfilter(self):
+        rc = rclone('local', 'remote', filterfile='profile.filter')
+        cmd = ["rclone", "lsjson", "--hash", "--recursive", "local"]
+        rc._addfilter(cmd)
+        self.assertEqual(cmd, ["rclone", "--filter-from", "profile.filter", "lsjson", "--hash", "--recursive", "local"])
+
+class RClone_liststrategy(unittest.TestCase):
+    class Probe(rclone):
+        #records the commands instead of running them
+        def _run(self, cmd, direction, onstderr=None):
+            self.cmds.append(cmd)
+            out = {"backend": b'{"Name": "s3", "Features": {"ListR": true}}',
+                   "config": b'{"s3": {"type": "s3"}, "gdrive": {"type": "drive"}}'}.get(cmd[1], b'[]')
+            return subprocess.CompletedProcess(cmd, 0, out, b'')
+
+    def test_list_strategy(self):
+        self.assertEqual(list_strategy({'Features': {'ListR': True}}), "fast-list")
+        self.assertEqual(list_strategy({'Features': {'ListR': False}}), "partitioned")
+        self.assertEqual(list_strategy({}), "partitioned")
+
+    def test_pick_liststrategy_cached(self):
+        cache = {}
+        r = self.Probe("/local", "s3:bucket", featurecache=cache)
+        r.cmds = []
+        self.assertEqual(r.pick_liststrategy(), "fast-list")
+        self.assertEqual(list(cache), ["s3:bucket"])
+
+        #a new instance with the same cache doesn't probe again
+        r = self.Probe("/local", "s3:bucket", featurecache=cache)
+        r.cmds = []
+        self.assertEqual(r.pick_liststrategy("walk"), "walk")
+        self.assertEqual(r.pick_liststrategy(), "fast-list")
+        self.assertEqual(r.cmds, [])
+        with self.assertRaises(ValueError):
+            r.pick_liststrategy("bogus")
+
+    def test_chunkargs(self):
+        cache = {}
+        r = self.Probe("/local", "gdrive:dir", featurecache=cache)
+        r.cmds = []
+        self.assertEqual(r.chunkargs("64M"), ["--drive-chunk-size", "64M"])
+        self.assertEqual(r.chunkargs(None), [])
+        #the type is looked up once per remote
+        self.assertEqual(r.chunkargs("8M"), ["--drive-chunk-size", "8M"])
+        self.assertEqual(r.cmds, [["rclone", "config", "dump"]])
+        r = self.Probe("/local", "other:dir", featurecache=cache)
+        r.cmds = []
+        self.assertEqual(r.chunkargs("8M"), [])
+        r = self.Probe("/local", ":s3,provider=AWS:bucket")
+        self.assertEqual(r.chunkargs("8M"), ["--s3-chunk-size", "8M"])
+        r = self.Probe("/local", "/mnt/x")
+        self.assertEqual(r.chunkargs("8M"), [])
+
+    def test_lsjson_flags(self):
+        r = self.Probe("/local", "s3:bucket", hashtype=None)
+        r.cmds = []
+        r.liststrategy = "fast-list"
+        r.lsjson(Direction.remote)
+        r.lsjson(Direction.local)
+        r.lsjson(Direction.remote, names=["a"])
+        self.assertIn("--fast-list", r.cmds[0])
+        self.assertNotIn("--fast-list", r.cmds[1])
+        self.assertNotIn("--fast-list", r.cmds[2])
+        self.assertIn("--no-traverse", r.cmds[2])
+        #too many to look up one by one
+        r.lsjson(Direction.remote, names=[str(i) for i in range(NOTRAVERSEMAX + 1)])
+        self.assertIn("--files-from-raw", r.cmds[3])
+        self.assertNotIn("--no-traverse", r.cmds[3])
+
+    def test_dirop_filter(self):
+        #purge/copydir of a dir get the rules rewritten for it, not the root's
+        class Filtered(rclone):
+            def _run(self, cmd, direction, onstderr=None):
+                ff = cmd[cmd.index("--filter-from") + 1] if "--filter-from" in cmd else None
+                with open(ff) if ff else open(os.devnull) as f:
+                    self.cmds.append(([c for c in cmd if c in ("copy", "delete", "purge")][0], f.read().split("\n")))
+                return subprocess.CompletedProcess(cmd, 0, b'', b'')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(tmp + "/filter", "w") as f:
+                f.write("- /data/cache/**\n+ /d/**\n- /**\n")
+            r = Filtered("/local", "remote:", filterfile=tmp + "/filter")
+            r.cmds = []
+            r.purge("data", Direction.remote)
+            r.copydir("d/sub", Direction.remote)
+            self.assertEqual(r.cmds, [("delete", ["- /cache/**", "- /**", ""]), ("copy", ["+ /**", "- /**", ""])])
+
+            with open(tmp + "/filter", "w") as f:
+                f.write("- /d/x/**\n")
+            r.cmds = []
+            r.purge("e", Direction.remote)
+            self.assertEqual(r.cmds, [("purge", [""])])
+
+            with open(tmp + "/filter", "w") as f:
+                f.write("- /**/x\n")
+            with self.assertRaises(ValueError):
+                r.purge("e", Direction.remote)
+
+    def test_partition_rules(self):
+        rules = ["- *.tmp\n", "- /top.txt", "- /photos/raw/**", "+ /docs/**", "- cache/", "- photos/thumbs/**", "- /*"]
+        self.assertEqual(partition_rules(rules, "photos"), ["- *.tmp", "- /raw/**", "- cache/", "- photos/thumbs/**", "- /thumbs/**"])
+        self.assertEqual(partition_rules(rules, "docs"), ["- *.tmp", "+ /**", "- cache/", "- photos/thumbs/**"])
+        self.assertEqual(partition_rules(["- /p*/raw/**"], "photos"), ["- /raw/**"])
+        self.assertEqual(partition_rules(["+ /photos/**", "- **"], "photos"), ["+ /**", "- /**"])
+        #can't tell where these start
+        self.assertEqual(partition_rules(["- /**/raw"], "photos"), None)
+        self.assertEqual(partition_rules(["- {a/b,c}"], "photos"), None)
+        self.assertEqual(partition_rules(["- /photos/"], "photos"), None)
+
+    def test_lsjson_partitioned(self):
+        class Parts(self.Probe):
+            def _run(self, cmd, direction, onstderr=None):
+                self.cmds.append(cmd)
+                if(cmd[-1] == "gdrive:"):
+                    out = (b'[{"Path": "a", "IsDir": true}, {"Path": "b", "IsDir": true},'
+                           b' {"Path": "top", "IsDir": false, "Size": 1, "ModTime": "2017-12-20T15:43:27.776000-07:00", "MimeType": "text/plain"}]')
+                else:
+                    out = (b'[{"Path": "x/y", "IsDir": false, "Size": 2, "ModTime": "2017-12-20T15:43:27.776000-07:00", "MimeType": "text/plain"}]')
+                return subprocess.CompletedProcess(cmd, 0, out, b'')
+
+        r = Parts("/local", "gdrive:", hashtype=None)
+        r.cmds = []
+        r.liststrategy = "partitioned"
+        l = r.lsjson(Direction.remote)
+        self.assertEqual(sorted(l), ["a/x/y", "b/x/y", "top"])
+        self.assertEqual(l["a/x/y"]['size'], 2)
+        self.assertEqual(sorted(c[-1] for c in r.cmds), ["gdrive:", "gdrive:a", "gdrive:b"])
+
+    def test_subtree_rules(self):
+        rules = ["- *.tmp", "- /projects/foo/build/**", "- /projects/bar/**"]
+        self.assertEqual(subtree_rules(rules, "projects/foo"), ["- *.tmp", "- /build/**"])
+        self.assertEqual(subtree_rules(["- /**/build"], "projects/foo"), None)
+
+    def test_lsjson_subtree(self):
+        class Sub(self.Probe):
+            def _run(self, cmd, direction, onstderr=None):
+                self.cmds.append(cmd)
+                if(cmd[-1] == "/local/p/new"):
+                    raise subprocess.CalledProcessError(DIRNOTFOUND, cmd, b'', b'directory not found')
+                out = (b'[{"Path": "x", "IsDir": true}, {"Path": "x/y", "IsDir": false, "Size": 2,'
+                       b' "ModTime": "2017-12-20T15:43:27.776000-07:00", "MimeType": "text/plain"}]')
+                return subprocess.CompletedProcess(cmd, 0, out, b'')
+
+        r = Sub("/local", "gdrive:", hashtype=None)
+        r.cmds = []
+        r.liststrategy = "partitioned"
+        self.assertEqual(list(r.lsjson(Direction.remote, path="p/q")), ["p/q/x/y"])
+        self.assertEqual(list(r.lsjson(Direction.local, path="p/q")), ["p/q/x/y"])
+        self.assertEqual(r.lsjson(Direction.local, path="p/new"), {})
+        self.assertEqual([c[-1] for c in r.cmds], ["gdrive:p/q", "/local/p/q", "/local/p/new"])
+
+class RClone_FilterRules(unittest.TestCase):
+    def test_FilterRules_unanchored(self):
+        fr = FilterRules(["- *.tmp"])
+        self.assertFalse(fr.included("a.tmp"))
+        self.assertFalse(fr.included("dir/sub/a.tmp"))
+        self.assertTrue(fr.included("a.tmp.txt"))
+
+    def test_FilterRules_anchored(self):
+        fr = FilterRules(["- /build/**"])
+        self.assertFalse(fr.included("build/out.o"))
+        self.assertTrue(fr.included("src/build/out.o"))
+        self.assertFalse(fr.included("build", isdir=True))
+        self.assertTrue(fr.included("src/build", isdir=True))
+
+    def test_FilterRules_dirs(self):
+        fr = FilterRules(["- .git/", "- *.pyc"])
+        self.assertFalse(fr.included("proj/.git", isdir=True))
+        self.assertTrue(fr.included("proj/.git"))
+        #file rules never prune a whole dir
+        self.assertTrue(fr.included("x.pyc", isdir=True))
+
+    def test_FilterRules_first_match(self):
+        fr = FilterRules(["# comment", "+ *.txt", "- *"])
+        self.assertTrue(fr.included("dir/a.txt"))
+        self.assertFalse(fr.included("dir/a.doc"))
+        self.assertTrue(fr.included("dir", isdir=True))
+
+    def test_FilterRules_implied_dirs(self):
+        #like rclone an include keeps the dirs on the way to what it matches
+        fr = FilterRules(["+ /a/b/**", "- /a/**"])
+        self.assertTrue(fr.included("a", isdir=True))
+        self.assertTrue(fr.included("a/b", isdir=True))
+        self.assertFalse(fr.included("a/c", isdir=True))
+        self.assertTrue(fr.included("a/b/keep.txt"))
+        self.assertFalse(fr.included("a/c.txt"))
+
+        fr = FilterRules(["+ /x/**/y.txt", "- /**"])
+        self.assertTrue(fr.included("x/p/q", isdir=True))
+        self.assertFalse(fr.included("z", isdir=True))
+
+    def test_FilterRules_braces_clear(self):
+        fr = FilterRules(["- *.{jpg,png}"])
+        self.assertFalse(fr.included("a.png"))
+        self.assertFalse(fr.included("a.jpg"))
+        self.assertTrue(fr.included("a.gif"))
+        fr.add("!")
+        self.assertTrue(fr.included("a.png"))
+
+    def test_FilterRules_bad(self):
+        with self.assertRaises(ValueError):
+            FilterRules(["*.tmp"])
+
+class RClone_walk_local(unittest.TestCase):
+    def test_walk_local(self):
+        with tempfile.TemporaryDirectory() as d:
+            for n in ("a.txt", "b.tmp", "sub/c.txt", ".git/objects/x", "sub/.git/y"):
+                os.makedirs(os.path.dirname(os.path.join(d, n)), exist_ok=True)
+                with open(os.path.join(d, n), "w") as f:
+                    f.write(n)
+
+            res = [n for (n, st) in walk_local(d, FilterRules(["- .git/**", "- *.tmp"]))]
+            self.assertEqual(res, ["a.txt", "sub/c.txt"])
+
+            res = [n for (n, st) in walk_local(d, FilterRules(["+ /sub/c.txt", "- /sub/**"]))]
+            self.assertEqual(res, [".git/objects/x", "a.txt", "b.tmp", "sub/c.txt"])
+
+            res = [n for (n, st) in walk_local(d)]
+            self.assertEqual(res, [".git/objects/x", "a.txt", "b.tmp", "sub/.git/y", "sub/c.txt"])
+
+class RClone_parsesize(unittest.TestCase):
+    def test_parsesize(self):
+        self.assertEqual(parsesize(1024), 1024)
+        self.assertEqual(parsesize("1024"), 1024)
+        self.assertEqual(parsesize("10K"), 10240)
+        self.assertEqual(parsesize("256M"), 256 * 1024 * 1024)
+        self.assertEqual(parsesize("1.5G"), 3 * 512 * 1024 * 1024)
+        self.assertEqual(parsesize("64MiB"), 64 * 1024 * 1024)
+
+    def test_parsesize_bad(self):
+        with self.assertRaises(ValueError):
+            parsesize("lots")
+
+class RClone_Scheduler(unittest.TestCase):
+    def test_israteerror(self):
+        self.assertTrue(israteerror(b'googleapi: Error 403: User Rate Limit Exceeded, userRateLimitExceeded'))
+        self.assertTrue(israteerror(b'HTTP error 429 (429 Too Many Requests)'))
+        self.assertTrue(israteerror(b'SlowDown: Please reduce your request rate.\n\tstatus code: 503'))
+        self.assertFalse(israteerror(b'directory not found'))
+        self.assertFalse(israteerror(b'ERROR : 429.jpg: Failed to copy: directory not found'))
+        self.assertFalse(israteerror(b'ERROR : rate limit notes.txt: Failed to copy: permission denied'))
+        self.assertFalse(israteerror(b''))
+
+    def test_remotename(self):
+        self.assertEqual(remotename("gdrive:some/dir"), "gdrive")
+        self.assertEqual(remotename("/home/user/dir"), None)
+        self.assertEqual(remotename("C:\\Users"), None)
+
+    def test_TokenBucket(self):
+        tb = TokenBucket(100, 2)
+        start = time.monotonic()
+        for i in range(4):
+            tb.acquire()
+        #2 from the burst, the other 2 at 100/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.015)
+
+    def test_run_retry(self):
+        sc = Scheduler(retries=2, basedelay=0.001)
+        cmd = [sys.executable, "-c", "import sys; sys.stderr.write('429 Too Many Requests'); sys.exit(1)"]
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            sc.run(cmd, "remote")
+        self.assertIn(b'429', cm.exception.stderr)
+
+    def test_run_no_retry(self):
+        sc = Scheduler(retries=2, basedelay=10)
+        cmd = [sys.executable, "-c", "import sys; sys.stderr.write('not found'); sys.exit(3)"]
+        start = time.monotonic()
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            sc.run(cmd, "remote")
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_run_ok(self):
+        sc = Scheduler(rate=50)
+        rv = sc.run([sys.executable, "-c", "print('ok')"])
+        self.assertEqual(rv.stdout.strip(), b'ok')
+
+    def test_run_tpslimit(self):
+        runs = []
+        sc = Scheduler()
+        sc._exec = lambda cmd, onstderr: runs.append(cmd) or subprocess.CompletedProcess(cmd, 0, b'', b'')
+        sc.setrate("remote", 5, 3)
+        cmd = ["rclone", "lsjson", "remote:"]
+        sc.run(cmd, "remote")
+        sc.run(cmd)
+        self.assertEqual(runs, [["rclone", "--tpslimit", "5", "--tpslimit-burst", "3", "lsjson", "remote:"], cmd])
+        self.assertEqual(cmd, ["rclone", "lsjson", "remote:"])
+
+        #processes side by side split the rate
+        runs.clear()
+        with sc.share("remote", 4):
+            sc.run(cmd, "remote")
+        sc.run(cmd, "remote")
+        self.assertEqual(runs[0][1:5], ["--tpslimit", "1.25", "--tpslimit-burst", "1"])
+        self.assertEqual(runs[1][1:5], ["--tpslimit", "5", "--tpslimit-burst", "3"])
+        self.assertEqual(sc.running, {"remote": 0})
+
+class RClone_Metrics(unittest.TestCase):
+    def test_parse_jsonlog(self):
+        line = b'{"level":"notice","msg":"stats","source":"accounting/stats.go:482","stats":{"bytes":1024,"transfers":2,"errors":0},"time":"2024-01-01T00:00:00Z"}\n'
+        self.assertEqual(parse_jsonlog(line), ("notice", "stats", {"bytes": 1024, "transfers": 2, "errors": 0}))
+        self.assertEqual(parse_jsonlog(b'panic: oops\n'), (None, "panic: oops", None))
+
+    def test_Metrics_live_and_final(self):
+        m = Metrics()
+        sid = object()
+        m.update(sid, {"bytes": 100, "transfers": 1})
+        self.assertEqual(m.snapshot()['bytes'], 100)
+        self.assertTrue(m.snapshot()['running'])
+
+        m.update(sid, {"bytes": 300, "transfers": 3})
+        m.finish(sid)
+        m.update(object(), {"bytes": 50, "transfers": 1})
+        j = m.snapshot()
+        self.assertEqual(j['bytes'], 350)
+        self.assertEqual(j['transfers'], 4)
+
+    def test_Metrics_write(self):
+        m = Metrics()
+        m.labels['profile'] = "test"
+        m.inc('rcloneruns', 3)
+        m.extra['concurrency'] = {'small': {'final': 12, 'trace': [{'value': 11}]}}
+        with m.phase("apply"):
+            pass
+
+        with tempfile.TemporaryDirectory() as d:
+            m.outputs = {'json': d + "/m.json", 'prom': d + "/m.prom"}
+            m.write()
+
+            with open(d + "/m.json") as f:
+                j = json.load(f)
+            self.assertEqual(j['rcloneruns'], 3)
+            self.assertIn('apply', j['phases'])
+            self.assertFalse(j['running'])
+
+            with open(d + "/m.prom") as f:
+                prom = f.read()
+            self.assertIn('rclone_bisync_rcloneruns_total{profile="test"} 3\n', prom)
+            self.assertIn('rclone_bisync_phase_seconds{profile="test",phase="apply"}', prom)
+            self.assertIn('rclone_bisync_concurrency{profile="test",class="small"} 12\n', prom)
+            self.assertEqual(sorted(os.listdir(d)), ["m.json", "m.prom"])
+
 class RClone_parsetime(unittest.TestCase):
     def test_parsetime_local(self):
         dt = "2018-07-22T20:54:59.696878795-06:00"
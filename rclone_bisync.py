@@ -3,22 +3,36 @@
 #################################################################################
 ## Imports
 #################################################################################
-import io
+#anything not needed to start up (or for --status) is imported where it's
+#used, RClone, subprocess and threading are loaded on 1st use
 import os
 import sys
 import json
-import argparse
-from enum import Enum
-from xdg.BaseDirectory import xdg_config_home
-
-import RClone
+import math
+import time
+import bisect
+import contextlib
+import importlib.util
+
+def lazy_import(name):
+    if(name in sys.modules):
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+RClone = lazy_import("RClone")
+subprocess = lazy_import("subprocess")
+threading = lazy_import("threading")
 
 
 #################################################################################
 ## TODO
 #################################################################################
 # Better google doc handling
-# handle dup file names
 # use sync to copy files 1 dir
 # other meta data?
 # renamed files
@@ -29,23 +43,109 @@ import RClone
 #################################################################################
 NAME = "rclone_bisync"
 VERSION = "0.0.1"
+NOOPMAXAGE = 24 #hours
+COLLAPSEMIN = 2 #files, smallest dir worth a single dir level copy/purge
+MAXATTEMPTS = 3
+RETRYDELAY = 2 #seconds, doubles each attempt
+
+#per profile transfer tuning, files under smallsize are batched into one
+#'rclone copy' and files of largesize or more get multi-thread streams.
+#adaptive tunes the small batches' --transfers (starting from smallargs) and
+#how many medium files are copied side by side while the changes are applied
+TRANSFER = {
+    'smallsize': "1M",
+    'largesize': "256M",
+    'smallargs': ["--transfers", "32", "--checkers", "64"],
+    'largeargs': ["--multi-thread-streams", "8", "--multi-thread-cutoff", "64M"],
+    'chunksize': "64M",
+    'batchsize': 1000,
+    'adaptive': True,
+    'maxtransfers': 128,
+    'workers': 4,
+    'maxworkers': 16,
+}
+WAVEROUNDS = 4 #files per transfer in each adaptive batch
+ORDERS = ("listing", "smallest", "largest", "locality", "priority")
+SIZECLASSES = ("small", "medium", "large")
+
+#lease on the remote so runs from several machines against it take turns,
+#ttl/wait/settle are secs. name is the lock's key on the remote, the
+#profile's name by default, so clones that share the remote need the same
+#profile name (or the same 'name' here)
+LOCK = {
+    'enabled': False,
+    'name': None,
+    'ttl': 300,
+    'wait': 0,
+    'settle': 2,
+}
+LOCKFILE = ".rclone_bisync.%s.lock"
+LOCKRULE = "- /.rclone_bisync.*.lock"
+
+#fast lists without hashes and compares size + modtime only, each run then
+#checks the next 'fraction' of the files by hash against the ones stored in
+#the previous file so the whole tree is re-verified every 1/fraction runs
+AUDIT = {
+    'fast': False,
+    'fraction': 0.02,
+}
+
+#what to do with several files under one name on the remote (drive allows
+#it), skip syncs just one of them and leaves the rest alone, the others are
+#'rclone dedupe' modes run on the dirs that have them
+DUPMODES = ("skip", "rename", "newest", "oldest", "largest", "smallest", "first")
+
+#requests per second allowed against the remote, None for no limit (rclone's
+#--tpslimit split over the rclone processes running at the same time, which
+#are also spaced out at that rate), retries are for rate limit errors only
+RATELIMIT = {
+    'tps': None,
+    'burst': None,
+    'retries': 8,
+    'maxdelay': 120,
+}
 
 
 #################################################################################
-## Global Vars
+## Engine defaults
 #################################################################################
-files = {}
-config = {}
-rclone = None
+#SyncEngine settings that aren't required, hashtype/window/settime are
+#worked out by connect()
+ENGINEDEFAULTS = {
+    'gdocs': False,
+    'filterfile': None,
+    'failfile': None,
+    'dryrun': False,
+    'full': False,
+    'noopmaxage': NOOPMAXAGE,
+    'transfer': TRANSFER,
+    'ratelimit': RATELIMIT,
+    'lock': LOCK,
+    'audit': AUDIT,
+    'dupnames': "skip",
+    'maxattempts': MAXATTEMPTS,
+    'order': "listing",
+    'priority': [],
+    'timebudget': None,
+    'timewindow': None,
+    'liststrategy': "auto",
+    'path': None,
+    'hashtype': "md5",
+    'window': 0,
+    'settime': False,
+}
 
 
 #################################################################################
-## Enums
+## Errors
 #################################################################################
+class SyncError(Exception):
+    #anything that stops a sync, the message is meant for the user
+    pass
 
 
 #################################################################################
-## Remote File Code
+## Version
 #################################################################################
 def VersionAsInt():
     ver = VERSION.split(".")
@@ -53,72 +153,129 @@ def VersionAsInt():
 
 
 #################################################################################
-## Remote File Code
+## Directory (Merkle) digests
 #################################################################################
-def get_remote_list():
-    rlist = rclone.lsjson(RClone.Direction.remote, includegdocs=True)
+def tree_digests(records, hashkey, timekey='time'):
+    #digest of a dir covers its files (name, size, hash, time) and the digests
+    #of its sub dirs so an unchanged digest means the whole subtree is unchanged
+    #time is included as calc_diffs also acts on time only changes
+    import hashlib
+    lines = {'': []}
+    subdirs = {}
+
+    for name in records:
+        r = records[name]
+        if(r.get('gdoc')):
+            continue
 
-    for name in rlist:
-        if(name not in files):
-            files[name] = {}
-        files[name]['remote'] = rlist[name]
+        d, _, base = name.rpartition('/')
+        h = r.get(hashkey) if hashkey else None
+        if(d not in lines):
+            #1st time we see this dir, hook it (and any new parents) into the tree
+            c = d
+            while(c not in lines):
+                lines[c] = []
+                p = c.rpartition('/')[0]
+                subdirs.setdefault(p, []).append(c)
+                c = p
+        lines[d].append("f\0%s\0%s\0%s\0%s" % (base, r['size'], h or "", r[timekey]))
+
+    digests = {}
+    for d in sorted(lines, key=lambda x: x.count('/') + (1 if x else 0), reverse=True):
+        entries = lines[d] + ["d\0%s\0%s" % (sd.rpartition('/')[2], digests[sd]) for sd in subdirs.get(d, [])]
+        h = hashlib.sha1()
+        for e in sorted(entries):
+            h.update(e.encode('utf-8', 'surrogateescape') + b'\n')
+        digests[d] = h.hexdigest()
+
+    return digests
+
+def unchanged_dirs(prevtree, localtree, remotetree):
+    #dirs whose local and remote digests both still match the previous sync
+    if(not prevtree):
+        return set()
+
+    pl = prevtree['local']
+    pr = prevtree['remote']
+    return {d for d in localtree if(d in pl and pl[d] == localtree[d] and
+                                    d in pr and d in remotetree and pr[d] == remotetree[d])}
+
+def get_tree(f, which, hashkey, timekey='time'):
+    r = {name: f[name][which] for name in f if which in f[name]}
+    return tree_digests(r, hashkey, timekey)
 
 
 #################################################################################
-## Local File Code
+## Path prefix index
 #################################################################################
-def get_local_list():
-    llist = rclone.lsjson(RClone.Direction.local)
-
-    for name in llist:
-        if(name not in files):
-            files[name] = {}
-        files[name]['local'] = llist[name]
-
-
-#################################################################################
-## Previous File Code
-#################################################################################
-def get_previous_list():
-    try:
-        with open(config['prevfile'], "r") as f:
-            plist = json.load(f)
-
-        if(plist['version'] != VersionAsInt()):
-            print("Previous file is of an old unsupported version!")
-            sys.exit(1)
-
-        f = plist['files']
-        for name in f:
-            files[name] = {}
-            files[name]['previous'] = {}
-            files[name]['previous']['size'] = int(f[name]['previous']['size'])
-            files[name]['previous']['time'] = RClone.parsetime(f[name]['previous']['time'])
-            files[name]['previous']['rtime'] = RClone.parsetime(f[name]['previous']['rtime'])
-            files[name]['previous']['md5sum'] = f[name]['previous']['md5sum']
-
-    except FileNotFoundError:
-        print("Missing previous file (%s), you will have to re-run the initial sync!" % config['prevfile'])
-        sys.exit(1)                
-    except json.JSONDecodeError:
-        print("Previous file (%s) is corrupt!" % config['prevfile'])
-        sys.exit(1)                
-    except KeyError:
-        print("Previous file (%s) is missing a key!" % config['prevfile'])
-        print(name)
-        print(files[name])
-        sys.exit(1)
+def prefix_names(names, prefix):
+    #the names under prefix ('a/b/') out of a sorted list, everything under a
+    #dir sorts together so it's two bisects instead of a scan
+    if(not prefix):
+        return names
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return names[bisect.bisect_left(names, prefix):bisect.bisect_left(names, end)]
+
+def sync_prefix(path):
+    #'/a/b/' -> 'a/b/', the prefix of the names a --path sync covers
+    if(not path or not path.strip("/")):
+        return ""
+    path = path.strip("/")
+    if(".." in path.split("/")):
+        raise SyncError("Path '%s' has to be inside the sync root" % path)
+    return path + "/"
 
 
 #################################################################################
 ## Calculate Diffs & Actions
 #################################################################################
-def calc_diffs(f):
+def in_skipped(name, skip, memo):
+    #True if any parent dir of name is in skip, memo caches the answer per dir
+    d = name.rpartition('/')[0]
+    if(d not in memo):
+        memo[d] = d in skip or (d != '' and in_skipped(d, skip, memo))
+    return memo[d]
+
+def time_changed(t1, t2, window=0):
+    #window is the modtime precision (secs) of the backends, anything closer
+    #than that is the same time
+    if(t1 == t2):
+        return False
+    if(not window):
+        return True
+
+    from datetime import datetime
+    d1 = datetime.strptime(t1[:26], RClone.TIMEFMT)
+    d2 = datetime.strptime(t2[:26], RClone.TIMEFMT)
+    return abs((d1 - d2).total_seconds()) > window
+
+def same_contents(f, hashkey):
+    #local and remote are known to be the same file (size and hash match)
+    if('local' not in f or 'remote' not in f or not hashkey):
+        return False
+    L = f['local']
+    R = f['remote']
+    return (L['size'] == R['size'] and L.get(hashkey) and L.get(hashkey) == R.get(hashkey))
+
+def calc_diffs(f, hashkey='md5sum', skip=None, window=0, settime=False):
+    #settime: a time only change of a file whose contents already match on
+    #both sides just gets its modtime set instead of being copied. window is
+    #(local, remote), each side's times are only as precise as that side
+    #keeps them, a single number is used for both
+    (lwindow, rwindow) = window if isinstance(window, tuple) else (window, window)
     cf = {}
     tests = ((0, 1), (0, 2)) #0=Previous, 1=Local, 2=Remote; so compare Prev to Curr, Prev to Remote
     lookups = ('previous', 'local', 'remote')
+    memo = {}
+
+    if(skip and '' in skip):
+        #nothing changed anywhere
+        return cf
 
     for name in f:
+        if(skip and in_skipped(name, skip, memo)):
+            continue
+
         vals = ('previous' in f[name], 'local' in f[name], 'remote' in f[name])
 
         if(vals[2] and f[name]['remote']['gdoc']): #fix me -- google doc work
@@ -134,8 +291,11 @@ def calc_diffs(f):
             L2 = lookups[test[1]]
 
             if(T1 and T2):
-                if(f[name][L1]['md5sum'] != f[name][L2]['md5sum']):
-                    f[name]['changed'] = 'md5sum'
+                #a hash can only be compared when both sides have one
+                H1 = f[name][L1].get(hashkey) if hashkey else None
+                H2 = f[name][L2].get(hashkey) if hashkey else None
+                if(H1 and H2 and H1 != H2):
+                    f[name]['changed'] = hashkey
                     if('which' not in f[name]):
                         f[name]['which'] = RClone.Direction.neither
                     f[name]['which'] |= test[1]
@@ -150,10 +310,10 @@ def calc_diffs(f):
 
         if('changed' not in f[name]):
             w = 0
-            if(vals[0] and vals[1] and f[name]['previous']['time'] != f[name]['local']['time']):
+            if(vals[0] and vals[1] and time_changed(f[name]['previous']['time'], f[name]['local']['time'], lwindow)):
                 f[name]['changed'] = 'time'
                 w += 1 #copy to remote
-            if(vals[0] and vals[2] and f[name]['previous']['rtime'] != f[name]['remote']['time']):
+            if(vals[0] and vals[2] and time_changed(f[name]['previous']['rtime'], f[name]['remote']['time'], rwindow)):
                 f[name]['changed'] = 'time'
                 w += 2 #copy to local
             if(w):
@@ -162,6 +322,10 @@ def calc_diffs(f):
         if('changed' in f[name] or 'missing' in f[name]):
             cf[name] = calc_actions(f[name])
 
+            if(settime and f[name].get('changed') == 'time' and cf[name]['action'] == RClone.Action.copyto and
+               same_contents(f[name], hashkey)):
+                cf[name]['action'] = RClone.Action.settime
+
     return cf
 
 def calc_actions(f):
@@ -228,75 +392,1588 @@ def calc_actions(f):
 
 
 #################################################################################
-## Run1stSync
+## Duplicate Contents
+#################################################################################
+def find_dups(changed_files, f, hashkey, sides, minsize=0):
+    #copies of contents (size + hash) that already exist at another path on
+    #the side being copied to become a copy within that side instead, ie a
+    #server side copy on the remote. sides are the directions where that's
+    #possible, files under minsize aren't worth a copy of their own
+    if(not hashkey):
+        return 0
+
+    #anything being overwritten/deleted on a side can't be copied from
+    busy = {RClone.Direction.local: set(), RClone.Direction.remote: set()}
+    for name in changed_files:
+        if(changed_files[name]['action'] in (RClone.Action.copyto, RClone.Action.deletefrom)):
+            busy[changed_files[name]['direction']].add(name)
+
+    index = {}
+    for side in sides:
+        index[side] = {}
+        for name in f:
+            r = f[name].get(side.name)
+            if(r and r.get(hashkey) and r['size'] and not r.get('gdoc') and name not in busy[side]):
+                index[side].setdefault((r['size'], r[hashkey]), name)
+
+    count = 0
+    for name in changed_files:
+        c = changed_files[name]
+        if(c['action'] != RClone.Action.copyto or c['direction'] not in index):
+            continue
+        r = f[name]['local' if c['direction'] == RClone.Direction.remote else 'remote']
+        source = index[c['direction']].get((r['size'], r.get(hashkey)))
+        if(source and r['size'] >= minsize):
+            c['action'] = RClone.Action.dupcopy
+            c['source'] = source
+            count += 1
+
+    return count
+
+
+#################################################################################
+## Collapse Dirs
 #################################################################################
-def Run1stSync():
-    localdirexisted = False
+def collapse_dirs(changed_files, f, mincount=COLLAPSEMIN, top=""):
+    #finds the topmost dirs where every file known under it (in any of
+    #previous/local/remote) gets the same copy/delete in the same direction,
+    #those become a single 'rclone copy' of the dir or a purge. only dirs
+    #under top are looked at, f doesn't know what else is in the ones above it
+    MIXED = object()
+    dirop = {}
+    count = {}
 
-    if(os.path.isdir(config["local"])):
-        localdirexisted = True
+    for name in f:
+        c = changed_files.get(name)
+        if(c and c['action'] in (RClone.Action.copyto, RClone.Action.deletefrom)):
+            op = (c['action'], c['direction'])
+        else:
+            op = MIXED
+
+        d = name.rpartition('/')[0]
+        while(d and (d + "/").startswith(top)):
+            dirop[d] = op if dirop.get(d, op) == op else MIXED
+            count[d] = count.get(d, 0) + 1
+            d = d.rpartition('/')[0]
+
+    dirs = {}
+    for d in sorted(dirop, key=lambda x: x.count('/')):
+        if(dirop[d] is MIXED or count[d] < mincount):
+            continue
+        #a parent is already being collapsed
+        p = d.rpartition('/')[0]
+        covered = False
+        while(p):
+            if(p in dirs):
+                covered = True
+                break
+            p = p.rpartition('/')[0]
+        if(covered):
+            continue
+
+        (action, direction) = dirop[d]
+        dirs[d] = {'action': RClone.Action.copydir if action == RClone.Action.copyto else RClone.Action.purge,
+                   'direction': direction, 'dir': d, 'names': []}
+
+    if(dirs):
+        for name in changed_files:
+            d = name.rpartition('/')[0]
+            while(d):
+                if(d in dirs):
+                    dirs[d]['names'].append(name)
+                    break
+                d = d.rpartition('/')[0]
+
+    return dirs
+
+
+#################################################################################
+## Apply Changes
+#################################################################################
+def size_class(size, tconf):
+    if(size < RClone.parsesize(tconf['smallsize'])):
+        return "small"
+    elif(size >= RClone.parsesize(tconf['largesize'])):
+        return "large"
+    return "medium"
+
+def transfer_size(f, name, direction):
+    #size of the source side of a copy
+    src = 'local' if direction == RClone.Direction.remote else 'remote'
+    return f[name].get(src, {}).get('size', 0)
+
+#apply_one()'s error for a transfer --max-duration stopped, see unfinished()
+CUTOFF = "stopped by the time budget"
+
+def errmsg(e):
+    #last non blank line rclone wrote to stderr, usually the actual error
+    lines = [l for l in (e.stderr or b'').decode('utf-8', 'replace').splitlines() if l.strip()]
+    return lines[-1] if lines else str(e)
+
+def change_size(f, name, c):
+    if(c['action'] != RClone.Action.copyto):
+        return 0
+    return transfer_size(f, name, c['direction'])
+
+def order_changes(changed_files, f, order, priority=(), dirs=None):
+    #the files of a collapse_dirs() dir are ordered as one, by their total size
+    #or the 1st of them to come up
+    names = list(changed_files)
+    dirs = dirs or {}
+    dirof = {name: d for d in dirs for name in dirs[d]['names']}
+    dirsize = {d: sum(change_size(f, n, changed_files[n]) for n in dirs[d]['names']) for d in dirs}
+    size = lambda n: dirsize[dirof[n]] if n in dirof else change_size(f, n, changed_files[n])
+
+    if(order == "smallest"):
+        names.sort(key=size)
+    elif(order == "largest"):
+        names.sort(key=size, reverse=True)
+    elif(order == "locality"):
+        names.sort(key=lambda n: (n.rpartition('/')[0], n))
+    elif(order == "priority"):
+        #1st matching glob wins, everything else after in listing order
+        rx = [RClone.glob_to_regex(g) for g in priority]
+        def prio(n):
+            for (i, r) in enumerate(rx):
+                if(r.search(n)):
+                    return i
+            return len(rx)
+        dirprio = {d: min(prio(n) for n in dirs[d]['names']) for d in dirs}
+        names.sort(key=lambda n: dirprio[dirof[n]] if n in dirof else prio(n))
+    elif(order != "listing"):
+        raise ValueError("Unknown order '%s'" % order)
+
+    return names
+
+def plan_units(names, changed_files, f, tconf, dirs=None):
+    #turns the ordered changes into units of work, runs of small copies in the
+    #same direction become one batch, deletes always go last. with adaptive
+    #concurrency runs of medium copies are grouped too. the files of a dir in
+    #dirs are one "dir" unit where the 1st of them is (purges with the deletes)
+    units = []
+    deletes = []
+    grouped = ("small", "medium") if tconf['adaptive'] else ("small",)
+    dirs = dirs or {}
+    dirof = {name: d for d in dirs for name in dirs[d]['names']}
+    done = set()
+
+    for name in names:
+        c = changed_files[name]
+        if(name in dirof):
+            d = dirof[name]
+            if(d not in done):
+                done.add(d)
+                u = ("dir", dirs[d]['direction'], [d])
+                (deletes if dirs[d]['action'] == RClone.Action.purge else units).append(u)
+        elif(c['action'] == RClone.Action.copyto):
+            sc = size_class(transfer_size(f, name, c['direction']), tconf)
+            u = units[-1] if units else None
+            if(sc in grouped and u and u[0] == sc and u[1] == c['direction'] and len(u[2]) < tconf['batchsize']):
+                u[2].append(name)
+            else:
+                units.append((sc, c['direction'], [name]))
+        elif(c['action'] == RClone.Action.dupcopy):
+            units.append(("dup", c['direction'], [name]))
+        elif(c['action'] in (RClone.Action.deletefrom, RClone.Action.settime)):
+            deletes.append((None, c['direction'], [name]))
+
+    return units + deletes
+
+
+def flag_value(args, flag, default=None):
+    #value of '--flag N' in an rclone arg list
+    if(flag in args[:-1]):
+        return args[args.index(flag) + 1]
+    return default
+
+def set_flag(args, flag, value):
+    #copy of args with '--flag value' replaced (or added)
+    args = list(args)
+    if(flag in args[:-1]):
+        args[args.index(flag) + 1] = str(value)
     else:
-        os.mkdir(config["local"])
+        args += [flag, str(value)]
+    return args
+
+class AIMD():
+    #additive increase/multiplicative decrease of a concurrency (transfers or
+    #workers) going by how each batch of copies went: +1 while the throughput
+    #holds up, halved on errors/rate limiting. the time per file isn't used,
+    #it goes with the sizes of the files more than with how busy the far end
+    #is. every batch is traced for the metrics
+    def __init__(self, start, hi, lo=1):
+        self.lo = lo
+        self.hi = max(lo, hi)
+        self.value = max(self.lo, min(self.hi, start))
+        self.bps = None
+        self.trace = []
+        self.start = time.time()
+
+    def feed(self, nbytes, nfiles, secs, errors):
+        secs = max(secs, 0.001)
+        bps = nbytes / secs
+        self.trace.append({'t': round(time.time() - self.start, 3), 'value': self.value, 'files': nfiles,
+                           'bytespersec': round(bps, 1), 'errors': errors})
+
+        if(errors):
+            self.value = max(self.lo, self.value // 2)
+        elif(self.bps is None or bps >= 0.8 * self.bps):
+            self.value = min(self.hi, self.value + 1)
+        self.bps = bps
+
+
+#################################################################################
+## Plan Files
+#################################################################################
+def prev_digest(prevfile):
+    #a plan is only valid against the exact previous file it was made with
+    import hashlib
+    h = hashlib.sha1()
+    with open(prevfile, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def same_record(a, b, hashkey=None):
+    if(a is None or b is None):
+        return a is None and b is None
+    if(a['size'] != b['size'] or a['time'] != b['time']):
+        return False
+    if(hashkey and a.get(hashkey) and b.get(hashkey)):
+        return a[hashkey] == b[hashkey]
+    return True
 
-    if(config['1stsync'] == "remote"):
-        # sync from the cloud
-        direction = RClone.Direction.local
-        if(localdirexisted):
-            get_local_list()
-            if(files):
-                print("Unable to sync from remote due to non-empty local dir")
-                sys.exit(1)
 
-    elif(config['1stsync'] == "local"):
-        get_remote_list()
-        direction = RClone.Direction.remote
-        if(files):
-            print("Unable to sync to remote due to non-empty cloud")
-            sys.exit(1)
+#################################################################################
+## Remote lease
+#################################################################################
+class RemoteLease():
+    #a lock file on the remote. few backends can do a compare-and-swap so a
+    #lease is written then read back after a settle delay to see whose write
+    #won. it expires ttl secs after it was last renewed, a heartbeat thread
+    #renews it while held so a crashed run only blocks others until then
+    def __init__(self, backend, name, ttl=LOCK['ttl'], settle=LOCK['settle']):
+        import uuid
+        import socket
+        self.backend = backend
+        self.file = LOCKFILE % name
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl
+        self.settle = settle
+        self.held = False
+        self.lost = None         #owner that took the lease from us
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read(self):
+        data = self.backend.readfile(self.file)
+        if(not data):
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            #half written or garbage, nobody holds it
+            return None
+
+    def write(self):
+        j = {'owner': self.owner, 'expires': time.time() + self.ttl}
+        self.backend.writefile(self.file, json.dumps(j).encode('utf-8'))
+
+    def acquire(self, wait=0):
+        #waits up to wait secs for whoever has it, SyncError if they still do
+        deadline = time.time() + wait
+        while(True):
+            cur = self.read()
+            if(cur and cur['owner'] != self.owner and cur['expires'] > time.time()):
+                if(time.time() >= deadline):
+                    raise SyncError("The remote is locked by '%s' for up to %ds more, try again later" %
+                                    (cur['owner'], cur['expires'] - time.time()))
+                time.sleep(max(0.01, min(self.settle, deadline - time.time())))
+                continue
 
-    rclone.sync(direction)
+            self.write()
+            #anyone who wrote at the same time has written by now
+            time.sleep(self.settle)
+            cur = self.read()
+            if(cur and cur['owner'] == self.owner):
+                break
+
+        self.held = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while(not self._stop.wait(self.ttl / 3)):
+            try:
+                cur = self.read()
+                if(cur and cur['owner'] != self.owner):
+                    self.lost = cur['owner']
+                    print("Lost the lock on the remote to '%s'" % self.lost)
+                    return
+                self.write()
+            except subprocess.CalledProcessError as e:
+                #try again on the next beat, the lease is good until it expires
+                print("Failed to renew the lock on the remote: %s" % errmsg(e))
+
+    def release(self):
+        if(not self.held):
+            return
+        self._stop.set()
+        self._thread.join()
+        self.held = False
+        if(self.lost is None):
+            cur = self.read()
+            if(cur and cur['owner'] == self.owner):
+                self.backend.deletefile(self.file)
 
 
 #################################################################################
-## RunSync
+## SyncEngine
 #################################################################################
-def RunSync():
-    get_previous_list()
-    get_local_list()
-    get_remote_list()
+class SyncEngine():
+    #one bi-directional sync between a local dir and a remote. everything a
+    #run needs lives on the instance so several engines can run side by side
+    #in threads (or asyncio tasks through asyncio.to_thread). nothing in here
+    #prompts or exits, anything that stops a sync is raised as a SyncError
+    def __init__(self, config, backend=None, metrics=None, shared=None):
+        #config needs 'local', 'remote' and 'prevfile', see ENGINEDEFAULTS for
+        #the rest. backend replaces the RClone.rclone connect() would make,
+        #shared hands out a local listing/fingerprint made once for several
+        #engines (see FanoutLink)
+        self.config = dict(ENGINEDEFAULTS, **config)
+        self.config['transfer'] = dict(TRANSFER, **self.config['transfer'])
+        self.config['ratelimit'] = dict(RATELIMIT, **self.config['ratelimit'])
+        self.config['lock'] = dict(LOCK, **self.config['lock'])
+        self.config['audit'] = dict(AUDIT, **self.config['audit'])
+        if('features' not in config):
+            self.config['features'] = {}
+        self.metrics = metrics or RClone.Metrics()
+        self.rclone = backend
+        self.shared = shared
+
+        self.files = {}
+        self.pending = set()     #changes not applied, they keep their old 'previous' record
+        self.changes = None      #the changes planned from full listings, see save()
+        self.dirs = {}           #and the dirs of them done in one op
+        self.noop = False
+        self.prevfingerprint = None
+        self.prevtree = None
+        self.runfingerprint = None
+        self.prefix = sync_prefix(self.config['path'])
+        self.outside = {}        #previous rows outside of prefix, written back as is
+        self.lease = None
+        self.auditstate = {}     #where the rolling audit is at, see audit()
+        self.auditbad = set()
+        self.remoteids = {}      #remote object ID -> name
+
+    def connect(self):
+        #sets up the backend and works out what the two sides have in common
+        if(self.rclone):
+            return self.rclone
+
+        c = self.config
+        rl = c['ratelimit']
+        RClone.scheduler.setrate(RClone.remotename(c['remote']), rl['tps'], rl['burst'])
+
+        self.rclone = RClone.rclone(c['local'], c['remote'], c['gdocs'], c['dryrun'], self.filterfile(),
+                                    featurecache=c['features'], mx=self.metrics)
+        c['hashtype'] = self.rclone.negotiate_hash()
+        print("Comparing file contents using hash type: %s" % c['hashtype'])
+
+        #times closer than the coarsest modtime precision of the two sides are equal
+        lp = self.rclone.precision(RClone.Direction.local)
+        rp = self.rclone.precision(RClone.Direction.remote)
+        if(c['timewindow'] is not None):
+            c['window'] = (c['timewindow'], c['timewindow'])
+        else:
+            c['window'] = (lp or 0, rp or 0)
+        c['settime'] = rp is not None and lp is not None
+        print("Modtimes compared within %gs locally and %gs on the remote" % c['window'])
+
+        strategy = self.rclone.pick_liststrategy(c['liststrategy'])
+        print("Listing the remote with strategy: %s" % strategy)
+        if(self.prefix):
+            print("Only syncing '%s'" % self.prefix)
+
+        return self.rclone
+
+    def filterfile(self):
+        #the lease's lock files are never synced, whoever wrote the filter file
+        #(if there is one) the rule is made sure of here
+        c = self.config
+        if(not c['lock']['enabled']):
+            return c['filterfile']
+        rules = ReadFilterRules(c['filterfile'])
+        if(rules[:1] == [LOCKRULE]):
+            return c['filterfile']
+        return WriteFilterFile(c['prevfile'], [LOCKRULE] + rules)
+
+    def hashkey(self):
+        return RClone.hashkey(self.config['hashtype'])
+
+    def treekey(self):
+        #the dir digests leave the hashes out when the listings don't have them
+        return None if self.config['audit']['fast'] else self.hashkey()
+
+    @contextlib.contextmanager
+    def listhash(self):
+        #a fast run lists without hashes, the names looked up directly (verify,
+        #audit) still get them
+        org = self.rclone.hashtype
+        if(self.config['audit']['fast']):
+            self.rclone.hashtype = None
+        try:
+            yield self.rclone.hashtype
+        finally:
+            self.rclone.hashtype = org
+
+    @contextlib.contextmanager
+    def locked(self):
+        #holds the remote's lease (if the profile uses one) from listing to
+        #saving. a dry run changes nothing so it doesn't need it
+        lc = self.config['lock']
+        if(not lc['enabled'] or self.config['dryrun']):
+            yield
+            return
+
+        self.connect()
+        self.lease = RemoteLease(self.rclone, lc['name'] or NAME, lc['ttl'], lc['settle'])
+        with self.metrics.phase("lock"):
+            self.lease.acquire(lc['wait'])
+        try:
+            yield
+        finally:
+            self.lease.release()
+
+    ##########################################################################
+    ## Listings
+    ##########################################################################
+    def list_remote(self, path=None):
+        #path re-lists just that dir
+        with self.metrics.phase("list_remote"), self.listhash():
+            rlist = self.rclone.lsjson(RClone.Direction.remote, includegdocs=True, path=path or self.prefix[:-1] or None)
+        if(not path):
+            self.check_prefix(rlist, RClone.Direction.remote)
+        self.add_remote(rlist)
+
+    def check_prefix(self, lst, direction):
+        #listing a file instead of a dir gives just that file under its own
+        #name, ie 'a/f.txt/f.txt', which mustn't end up in the previous state
+        if(not self.prefix):
+            return
+        path = self.prefix[:-1]
+        if(list(lst) == [self.prefix + path.rsplit("/", 1)[-1]] and self.rclone.isfile(direction, path)):
+            raise SyncError("--path '%s' is a file on the %s side, it has to be a dir" % (path, direction.name))
+
+    def add_remote(self, rlist):
+        for name in rlist:
+            r = rlist[name]
+            if(name not in self.files):
+                self.files[name] = {}
+            if(r.get('dups')):
+                #stick with the file the last sync was of
+                rid = self.files[name].get('previous', {}).get('rid')
+                r = RClone.pick_dup([r] + r['dups'], rid)
+            self.files[name]['remote'] = r
+            for d in [r] + r.get('dups', []):
+                if(d.get('id')):
+                    self.remoteids[d['id']] = name
+
+    def list_local(self):
+        with self.metrics.phase("list_local"), self.listhash() as ht:
+            if(self.shared):
+                llist = self.shared.list(ht, self.prefix[:-1] or None)
+            else:
+                llist = self.rclone.lsjson(RClone.Direction.local, path=self.prefix[:-1] or None)
+        self.check_prefix(llist, RClone.Direction.local)
+
+        for name in llist:
+            if(name not in self.files):
+                self.files[name] = {}
+            self.files[name]['local'] = llist[name]
+
+    def list(self):
+        self.connect()
+        self.list_local()
+        self.list_remote()
+        return self.files
+
+    def load_previous(self):
+        prevfile = self.config['prevfile']
+        try:
+            with open(prevfile, "r") as f:
+                plist = json.load(f)
+        except FileNotFoundError:
+            raise SyncError("Missing previous file (%s), you will have to re-run the initial sync!" % prevfile)
+        except json.JSONDecodeError:
+            raise SyncError("Previous file (%s) is corrupt!" % prevfile)
+
+        if(plist.get('version') != VersionAsInt()):
+            raise SyncError("Previous file is of an old unsupported version!")
+
+        #hashes from the previous run are only comparable if the same
+        #algorithm was negotiated this time around
+        prevkey = RClone.hashkey(plist.get('hashtype', "md5"))
+        hk = self.hashkey()
+        if(prevkey != hk):
+            if(self.prefix):
+                raise SyncError("Hash type changed since the last sync, a full sync is needed 1st")
+            print("Hash type changed (%s -> %s), previous hashes are ignored" % (plist.get('hashtype', "md5"), self.config['hashtype']))
+
+        self.prevfingerprint = plist.get('fingerprint')
+        self.prevtree = plist.get('tree') if prevkey == hk else None
+        self.auditstate = plist.get('audit') or {}
+        try:
+            #the status file has it as of the last run, no-op or not
+            with open(status_path(prevfile), "r") as f:
+                self.auditstate = json.load(f).get('audit') or self.auditstate
+        except (OSError, ValueError):
+            pass
+
+        try:
+            f = plist['files']
+            names = f
+            if(self.prefix):
+                #only the rows under the prefix are looked at, the rest go
+                #back into the previous file untouched
+                names = prefix_names(sorted(f), self.prefix)
+                self.outside = dict(f)
+                for name in names:
+                    del(self.outside[name])
+            for name in names:
+                p = {}
+                p['size'] = int(f[name]['previous']['size'])
+                p['time'] = RClone.parsetime(f[name]['previous']['time'])
+                p['rtime'] = RClone.parsetime(f[name]['previous']['rtime'])
+                if(hk and prevkey == hk):
+                    p[hk] = f[name]['previous'][hk]
+                if(f[name]['previous'].get('rid')):
+                    p['rid'] = f[name]['previous']['rid']
+                self.files[name] = {'previous': p}
+        except KeyError:
+            raise SyncError("Previous file (%s) is missing a key! (%s)" % (prevfile, name))
+
+    ##########################################################################
+    ## Quick no-op check
+    ##########################################################################
+    def fingerprint(self):
+        #the local walk and remote query are done before any listing so a change
+        #that races the listing shows up as a mismatch on the next run
+        fp = {}
+        fp['local'] = self.shared.fingerprint() if self.shared else self.rclone.local_fingerprint()
+        fp['remote'] = self.rclone.remote_fingerprint()
+        fp['time'] = time.time()
+
+        return fp
+
+    def quick_check(self):
+        prev = self.prevfingerprint
+        if(self.config['full'] or not prev):
+            return False
+        if(self.prefix):
+            #the fingerprints cover the whole tree, nothing to go by and the
+            #subtree is listed anyway. what was saved stays valid if nothing in
+            #it changes, see write_previous()
+            self.runfingerprint = prev
+            return False
+
+        #bound how long we trust the fingerprints, ie the remote 'about' totals
+        #can't see a same size in place edit
+        if(time.time() - prev['time'] > self.config['noopmaxage'] * 3600):
+            return False
+
+        fp = self.fingerprint()
+        self.runfingerprint = fp
+        return (fp['local'] == prev['local'] and fp['remote'] == prev['remote'])
+
+    ##########################################################################
+    ## Duplicate names
+    ##########################################################################
+    def duplicates(self):
+        #names the remote has several files under. with 'skip' one of them
+        #(the same one every run, see add_remote) is synced and the rest are
+        #left alone, otherwise the dirs they're in are deduped and re-listed
+        mode = self.config['dupnames']
+        dups = sorted(name for name in self.files if self.files[name].get('remote', {}).get('dups'))
+        self.metrics.extra['dupnames'] = len(dups)
+        if(not dups):
+            return
+
+        for name in dups:
+            r = self.files[name]['remote']
+            print("File: '%s' is on the remote %d times, syncing the one with ID %s" % (name, len(r['dups']) + 1, r.get('id')))
+        if(mode == "skip" or self.config['dryrun']):
+            return
+
+        #dedupe goes through the sub dirs too
+        dirs = {name.rpartition('/')[0] for name in dups}
+        if('' in dirs):
+            dirs = {''}
+        dirs = sorted(d for d in dirs if not any(d.startswith(p + "/") for p in dirs))
+
+        ids = {}
+        for name in dups:
+            r = self.files[name]['remote']
+            for rec in [r] + r['dups']:
+                if(rec.get('id')):
+                    ids[rec['id']] = name
+
+        for d in dirs:
+            try:
+                self.rclone.dedupe(d, mode)
+            except subprocess.CalledProcessError as e:
+                print("Failed to dedupe '%s': %s" % (d, errmsg(e)))
+                continue
+
+            prefix = d + "/" if d else ""
+            for name in list(self.files):
+                if(name.startswith(prefix)):
+                    self.files[name].pop('remote', None)
+                    if(not self.files[name]):
+                        del(self.files[name])
+            self.remoteids = {rid: name for (rid, name) in self.remoteids.items() if not name.startswith(prefix)}
+            self.list_remote(d)
+
+        for (rid, name) in sorted(ids.items(), key=lambda x: x[1]):
+            if(self.remoteids.get(rid) != name):
+                print("File: '%s' (ID %s) is %s after the dedupe" % (name, rid, "now '%s'" % self.remoteids[rid] if rid in self.remoteids else "gone"))
+
+    ##########################################################################
+    ## Rolling audit
+    ##########################################################################
+    def audit(self):
+        #hashes the next slice of the files on both sides and compares them to
+        #the hashes of the last sync, a mismatch (same size + modtime, different
+        #contents) shows up as a change in diff(). the names are gone through
+        #in order from where the last run stopped, wrapping around at the end.
+        #a no-op run goes by the previous state alone. returns True if any
+        #file didn't match
+        a = self.config['audit']
+        hk = self.hashkey()
+        if(not a['fast'] or not hk or self.prefix):
+            return False
+
+        f = self.files
+        names = sorted(name for name in f if('previous' in f[name] and
+                                             (self.noop or ('local' in f[name] and 'remote' in f[name] and
+                                                            not f[name]['remote'].get('gdoc')))))
+        if(not names):
+            return False
+
+        st = self.auditstate
+        if(not st):
+            st.update({'cycle': 1, 'cyclestart': time.time(), 'cursor': None, 'audited': 0})
+        start = bisect.bisect_right(names, st['cursor']) if st['cursor'] else 0
+        pick = (names[start:] + names[:start])[:math.ceil(len(names) * a['fraction'])]
+        npicked = len(pick)
+
+        with self.metrics.phase("audit"):
+            llist = self.rclone.lsjson(RClone.Direction.local, names=pick)
+            rlist = self.rclone.lsjson(RClone.Direction.remote, includegdocs=True, names=pick)
+
+        for name in pick:
+            prev = f[name]['previous'].get(hk)
+            for (which, l) in (('local', llist), ('remote', rlist)):
+                h = (l.get(name) or {}).get(hk)
+                if(h and which in f[name]):
+                    f[name][which][hk] = h
+                if(h and prev and h != prev):
+                    print("File: '%s' doesn't match its %s hash from the last sync on %s" % (name, self.config['hashtype'], which))
+                    self.auditbad.add(name)
+
+        if(start + len(pick) >= len(names)):
+            #went past the end, everything has been checked once this cycle
+            print("Audit cycle %d done in %.1f day(s)" % (st['cycle'], (time.time() - st['cyclestart']) / 86400))
+            st.update({'cycle': st['cycle'] + 1, 'cyclestart': time.time(), 'audited': 0})
+            pick = pick[len(names) - start:]
+        st['cursor'] = pick[-1] if pick else None
+        st['audited'] += len(pick)
+        st['files'] = len(names)
+        st['coverage'] = min(1.0, st['audited'] / len(names))
+
+        print("Audited %d file(s) by hash, %.1f%% of the tree checked this cycle" % (npicked, 100 * st['coverage']))
+        self.metrics.extra['audited'] = npicked
+        self.metrics.extra['auditmismatches'] = len(self.auditbad)
+        return bool(self.auditbad)
+
+    ##########################################################################
+    ## Plan
+    ##########################################################################
+    def diff(self):
+        #changes between the listings and the previous state, returns
+        #(changes, dirs), dirs are collapse_dirs() results
+        c = self.config
+        hk = self.hashkey()
+        tk = self.treekey()
+        with self.metrics.phase("diff"):
+            prevtree = self.prevtree if (self.prevtree or {}).get('key', hk) == tk else None
+            skip = unchanged_dirs(prevtree, get_tree(self.files, 'local', tk), get_tree(self.files, 'remote', tk))
+            for name in self.auditbad:
+                #the digests can't see these
+                d = name
+                while(d):
+                    d = d.rpartition('/')[0]
+                    skip.discard(d)
+            changed_files = calc_diffs(self.files, hk, skip, c['window'], c['settime'])
+            sides = [RClone.Direction.local] + ([RClone.Direction.remote] if self.rclone.servercopy() else [])
+            self.metrics.extra['dupcopies'] = find_dups(changed_files, self.files, hk, sides,
+                                                        RClone.parsesize(c['transfer']['smallsize']))
+            dirs = collapse_dirs(changed_files, self.files, top=self.prefix)
+            #a dir the filter rules can't be rewritten for is done file by file
+            dirs = {d: dirs[d] for d in dirs if self.rclone.subtree_filter(d) is not None}
+
+        #files holds the full listings now, save() only has to verify these
+        self.changes = changed_files
+        self.dirs = dirs
+        return (changed_files, dirs)
+
+    def plan(self):
+        #lists both sides and works out the changes, returns (changes, dirs)
+        #or None when the quick check found nothing changed since the last sync
+        self.connect()
+        with self.metrics.phase("previous"):
+            self.load_previous()
+
+        with self.metrics.phase("quickcheck"):
+            noop = self.quick_check()
+        if(noop):
+            #an idle tree is still audited, the fingerprints can't see a same
+            #size + modtime edit. a mismatch means a full run after all, the
+            #slice is checked again against the listings then
+            self.noop = True
+            auditstate = dict(self.auditstate)
+            if(not self.audit()):
+                print("Nothing changed since the last sync")
+                self.metrics.extra['noop'] = True
+                return None
+            print("The audit found changes the quick check can't see, listing both sides")
+            self.noop = False
+            self.auditstate = auditstate
+            self.auditbad = set()
+
+        #the fingerprints are taken before listing, same as in save()
+        if(not self.runfingerprint):
+            self.runfingerprint = self.fingerprint()
+
+        self.list_local()
+        self.list_remote()
+        self.duplicates()
+        self.audit()
+        return self.diff()
+
+    def write_plan(self, planfile, changed_files, dirs):
+        j = {}
+        j['version'] = VersionAsInt()
+        j['local'] = self.config['local']
+        j['remote'] = self.config['remote']
+        j['hashtype'] = self.config['hashtype']
+        j['path'] = self.prefix
+        j['previous'] = prev_digest(self.config['prevfile'])
+        j['fingerprint'] = self.runfingerprint
+        j['changes'] = {}
+
+        for name in changed_files:
+            c = changed_files[name]
+            j['changes'][name] = {'action': c['action'].name, 'direction': c['direction'].name}
+            if('source' in c):
+                j['changes'][name]['source'] = c['source']
+            for which in ('previous', 'local', 'remote'):
+                j['changes'][name][which] = self.files[name].get(which)
+
+        j['dirs'] = {}
+        for d in dirs:
+            j['dirs'][d] = {'action': dirs[d]['action'].name, 'direction': dirs[d]['direction'].name, 'names': dirs[d]['names']}
+
+        with open(planfile, "w") as f:
+            json.dump(j, f, indent=4, separators=(',', ': '))
+
+        print("Wrote plan with %d change(s) to '%s'" % (len(changed_files), planfile))
+
+    def read_plan(self, planfile):
+        try:
+            with open(planfile, "r") as f:
+                j = json.load(f)
+        except FileNotFoundError:
+            raise SyncError("Plan file (%s) is missing!" % planfile)
+        except json.JSONDecodeError:
+            raise SyncError("Plan file (%s) is corrupt!" % planfile)
+
+        if(j['version'] != VersionAsInt()):
+            raise SyncError("Plan file is of an old unsupported version!")
+        if(j['local'] != self.config['local'] or j['remote'] != self.config['remote'] or j['hashtype'] != self.config['hashtype']):
+            raise SyncError("Plan file (%s) was made for a different local/remote/hash type!" % planfile)
+        if(j['path'] != self.prefix):
+            raise SyncError("Plan file (%s) was made for a different --path!" % planfile)
+        if(j['previous'] != prev_digest(self.config['prevfile'])):
+            raise SyncError("The previous file changed since the plan was made (another sync ran?), please re-plan")
+
+        return j
+
+    def stale_changes(self, plan, fingerprint):
+        #files that changed since the plan was made. an unchanged local fingerprint
+        #means the local side wasn't touched, the remote's can miss an edit that
+        #kept the size so its files are always looked up (in one call)
+        stale = set()
+        names = list(plan['changes'])
+        pfp = plan['fingerprint'] or {}
+
+        if(fingerprint['local'] != pfp.get('local')):
+            for name in names:
+                cur = self.rclone.localrecord(name)
+                if(not same_record(plan['changes'][name]['local'], cur)):
+                    stale.add(name)
+
+        if(names):
+            cur = self.rclone.lsjson(RClone.Direction.remote, includegdocs=True, names=names)
+            for name in names:
+                if(not same_record(plan['changes'][name]['remote'], cur.get(name), self.hashkey())):
+                    stale.add(name)
+
+        return stale
+
+    def load_plan(self, planfile):
+        #the changes saved with write_plan() that are still valid, returns
+        #(changes, dirs) same as plan()
+        self.connect()
+        with self.metrics.phase("previous"):
+            self.load_previous()
+
+        plan = self.read_plan(planfile)
+        fingerprint = self.fingerprint()
+
+        with self.metrics.phase("staleness"):
+            stale = self.stale_changes(plan, fingerprint)
+
+        changed_files = {}
+        for name in plan['changes']:
+            p = plan['changes'][name]
+            self.files[name] = {which: p[which] for which in ('previous', 'local', 'remote') if p[which] is not None}
+            if(name in stale):
+                print("File: '%s' changed since the plan was made, skipping it" % name)
+                continue
+            changed_files[name] = {'action': RClone.Action[p['action']], 'direction': RClone.Direction[p['direction']]}
+            if('source' in p):
+                changed_files[name]['source'] = p['source']
+
+        #a dir op is only safe if none of its files went stale, the filter rules
+        #can still be rewritten for it and, for a purge, nothing new can have
+        #shown up in it (that side's fingerprint is unchanged)
+        dirs = {}
+        for d in plan['dirs']:
+            p = plan['dirs'][d]
+            action = RClone.Action[p['action']]
+            direction = RClone.Direction[p['direction']]
+            if(stale.intersection(p['names']) or self.rclone.subtree_filter(d) is None):
+                continue
+            if(action == RClone.Action.purge and fingerprint[direction.name] != (plan['fingerprint'] or {}).get(direction.name)):
+                continue
+            dirs[d] = {'action': action, 'direction': direction, 'dir': d, 'names': p['names']}
+
+        print("Applying %d of %d planned change(s)" % (len(changed_files), len(plan['changes'])))
+        self.pending = stale
+        return (changed_files, dirs)
+
+    ##########################################################################
+    ## Apply
+    ##########################################################################
+    def apply_one(self, name, c, args=()):
+        try:
+            if(c['action'] == RClone.Action.copyto):
+                self.rclone.copyto(name, c['direction'], args)
+            elif(c['action'] == RClone.Action.deletefrom):
+                self.rclone.delete(name, c['direction'])
+            elif(c['action'] == RClone.Action.settime):
+                src = 'local' if c['direction'] == RClone.Direction.remote else 'remote'
+                self.rclone.settime(name, c['direction'], self.files[name][src]['time'])
+            elif(c['action'] == RClone.Action.dupcopy):
+                self.rclone.dupcopy(c['source'], name, c['direction'])
+                if(self.config['settime']):
+                    #the copy has the modtime of the file it was made from
+                    src = 'local' if c['direction'] == RClone.Direction.remote else 'remote'
+                    self.rclone.settime(name, c['direction'], self.files[name][src]['time'])
+        except subprocess.CalledProcessError as e:
+            if(e.returncode == RClone.DURATIONEXCEEDED):
+                return CUTOFF
+            print("Failed to apply '%s': %s" % (name, errmsg(e)))
+            return errmsg(e)
+
+        return None
+
+    def dir_changed(self, d, direction):
+        #a purge takes whatever is in the dir when it runs, which can be long
+        #after the listing (ie the prompt). names in the dir that are new or
+        #changed since then, a new file is never deleted without being seen
+        side = 'local' if direction == RClone.Direction.local else 'remote'
+        now = self.rclone.lsjson(direction, path=d['dir'])
+        late = [name for name in now if name not in self.files or side not in self.files[name] or
+                not same_record(now[name], self.files[name][side])]
+        return late
+
+    def unfinished(self, names, direction):
+        #which of the names a transfer stopped by --max-duration didn't copy,
+        #the target is listed as rclone may have got through some of them
+        src = 'local' if direction == RClone.Direction.remote else 'remote'
+        try:
+            got = self.rclone.lsjson(direction, names=names)
+        except subprocess.CalledProcessError:
+            return list(names)
+        return [name for name in names if name not in got or got[name]['size'] != self.files[name][src]['size']]
+
+    def apply_changes(self, changed_files, dirs=None):
+        #returns ({name: error}, deferred names), a failure never stops the rest
+        #of the changes from being applied, whatever doesn't fit in the time
+        #budget is deferred. dirs are collapse_dirs() results, their files are
+        #done with one op per dir
+        dirs = dirs or {}
+        f = self.files
+        tconf = self.config['transfer']
+        budget = self.config['timebudget']
+        order = self.config['order']
+        start = time.time()
+        args = {}
+        retry = {}
+        deferred = set()
+        spared = set()   #changed since listing, see dir_changed()
+
+        args['large'] = tconf['largeargs'] + self.rclone.chunkargs(tconf['chunksize'])
+        smallargs = list(tconf['smallargs'])
+        if(order in ("smallest", "largest")):
+            #keep the order within a batch too
+            smallargs += ["--order-by", "size," + ("ascending" if order == "smallest" else "descending")]
+
+        ctls = {}
+        if(tconf['adaptive']):
+            ctls['small'] = AIMD(int(flag_value(smallargs, "--transfers", 4)), tconf['maxtransfers'])
+            ctls['medium'] = AIMD(tconf['workers'], tconf['maxworkers'])
+        overbudget = lambda: budget and time.time() - start > budget
+        #rclone stops starting new transfers itself once the budget is used up
+        limit = lambda: ["--max-duration", "%ds" % max(1, int(start + budget - time.time())), "--cutoff-mode", "soft"] if budget else []
+
+        names = order_changes(changed_files, f, order, self.config['priority'], dirs)
+        units = plan_units(names, changed_files, f, tconf, dirs)
+
+        stats = {sc: {'files': 0, 'bytes': 0, 'secs': 0.0} for sc in SIZECLASSES + ("dir",)}
+        for (i, (sc, direction, names)) in enumerate(units):
+            if((self.lease and self.lease.lost) or overbudget()):
+                for u in units[i:]:
+                    deferred.update(dirs[u[2][0]]['names'] if u[0] == "dir" else u[2])
+                break
+
+            ustart = time.time()
+            failed = {}
+
+            if(sc == "dir"):
+                d = dirs[names[0]]
+                names = d['names']
+                try:
+                    if(d['action'] == RClone.Action.copydir):
+                        self.rclone.copydir(d['dir'], direction, tconf['smallargs'] + limit())
+                    else:
+                        late = self.dir_changed(d, direction)
+                        if(not late):
+                            self.rclone.purge(d['dir'], direction)
+                        else:
+                            #the files that are still as listed are deleted one
+                            #by one, the rest is left for the next run to look at
+                            changed = [name for name in names if name in late]
+                            print("Dir '%s' changed since it was listed, deleting its files one by one, %d left for the next run" %
+                                  (d['dir'], len(changed)))
+                            spared.update(changed)
+                            names = [name for name in names if name not in late]
+                            for name in names:
+                                err = self.apply_one(name, changed_files[name])
+                                if(err):
+                                    failed[name] = err
+                except subprocess.CalledProcessError as e:
+                    if(e.returncode == RClone.DURATIONEXCEEDED):
+                        failed = dict.fromkeys(names, CUTOFF)
+                    else:
+                        #fall back to the per file changes
+                        print("Failed to apply dir '%s': %s" % (d['dir'], errmsg(e)))
+                        failed = {name: errmsg(e) for name in names}
+            elif(sc in ctls):
+                if(sc == "small"):
+                    (failed, notstarted) = self.copy_waves(names, changed_files, ctls[sc], smallargs, overbudget, limit)
+                else:
+                    (failed, notstarted) = self.copy_pool(names, changed_files, ctls[sc], overbudget, limit)
+                deferred.update(notstarted)
+                names = [name for name in names if name not in deferred]
+            elif(sc == "small"):
+                try:
+                    self.rclone.copyfiles(names, direction, smallargs + limit())
+                except subprocess.CalledProcessError as e:
+                    if(e.returncode == RClone.DURATIONEXCEEDED):
+                        failed = dict.fromkeys(names, CUTOFF)
+                    else:
+                        #can't tell which files of the batch failed, retry them one by
+                        #one (rclone skips the ones that did make it)
+                        print("Batch copy of %d file(s) failed: %s" % (len(names), errmsg(e)))
+                        failed = {name: errmsg(e) for name in names}
+            else:
+                for name in names:
+                    err = self.apply_one(name, changed_files[name], list(args.get(sc, ())) + limit())
+                    if(err):
+                        failed[name] = err
+
+            cut = [name for name in failed if failed[name] == CUTOFF]
+            if(cut):
+                #the rest of the transfer is left for the next run, what did
+                #make it is verified by save() as usual
+                late = self.unfinished(cut, direction)
+                deferred.update(late)
+                for name in cut:
+                    del(failed[name])
+                names = [name for name in names if name not in late]
+
+            if(sc and all(changed_files[name]['action'] == RClone.Action.copyto for name in names)):
+                done = [name for name in names if name not in failed]
+                stats[sc]['files'] += len(done)
+                stats[sc]['bytes'] += sum(transfer_size(f, name, direction) for name in done)
+                stats[sc]['secs'] += time.time() - ustart
+            retry.update(failed)
+
+        if(deferred and self.lease and self.lease.lost):
+            print("Another run has the remote now, deferring %d change(s) to the next run" % len(deferred))
+        elif(deferred):
+            print("Time budget of %ds used up, deferring %d change(s) to the next run" % (budget, len(deferred)))
+        deferred.update(spared)
+
+        if(ctls):
+            self.metrics.extra['concurrency'] = {sc: {'final': ctls[sc].value, 'trace': ctls[sc].trace} for sc in ctls if ctls[sc].trace}
+
+        for sc in SIZECLASSES + ("dir",):
+            st = stats[sc]
+            if(st['files']):
+                print("Transferred %d %s file(s), %d bytes in %.1fs (%.1f KiB/s)" %
+                      (st['files'], sc if sc != "dir" else "whole dir", st['bytes'], st['secs'], st['bytes'] / 1024 / max(st['secs'], 0.001)))
+
+        for attempt in range(2, self.config['maxattempts'] + 1):
+            if(not retry or (budget and time.time() - start > budget) or (self.lease and self.lease.lost)):
+                break
+
+            delay = min(30, RETRYDELAY ** (attempt - 1))
+            print("Retrying %d failed change(s) in %ds (attempt %d/%d)" % (len(retry), delay, attempt, self.config['maxattempts']))
+            time.sleep(delay)
+
+            pending, retry = retry, {}
+            for name in pending:
+                c = changed_files[name]
+                sc = size_class(transfer_size(f, name, c['direction']), tconf) if c['action'] == RClone.Action.copyto else None
+                err = self.apply_one(name, c, list(args.get(sc, ())) + limit())
+                if(err == CUTOFF):
+                    deferred.update(self.unfinished([name], c['direction']))
+                elif(err):
+                    retry[name] = err
+
+        return (retry, deferred)
+
+    def copy_waves(self, names, changed_files, ctl, smallargs, overbudget, limit=list):
+        #copies small files in waves, each one rclone copy with ctl.value
+        #transfers. returns ({name: error}, names not started as the budget ran out)
+        f = self.files
+        direction = changed_files[names[0]]['direction']
+        failed = {}
+        i = 0
+        while(i < len(names)):
+            if(i and overbudget()):
+                return (failed, names[i:])
+
+            wave = names[i:i + ctl.value * WAVEROUNDS]
+            i += len(wave)
+            ratelimited = self.metrics.counters.get('ratelimited', 0)
+            wstart = time.time()
+            werr = {}
+            try:
+                self.rclone.copyfiles(wave, direction, set_flag(smallargs, "--transfers", ctl.value) + limit())
+            except subprocess.CalledProcessError as e:
+                if(e.returncode == RClone.DURATIONEXCEEDED):
+                    werr = dict.fromkeys(wave, CUTOFF)
+                else:
+                    #same as a whole batch, retried one by one
+                    print("Batch copy of %d file(s) failed: %s" % (len(wave), errmsg(e)))
+                    werr = {name: errmsg(e) for name in wave}
+
+            nbytes = sum(transfer_size(f, name, direction) for name in wave if name not in werr)
+            #being cut off by the budget says nothing about the remote
+            errors = sum(1 for name in werr if werr[name] != CUTOFF)
+            ctl.feed(nbytes, len(wave), time.time() - wstart,
+                     errors + self.metrics.counters.get('ratelimited', 0) - ratelimited)
+            failed.update(werr)
+
+        return (failed, [])
+
+    def copy_pool(self, names, changed_files, ctl, overbudget, limit=list):
+        #copies medium files as copytos side by side, a new one is started as
+        #soon as one finishes while fewer than ctl.value are running, so a slow
+        #file only holds up its own slot. ctl is fed every ctl.value files.
+        #returns ({name: error}, names not started as the budget ran out)
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        f = self.files
+        direction = changed_files[names[0]]['direction']
+        failed = {}
+        running = {}
+        i = 0
+        w = None
+        with ThreadPoolExecutor(max_workers=ctl.hi) as pool, \
+             RClone.scheduler.share(RClone.remotename(self.config['remote']), min(ctl.hi, len(names))):
+            while(True):
+                while(i < len(names) and len(running) < ctl.value and not (i and overbudget())):
+                    running[pool.submit(self.apply_one, names[i], changed_files[names[i]], limit())] = names[i]
+                    i += 1
+                if(not running):
+                    break
+
+                if(w is None):
+                    w = {'files': 0, 'bytes': 0, 'errors': 0, 'start': time.time(),
+                         'ratelimited': self.metrics.counters.get('ratelimited', 0)}
+                (done, _) = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    err = fut.result()
+                    w['files'] += 1
+                    if(not err):
+                        w['bytes'] += transfer_size(f, name, direction)
+                    elif(err != CUTOFF):
+                        w['errors'] += 1
+                    if(err):
+                        failed[name] = err
+
+                if(w['files'] >= ctl.value or not running):
+                    ctl.feed(w['bytes'], w['files'], time.time() - w['start'],
+                             w['errors'] + self.metrics.counters.get('ratelimited', 0) - w['ratelimited'])
+                    w = None
+
+        return (failed, names[i:])
+
+    def write_failures(self, changed_files, failed):
+        #permanent failures of this run, their 'previous' record is kept as is so
+        #the next run plans them again
+        failfile = self.config['failfile']
+        if(not failfile):
+            return
+
+        if(not failed):
+            if(os.path.isfile(failfile)):
+                os.remove(failfile)
+            return
+
+        j = {}
+        for name in failed:
+            j[name] = {'action': changed_files[name]['action'].name,
+                       'direction': changed_files[name]['direction'].name,
+                       'error': failed[name]}
+
+        with open(failfile, "w") as f:
+            json.dump(j, f, indent=4, separators=(',', ': '))
+
+        print("%d change(s) failed, see '%s':" % (len(failed), failfile))
+        for name in failed:
+            print("    %s: %s" % (name, failed[name]))
+
+    def apply(self, changed_files, dirs=None):
+        #applies plan()/load_plan() results, returns ({name: error}, deferred
+        #names), anything not applied is left for the next run by save()
+        self.metrics.extra['changes'] = len(changed_files)
+        if(self.config['dryrun']):
+            return ({}, set())
+
+        with self.metrics.phase("apply"):
+            (failed, deferred) = self.apply_changes(changed_files, dirs)
+        self.write_failures(changed_files, failed)
+        self.metrics.inc('failed', len(failed))
+        self.metrics.extra['deferred'] = len(deferred)
+
+        self.pending.update(failed)
+        self.pending.update(deferred)
+        self.pending.update(name for name in changed_files if changed_files[name]['action'] == RClone.Action.conflict)
+        return (failed, deferred)
+
+    def sync(self):
+        #a whole unattended run, returns what apply() does
+        with self.locked():
+            p = self.plan()
+            result = ({}, set())
+            if(p):
+                result = self.apply(*p)
+            self.save()
+        return result
+
+    ##########################################################################
+    ## Initial sync
+    ##########################################################################
+    def initial_sync(self, source):
+        #source is the side ("local" or "remote") the other side starts out as a copy of
+        self.connect()
+        local = self.config['local']
+        localdirexisted = os.path.isdir(local)
+        if(not localdirexisted):
+            os.mkdir(local)
+
+        if(source == "remote"):
+            # sync from the cloud
+            direction = RClone.Direction.local
+            if(localdirexisted):
+                self.list_local()
+                if(self.files):
+                    raise SyncError("Unable to sync from remote due to non-empty local dir")
+        elif(source == "local"):
+            self.list_remote()
+            direction = RClone.Direction.remote
+            if(self.files):
+                raise SyncError("Unable to sync to remote due to non-empty cloud")
+        else:
+            raise ValueError("Invalid source arg")
+
+        self.rclone.sync(direction)
+
+    ##########################################################################
+    ## Save
+    ##########################################################################
+    def verify(self, changed_files):
+        #re-lists just the files this run touched on both sides and checks they
+        #now match, the new records go straight into files so the previous file
+        #can be written without listing everything again. returns the names that
+        #failed to verify
+        hk = self.hashkey()
+        touched = [name for name in changed_files if(name not in self.pending and
+                   changed_files[name]['action'] not in (RClone.Action.none, RClone.Action.conflict))]
+        if(not touched):
+            return []
+
+        #a dir done in one op is listed in one go too, the rest are looked up by name
+        llist = {}
+        rlist = {}
+        dirs = [d for d in self.dirs if not set(touched).isdisjoint(self.dirs[d]['names'])]
+        for d in dirs:
+            llist.update(self.rclone.lsjson(RClone.Direction.local, path=d))
+            rlist.update(self.rclone.lsjson(RClone.Direction.remote, includegdocs=True, path=d))
+        members = {name for d in dirs for name in self.dirs[d]['names']}
+        names = [name for name in touched if name not in members]
+        if(names):
+            llist.update(self.rclone.lsjson(RClone.Direction.local, names=names))
+            rlist.update(self.rclone.lsjson(RClone.Direction.remote, includegdocs=True, names=names))
+
+        bad = []
+        for name in touched:
+            L = llist.get(name)
+            R = rlist.get(name)
+            if(R and R.get('dups')):
+                #the same one of the duplicates as was planned with
+                R = RClone.pick_dup([R] + R['dups'], self.files[name].get('remote', {}).get('id'))
+            self.files[name].pop('local', None)
+            self.files[name].pop('remote', None)
+            if(L is None and R is None):
+                #deleted from both
+                continue
+            if(L is None or R is None or L['size'] != R['size'] or
+               (hk and L.get(hk) and R.get(hk) and L[hk] != R[hk])):
+                print("File: '%s' doesn't match on both sides after the sync" % name)
+                bad.append(name)
+                continue
+            self.files[name]['local'] = L
+            self.files[name]['remote'] = R
+
+        print("Verified %d of %d changed file(s)" % (len(touched) - len(bad), len(touched)))
+        return bad
+
+    def save(self):
+        #writes the 'previous' state for the next sync, and the run's status
+        #for --status (no-op runs too)
+        if(self.config['dryrun']):
+            return
+
+        if(not self.noop):
+            with self.metrics.phase("cleanup"):
+                self.write_previous()
+        self.write_status()
+
+    def write_status(self):
+        #a few numbers about the run, small so --status doesn't have to load
+        #the previous file (or anything else) to answer. it has the audit's
+        #cursor too so a no-op run doesn't have to rewrite the previous file
+        m = self.metrics
+        j = {}
+        j['time'] = time.time()
+        j['duration'] = j['time'] - m.start
+        j['noop'] = self.noop
+        j['path'] = self.prefix or None
+        j['files'] = len(self.files)
+        j['pending'] = len(self.pending)
+        j['failed'] = m.counters['failed']
+        j['deferred'] = m.extra.get('deferred', 0)
+        j['coverage'] = self.auditstate.get('coverage') if self.config['audit']['fast'] else None
+        j['audit'] = self.auditstate
+        j['version'] = VersionAsInt()
+
+        with open(status_path(self.config['prevfile']), "w") as f:
+            json.dump(j, f, indent=4, separators=(',', ': '))
+
+    def write_previous(self):
+        files = self.files
+        hk = self.hashkey()
+        oldrecs = {name: files[name]['previous'] for name in files if 'previous' in files[name]}
+        oldprev = {name: oldrecs[name] for name in self.pending if name in oldrecs}
+
+        if(self.changes is not None):
+            #this run has full listings from before the changes, only what
+            #changed needs checking
+            with self.metrics.phase("verify"):
+                bad = self.verify(self.changes)
+            for name in bad:
+                self.pending.add(name)
+                if('previous' in files[name]):
+                    oldprev[name] = files[name]['previous']
+
+            #the fingerprints from before listing still hold if nothing was changed
+            fingerprint = self.runfingerprint if not self.changes else None
+        else:
+            files = self.files = {}
+
+            #a subtree's listing says nothing about the rest of the tree
+            fingerprint = self.fingerprint() if not self.prefix else None
+
+            self.list_local()
+            self.list_remote()
+
+        for name in list(files): #note -- missing gdoc file names
+            if('remote' in files[name] and files[name]['remote']['gdoc']):
+                del(files[name])
+                continue
+            if(name in self.pending):
+                if(name in oldprev):
+                    files[name] = {'previous': oldprev[name]}
+                else:
+                    del(files[name])
+                continue
+            if('local' not in files[name] or 'remote' not in files[name]):
+                #showed up on one side during the sync, the next run picks it up
+                del(files[name])
+                continue
+            files[name]['previous'] = files[name]['local']
+            files[name]['previous']['rtime'] = files[name]['remote']['time']
+            if(files[name]['remote'].get('id')):
+                #which of the remote's files this is if the name is ever duplicated
+                files[name]['previous']['rid'] = files[name]['remote']['id']
+            old = oldrecs.get(name)
+            if(hk and not files[name]['previous'].get(hk) and old and old.get(hk) and same_record(old, files[name]['previous'])):
+                #listed without hashes (fast) and unchanged, keep the one we had
+                files[name]['previous'][hk] = old[hk]
+            del(files[name]['local'])
+            del(files[name]['remote'])
+        for name in oldprev:
+            if(name not in files):
+                files[name] = {'previous': oldprev[name]}
+        files.update(self.outside)
 
-    changed_files = calc_diffs(files)
+        tk = self.treekey()
+        j = {}
+        j['files'] = files
+        j['tree'] = {'local': get_tree(files, 'previous', tk), 'remote': get_tree(files, 'previous', tk, 'rtime'), 'key': tk}
+        j['hashtype'] = self.config['hashtype']
+        j['audit'] = self.auditstate
+        #anything left pending has to be looked at again next time
+        j['fingerprint'] = None if self.pending else fingerprint
+        j['version'] = VersionAsInt()
 
+        with open(self.config['prevfile'], "w") as f:
+            json.dump(j, f, indent=4, separators=(',', ': '))
+
+
+#################################################################################
+## RunSync
+#################################################################################
+def PrintChanges(files, changed_files, dirs):
     for name in changed_files:
         print("File: '%s' needs to be %s on %s" % (name, str(changed_files[name]['action']), str(changed_files[name]['direction'])))
         if(changed_files[name]['direction'] == RClone.Direction.neither):
             print("    --> %s " % str(files[name]))
+        if('source' in changed_files[name]):
+            print("    --> copied from '%s' which has the same contents" % changed_files[name]['source'])
+    for d in dirs:
+        print("Dir: '%s' (%d files) will be done as one %s on %s" % (d, len(dirs[d]['names']), str(dirs[d]['action']), str(dirs[d]['direction'])))
 
-    if(config['dryrun']):
-        return
-
-    if(not changed_files):
-        return
-
+def Confirm():
     x = input("Make the above changes? ")
     x = x.lower()
-    if(x != "yes" and x != "y"):
-        print("Quiting and not applying changes")
-        sys.exit(0)
+    return (x == "yes" or x == "y")
 
-    for name in changed_files:
-        if(changed_files[name]['action'] == RClone.Action.copyto):
-            rclone.copyto(name, changed_files[name]['direction'])
-        elif(changed_files[name]['action'] == RClone.Action.deletefrom):
-            rclone.delete(name, changed_files[name]['direction'])
+def RunSync(engine, args, confirm=Confirm):
+    with engine.locked():
+        if(args.apply_plan):
+            #the plan was reviewed when it was made, no need to ask again
+            (changed_files, dirs) = engine.load_plan(args.apply_plan)
+        else:
+            p = engine.plan()
+            if(p is None):
+                if(args.plan_out):
+                    engine.write_plan(args.plan_out, {}, {})
+                return
+
+            (changed_files, dirs) = p
+            PrintChanges(engine.files, changed_files, dirs)
+
+            if(args.plan_out):
+                engine.write_plan(args.plan_out, changed_files, dirs)
+                return
+
+            if(changed_files and not args.dry_run and not confirm()):
+                print("Quiting and not applying changes")
+                return
+
+        if(changed_files):
+            engine.apply(changed_files, dirs)
+        engine.save()
+
+
+#################################################################################
+## Fan-out
+#################################################################################
+class FanoutLink():
+    #a worker's end of the pipe to the parent, which does the local listing
+    #and the prompt once for all the remotes. the worker's output is held
+    #until the prompt so each remote's changes are printed together
+    def __init__(self, conn):
+        import io
+        self.conn = conn
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def request(self, *msg):
+        self.conn.send(msg)
+        return self.conn.recv()
+
+    def list(self, hashtype, path=None):
+        return self.request('list', hashtype, path)
+
+    def fingerprint(self):
+        return self.request('fingerprint')
+
+    def release(self):
+        if(sys.stdout is self.stdout):
+            return ""
+        out = sys.stdout.getvalue()
+        sys.stdout = self.stdout
+        return out
+
+    def confirm(self):
+        return self.request('confirm', self.release())
+
+    def done(self):
+        self.conn.send(('done', self.release()))
+        self.conn.close()
+
+def fanout_targets(profile):
+    return [{'remote': profile['remote'], 'prevfile': profile['prevfile']}] + profile['fanout']
+
+def fanout_path(path, i):
+    #metrics file for the i'th remote, ie sync.prom -> sync.1.prom
+    root, ext = os.path.splitext(path)
+    return "%s.%d%s" % (root, i, ext)
+
+def FanoutWorker(i, args, profile, filterfile, conn):
+    link = FanoutLink(conn)
+    try:
+        print("==== %s ====" % fanout_targets(profile)[i]['remote'])
+        engine = SyncEngine(EngineConfig(args, profile, filterfile, i), shared=link)
+        SetupMetrics(engine, args, profile, i)
+        try:
+            RunSync(engine, args, link.confirm)
+        finally:
+            engine.metrics.write()
+    except SyncError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        link.done()
+
+def RunFanout(engine, args, profile, filterfile):
+    #one worker process per remote, each with its own engine and previous
+    #state. the local tree is listed (and hashed) here once per hash type
+    #and shared
+    import multiprocessing
+    from multiprocessing.connection import wait
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+    for i in range(len(fanout_targets(profile))):
+        (conn, child) = ctx.Pipe()
+        proc = ctx.Process(target=FanoutWorker, args=(i, args, profile, filterfile, child))
+        proc.start()
+        child.close()
+        workers.append({'conn': conn, 'proc': proc, 'state': "running", 'output': ""})
+
+    locallists = {}
+    localfp = None
+    while(any(w['state'] != "done" for w in workers)):
+        running = [w for w in workers if w['state'] == "running"]
+        if(not running):
+            #everyone has their changes worked out, show them all and ask once
+            ShowFanoutOutput(workers)
+            ok = Confirm()
+            for w in workers:
+                if(w['state'] == "waiting"):
+                    w['conn'].send(ok)
+                    w['state'] = "running"
+            continue
+
+        for conn in wait([w['conn'] for w in running]):
+            w = next(w for w in running if w['conn'] is conn)
+            try:
+                msg = conn.recv()
+            except EOFError:
+                w['state'] = "done"
+                continue
+
+            if(msg[0] == 'list'):
+                if(msg[1:] not in locallists):
+                    engine.rclone.hashtype = msg[1]
+                    with engine.metrics.phase("list_local"):
+                        locallists[msg[1:]] = engine.rclone.lsjson(RClone.Direction.local, path=msg[2])
+                conn.send(locallists[msg[1:]])
+            elif(msg[0] == 'fingerprint'):
+                if(localfp is None):
+                    localfp = engine.rclone.local_fingerprint()
+                conn.send(localfp)
+            elif(msg[0] == 'confirm'):
+                w['output'] += msg[1]
+                w['state'] = "waiting"
+            else:
+                w['output'] += msg[1]
+                w['state'] = "done"
+
+    ShowFanoutOutput(workers)
+    rc = 0
+    for w in workers:
+        w['proc'].join()
+        rc = max(rc, w['proc'].exitcode)
+    return rc
+
+def ShowFanoutOutput(workers):
+    for w in workers:
+        sys.stdout.write(w['output'])
+        w['output'] = ""
+    sys.stdout.flush()
+
+def RunFanout1stSync(args, profile, filterfile):
+    #the other remotes start out as copies of the now synced local dir
+    for i in range(1, len(fanout_targets(profile))):
+        print("==== %s ====" % fanout_targets(profile)[i]['remote'])
+        engine = SyncEngine(EngineConfig(args, profile, filterfile, i))
+        engine.initial_sync("local")
+        engine.save()
 
 
 #################################################################################
 ## ParseArgs
 #################################################################################
+def ConfFile(profile):
+    from xdg.BaseDirectory import xdg_config_home
+    return "/".join([xdg_config_home, NAME, profile])
+
 def ParseArgs():
+    import argparse
     initmsg = "required and only allowed on initial sync"
-    
+
     desc = "This program utilizes rclone to preform a bi-directional sync."
     parser = argparse.ArgumentParser(description=desc, allow_abbrev=False)
 
@@ -304,12 +1981,29 @@ def ParseArgs():
     group.add_argument('-P', '--profile', help="Name of the profile to be loaded to sync")
     group.add_argument(      '--configfile', help="load this config file instead of one specified by profile")
 
+    parser.add_argument(      '--status', action='store_true', help="Show how the last sync went and exit")
     parser.add_argument(      '--dry-run', action='store_true', help="Will not preform any actions (passes --dry-run to rclone)")
+    parser.add_argument(      '--full', action='store_true', help="Skip the quick no-op check and always list both sides")
+    parser.add_argument(      '--order', choices=ORDERS, help="Order the changes are applied in, listing order by default")
+    parser.add_argument(      '--time-budget', type=int, metavar='SECS', help="Stop starting new transfers after SECS seconds, the rest is done on the next run")
+    parser.add_argument(      '--fast', action='store_true', help="Compare size + modtime only, with a rolling audit of part of the files by hash each run")
+    parser.add_argument(      '--path', metavar='DIR', help="Only sync the files under DIR (relative to the local/remote roots)")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(      '--plan-out', metavar='FILE', help="Work out the changes and save them to FILE instead of applying them")
+    group.add_argument(      '--apply-plan', metavar='FILE', help="Apply the changes saved with --plan-out without re-listing")
+
+    parser.add_argument(      '--list-strategy', choices=["auto"] + list(RClone.LISTSTRATEGIES), help="How the remote is listed, picked from the backend's features by default")
+    parser.add_argument(      '--benchmark-listing', action='store_true', help="Time a full listing of the remote with each listing strategy and exit")
+    parser.add_argument(      '--metrics-json', metavar='FILE', help="Write a JSON summary of the run's metrics to FILE")
+    parser.add_argument(      '--metrics-prom', metavar='FILE', help="Write the run's metrics to FILE in the Prometheus textfile format")
 
     parser.add_argument(      '--initsync', choices=["remote", "local"], help="Location the initial sync will use as the source") #, "merge"
     parser.add_argument(      '--local', help="Local path for the sync [%s]" % initmsg)
-    parser.add_argument(      '--remote', help="Rclone remote for the sync [%s]" % initmsg)
+    parser.add_argument(      '--remote', action='append', help="Rclone remote for the sync, repeat it to sync to several remotes [%s]" % initmsg)
     parser.add_argument(      '--google-docs', action='store_true', help="Pulls down Google Docs, they are ignored by default [%s]" % initmsg)
+    parser.add_argument(      '--filter', action='append', default=[], metavar='RULE', help="Rclone filter rule, ie '- .git/**', may be repeated [only allowed on initial sync]")
+    parser.add_argument(      '--filter-from', metavar='FILE', help="Read rclone filter rules from FILE [only allowed on initial sync]")
     #-v --verbose
     #--extra-rclone-args
     #rclode verbose
@@ -317,129 +2011,356 @@ def ParseArgs():
     args = parser.parse_args()
 
     if(args.configfile):
-        config["conffile"] = args.configfile
+        args.conffile = args.configfile
     else:
-        config["conffile"] = "/".join([xdg_config_home, NAME, args.profile])
-
-    config['1stsync'] = args.initsync
-    config['dryrun'] = args.dry_run
+        args.conffile = ConfFile(args.profile)
 
-    if(config['1stsync']):
-        config['local'] = args.local
-        config['remote'] = args.remote
-        config['gdocs'] = args.google_docs
-
-        if(not config['local']):
+    if(args.initsync):
+        if(not args.local):
             parser.error("Miising required argument for initial sync --local")
-        if(not config['remote']):
+        if(not args.remote):
             parser.error("Miising required argument for initial sync --remote")
+        if(args.plan_out or args.apply_plan):
+            parser.error("--plan-out/--apply-plan are not allowed on initial sync")
+        if(args.benchmark_listing):
+            parser.error("--benchmark-listing is not allowed on initial sync")
+        if(args.path):
+            parser.error("--path is not allowed on initial sync")
+        if(args.status):
+            parser.error("--status is not allowed on initial sync")
+    elif(args.filter or args.filter_from):
+        parser.error("--filter/--filter-from are only allowed on initial sync, edit the 'filters' list in the config file instead")
+
+    return args
+
+
+#################################################################################
+## Filter Rules
+#################################################################################
+def ReadFilterRules(filename):
+    rules = []
+    if(not filename):
+        return rules
+
+    try:
+        with open(filename, "r") as f:
+            for l in f:
+                l = l.strip()
+                if(not l or l[0] in "#;"):
+                    continue
+                rules.append(l)
+    except OSError as e:
+        raise SyncError("Unable to read filter file '%s': %s" % (filename, e.strerror))
+
+    return rules
+
+def WriteFilterFile(conffile, filters):
+    #rclone only takes filter rules from a file (or per rule args) so
+    #keep a copy next to the config that --filter-from can point at
+    if(not filters):
+        return None
+
+    filterfile = conffile + ".filter"
+    with open(filterfile, "w") as f:
+        for rule in filters:
+            f.write(rule + "\n")
+
+    return filterfile
 
 
 #################################################################################
 ## ReadConfigFile
 #################################################################################
-def ReadConfigFile():
-    configexits = os.path.isfile(config["conffile"])
+def ReadConfigFile(conffile, initsync=None):
+    configexits = os.path.isfile(conffile)
 
-    if(config['1stsync'] and configexits):
-        print("'%s' config file exists please remove it and rerun" % config["conffile"])
-        sys.exit(1)
-    if(not config['1stsync'] and not configexits):
-        print("'%s' config file doesn't exists please run --initsync 1st" % config["conffile"])
-        sys.exit(1)
+    if(initsync and configexits):
+        raise SyncError("'%s' config file exists please remove it and rerun" % conffile)
+    if(not initsync and not configexits):
+        raise SyncError("'%s' config file doesn't exists please run --initsync 1st" % conffile)
 
     try:
-        configpath = os.path.dirname(config["conffile"])
+        configpath = os.path.dirname(conffile)
         os.mkdir(configpath)
     except FileExistsError:
         pass
 
     if(not os.access(configpath, os.W_OK)):
-        print("'%s' is not writable please resolve and rerun" % config["conffile"])
-        sys.exit(1)
-    
-    if(not config['1stsync']):
-        with open(config["conffile"], "r") as f:
+        raise SyncError("'%s' is not writable please resolve and rerun" % conffile)
+
+    profile = {}
+    if(not initsync):
+        with open(conffile, "r") as f:
             try:
                 jsonconfig = json.load(f)
             except json.JSONDecodeError:
-                print("'%s' config file is corrupt" % config["conffile"])
-                sys.exit(1)                
-
-        config['local']    = jsonconfig['local']
-        config['remote']   = jsonconfig['remote']
-        config['gdocs']    = jsonconfig['gdocs']
-        config['prevfile'] = jsonconfig['prevfile']
-        config['version']  = jsonconfig['version']
+                raise SyncError("'%s' config file is corrupt" % conffile)
+
+        profile['local']    = jsonconfig['local']
+        profile['remote']   = jsonconfig['remote']
+        profile['gdocs']    = jsonconfig['gdocs']
+        profile['prevfile'] = jsonconfig['prevfile']
+        profile['version']  = jsonconfig['version']
+        profile['filters']  = jsonconfig.get('filters', [])
+        profile['noopmaxage'] = jsonconfig.get('noopmaxage', NOOPMAXAGE)
+        profile['transfer'] = dict(TRANSFER, **jsonconfig.get('transfer', {}))
+        profile['ratelimit'] = dict(RATELIMIT, **jsonconfig.get('ratelimit', {}))
+        profile['lock'] = dict(LOCK, **jsonconfig.get('lock', {}))
+        profile['audit'] = dict(AUDIT, **jsonconfig.get('audit', {}))
+        profile['dupnames'] = jsonconfig.get('dupnames', "skip")
+        if(profile['dupnames'] not in DUPMODES):
+            raise SyncError("'%s' config file has an unknown 'dupnames' (one of %s)" % (conffile, ", ".join(DUPMODES)))
+        profile['maxattempts'] = jsonconfig.get('maxattempts', MAXATTEMPTS)
+        profile['metrics'] = jsonconfig.get('metrics', {'json': None, 'prom': None})
+        profile['order'] = jsonconfig.get('order', "listing")
+        profile['priority'] = jsonconfig.get('priority', [])
+        profile['timebudget'] = jsonconfig.get('timebudget')
+        profile['timewindow'] = jsonconfig.get('timewindow')
+        profile['liststrategy'] = jsonconfig.get('liststrategy', "auto")
+        profile['features'] = jsonconfig.get('features', {})
+        profile['fanout'] = jsonconfig.get('fanout', [])
     else:
-        config['prevfile'] = config["conffile"] + ".previous"
+        profile['prevfile'] = conffile + ".previous"
+        profile['noopmaxage'] = NOOPMAXAGE
+        profile['transfer'] = dict(TRANSFER)
+        profile['ratelimit'] = dict(RATELIMIT)
+        profile['lock'] = dict(LOCK)
+        profile['audit'] = dict(AUDIT)
+        profile['dupnames'] = "skip"
+        profile['maxattempts'] = MAXATTEMPTS
+        profile['metrics'] = {'json': None, 'prom': None}
+        profile['order'] = "listing"
+        profile['priority'] = []
+        profile['timebudget'] = None
+        profile['timewindow'] = None
+        profile['liststrategy'] = "auto"
+        profile['features'] = {}
+
+    return profile
 
 
 #################################################################################
 ## HandleConfigWrite
 #################################################################################
-def WriteConfigFile():
+def WriteConfigFile(conffile, profile):
     jsonconfig = {}
-    jsonconfig['local']    = config['local']
-    jsonconfig['remote']   = config['remote']
-    jsonconfig['gdocs']    = config['gdocs']
-    jsonconfig['prevfile'] = config['prevfile']
+    jsonconfig['local']    = profile['local']
+    jsonconfig['remote']   = profile['remote']
+    jsonconfig['gdocs']    = profile['gdocs']
+    jsonconfig['prevfile'] = profile['prevfile']
+    jsonconfig['filters']  = profile['filters']
+    jsonconfig['noopmaxage'] = profile['noopmaxage']
+    jsonconfig['transfer'] = profile['transfer']
+    jsonconfig['ratelimit'] = profile['ratelimit']
+    jsonconfig['lock'] = profile['lock']
+    jsonconfig['audit'] = profile['audit']
+    jsonconfig['dupnames'] = profile['dupnames']
+    jsonconfig['maxattempts'] = profile['maxattempts']
+    jsonconfig['metrics'] = profile['metrics']
+    jsonconfig['order'] = profile['order']
+    jsonconfig['priority'] = profile['priority']
+    jsonconfig['timebudget'] = profile['timebudget']
+    jsonconfig['timewindow'] = profile['timewindow']
+    jsonconfig['liststrategy'] = profile['liststrategy']
+    jsonconfig['features'] = profile['features']
+    jsonconfig['fanout'] = profile['fanout']
     jsonconfig['version']  = VersionAsInt()
 
-    with open(config["conffile"], "w") as f:
+    with open(conffile, "w") as f:
         json.dump(jsonconfig, f, indent=4, separators=(',', ': '))
 
 
 #################################################################################
 ## Initialize
 #################################################################################
-def Initialize():
-    global rclone
-
-    ParseArgs()
-    ReadConfigFile()
-
-    rclone = RClone.rclone(config['local'], config['remote'], config['gdocs'], config['dryrun'])
+def NewProfile(args):
+    profile = ReadConfigFile(args.conffile, args.initsync)
+    profile['local'] = args.local
+    profile['remote'] = args.remote[0]
+    profile['gdocs'] = args.google_docs
+    profile['filters'] = ReadFilterRules(args.filter_from) + args.filter
+    profile['fanout'] = [{'remote': r, 'prevfile': "%s.previous.%d" % (args.conffile, i)}
+                         for (i, r) in enumerate(args.remote[1:], 1)]
+    return profile
+
+def EngineConfig(args, profile, filterfile, i=0):
+    #settings for the engine syncing the i'th remote of the profile, command
+    #line settings win over the ones in the profile
+    c = {k: profile[k] for k in ('local', 'gdocs', 'noopmaxage', 'transfer', 'ratelimit', 'maxattempts',
+                                 'priority', 'timewindow', 'features', 'dupnames')}
+    c.update(fanout_targets(profile)[i])
+    #the fan-out workers are processes of their own, targets on the same
+    #remote split its rate up front
+    rl = c['ratelimit']
+    n = [RClone.remotename(t['remote']) for t in fanout_targets(profile)].count(RClone.remotename(c['remote']))
+    if(n > 1 and rl['tps']):
+        c['ratelimit'] = dict(rl, tps=rl['tps'] / n, burst=rl['burst'] and max(1, rl['burst'] // n))
+    c['filterfile'] = filterfile
+    c['failfile'] = args.conffile + ".failures" + (".%d" % i if i else "")
+    c['dryrun'] = args.dry_run
+    c['full'] = args.full
+    c['order'] = args.order or profile['order']
+    c['timebudget'] = args.time_budget or profile['timebudget']
+    c['liststrategy'] = args.list_strategy or profile['liststrategy']
+    c['path'] = args.path
+    c['lock'] = dict(profile['lock'], name=profile['lock']['name'] or os.path.basename(args.conffile))
+    c['audit'] = dict(profile['audit'], fast=args.fast or profile['audit']['fast'])
+    return c
+
+def SetupMetrics(engine, args, profile, i=0):
+    for fmt in ('json', 'prom'):
+        path = getattr(args, "metrics_" + fmt) or profile['metrics'].get(fmt)
+        engine.metrics.outputs[fmt] = fanout_path(path, i) if path and i else path
+    engine.metrics.labels['profile'] = os.path.basename(args.conffile)
+    if(i):
+        engine.metrics.labels['remote'] = fanout_targets(profile)[i]['remote']
+
+def Initialize(args, profile, filterfile):
+    rl = profile['ratelimit']
+    RClone.scheduler.retries = rl['retries']
+    RClone.scheduler.maxdelay = rl['maxdelay']
+    for target in fanout_targets(profile):
+        RClone.scheduler.setrate(RClone.remotename(target['remote']), rl['tps'], rl['burst'])
+
+    engine = SyncEngine(EngineConfig(args, profile, filterfile))
+    SetupMetrics(engine, args, profile)
+
+    probed = len(profile['features'])
+    for target in profile['fanout']:
+        #probed here so the workers find them in the cache
+        RClone.rclone(profile['local'], target['remote'], featurecache=profile['features']).features(RClone.Direction.remote)
+    engine.connect()
+
+    #keep what was probed so the next run doesn't have to ask again, the
+    #initial sync writes the profile when it's done
+    if(len(profile['features']) != probed and not args.initsync and not args.dry_run):
+        WriteConfigFile(args.conffile, profile)
+
+    return engine
 
 
 #################################################################################
-## CleanUp
+## BenchmarkListing
 #################################################################################
-def CleanUp():
-    if(not config['dryrun']):
-        #get ready to create 'previous' for next sync
-        global files
-        files = {}
+def BenchmarkListing(engine):
+    print("Timing a full listing of '%s' with each strategy" % engine.config['remote'])
+    results = engine.rclone.benchmark_listing()
+    for strategy in sorted(results, key=lambda s: results[s][0]):
+        print("  %-10s %8.2fs  %d files" % (strategy, results[strategy][0], results[strategy][1]))
+    best = min(results, key=lambda s: results[s][0])
+    print("Fastest was '%s', set \"liststrategy\" in the profile or pass --list-strategy to use it" % best)
 
-        get_local_list()
-        get_remote_list()
-        for name in list(files): #note -- missing gdoc file names
-            if('remote' in files[name] and files[name]['remote']['gdoc']):
-                del(files[name])
-                continue
-            files[name]['previous'] = files[name]['local']
-            files[name]['previous']['rtime'] = files[name]['remote']['time']
-            del(files[name]['local'])
-            del(files[name]['remote'])
 
-        j = {}
-        j['files'] = files
-        j['version'] = VersionAsInt()
-        
-        with open(config['prevfile'], "w") as f:
-            json.dump(j, f, indent=4, separators=(',', ': '))
+#################################################################################
+## Status
+#################################################################################
+def status_path(prevfile):
+    return prevfile + ".status"
+
+def StatusArgs(argv):
+    #the config file for a plain '--status -P name' (or --configfile), None
+    #for anything else, which goes through ParseArgs() as usual
+    if(argv.count("--status") != 1):
+        return None
+    rest = [a for a in argv if a != "--status"]
+    if(len(rest) == 1 and "=" in rest[0]):
+        rest = rest[0].split("=", 1)
+    if(len(rest) != 2):
+        return None
+    if(rest[0] in ("-P", "--profile")):
+        return ConfFile(rest[1])
+    if(rest[0] == "--configfile"):
+        return rest[1]
+    return None
+
+def FormatStatus(remote, st):
+    ago = int(time.time() - st['time'])
+    lines = ["'%s' last synced %s (%dh %02dm ago), took %.1fs" % (remote, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(st['time'])),
+                                                               ago // 3600, ago % 3600 // 60, st['duration'])]
+    if(st['path']):
+        lines.append("  only '%s' was synced" % st['path'])
+    if(st['noop']):
+        lines.append("  nothing changed, %d file(s)" % st['files'])
+    else:
+        lines.append("  %d file(s)" % st['files'])
+    if(st['pending']):
+        lines.append("  %d change(s) left for the next run (%d failed, %d deferred)" % (st['pending'], st['failed'], st['deferred']))
+    if(st['coverage'] is not None):
+        lines.append("  %.1f%% of the tree audited by hash this cycle" % (100 * st['coverage']))
+    return "\n".join(lines)
+
+def ShowStatus(conffile):
+    #how the last run went, only reads the config and the small status files
+    #written by save(). returns 2 if changes were left for the next run and 1
+    #if there is no run to go by
+    try:
+        with open(conffile, "r") as f:
+            jsonconfig = json.load(f)
+    except (OSError, ValueError):
+        print("'%s' config file is missing or corrupt" % conffile)
+        return 1
+    jsonconfig.setdefault('fanout', [])
+
+    rc = 0
+    for target in fanout_targets(jsonconfig):
+        try:
+            with open(status_path(target['prevfile']), "r") as f:
+                st = json.load(f)
+        except (OSError, ValueError):
+            print("'%s' has no sync recorded yet" % target['remote'])
+            rc = max(rc, 1)
+            continue
+        print(FormatStatus(target['remote'], st))
+        if(st['pending']):
+            rc = 2
+    return rc
 
 
 #################################################################################
 ## main
 #################################################################################
-if(__name__ == '__main__'):
-    Initialize()
+def main():
+    #--status skips building the parser and everything a sync needs
+    conffile = StatusArgs(sys.argv[1:])
+    if(conffile):
+        return ShowStatus(conffile)
 
-    if(config['1stsync']):
-        Run1stSync()
-        WriteConfigFile()
-    else:
-        RunSync()
+    args = ParseArgs()
+    if(args.status):
+        return ShowStatus(args.conffile)
+
+    try:
+        profile = NewProfile(args) if args.initsync else ReadConfigFile(args.conffile)
+        filterfile = WriteFilterFile(args.conffile, profile['filters'])
+        engine = Initialize(args, profile, filterfile)
+
+        if(args.benchmark_listing):
+            BenchmarkListing(engine)
+            return 0
 
-    CleanUp()
+        if(profile['fanout'] and not args.initsync):
+            if(args.plan_out or args.apply_plan):
+                raise SyncError("--plan-out/--apply-plan are not supported for profiles with several remotes")
+            try:
+                return RunFanout(engine, args, profile, filterfile)
+            finally:
+                engine.metrics.write()
+
+        try:
+            if(args.initsync):
+                engine.initial_sync(args.initsync)
+                WriteConfigFile(args.conffile, profile)
+                engine.save()
+                RunFanout1stSync(args, profile, filterfile)
+            else:
+                RunSync(engine, args)
+        finally:
+            engine.metrics.write()
+    except SyncError as e:
+        print(e)
+        return 1
+
+    return 0
+
+if(__name__ == '__main__'):
+    sys.exit(main())
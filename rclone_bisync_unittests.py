@@ -3,11 +3,86 @@
 #################################################################################
 ## Imports
 #################################################################################
+import io
+import os
+import sys
 import unittest
 import copy
+import time
+import tempfile
+import threading
+import subprocess
+import contextlib
 
+import rclone_bisync
 from rclone_bisync import *
 
+class FakeRClone():
+    #stands in for RClone.rclone, fails the names in 'fail' the given number of times
+    def __init__(self, fail):
+        self.fail = dict(fail)
+        self.done = []
+        self.listing = {RClone.Direction.local: {}, RClone.Direction.remote: {}}
+        self.hashtype = "md5"
+
+    def _apply(self, name):
+        if(self.fail.get(name)):
+            self.fail[name] -= 1
+            raise subprocess.CalledProcessError(1, ["rclone"], b'', b'ERROR : some error\n')
+        self.done.append(name)
+
+    def copyfiles(self, names, direction, extraargs=()):
+        for name in names:
+            if(self.fail.get(name)):
+                raise subprocess.CalledProcessError(1, ["rclone"], b'', b'ERROR : batch error\n')
+        self.done.extend(names)
+
+    def copyto(self, name, direction, extraargs=()):
+        self._apply(name)
+
+    def copydir(self, name, direction, extraargs=()):
+        self._apply(name + "/")
+
+    def purge(self, name, direction):
+        self._apply(name + "/")
+
+    def delete(self, name, direction):
+        self._apply(name)
+
+    def dupcopy(self, source, name, direction):
+        self._apply(source + ">" + name)
+
+    def settime(self, name, direction, t):
+        pass
+
+    def chunkargs(self, chunksize):
+        return []
+
+    def lsjson(self, direction, includegdocs=False, names=None, path=None):
+        #without a hash type the records come back without hashes
+        return {name: {k: v for (k, v) in rec.items() if self.hashtype or k != 'md5sum'}
+                for (name, rec) in self.listing[direction].items()
+                if(names is None or name in names) and (path is None or name.startswith(path + "/"))}
+
+    def servercopy(self):
+        return False
+
+    def subtree_filter(self, path):
+        return []
+
+    def isfile(self, direction, name):
+        return name in self.listing[direction]
+
+    def local_fingerprint(self):
+        return "L"
+
+    def remote_fingerprint(self):
+        return "R"
+
+def new_engine(rc, **config):
+    #engine around a FakeRClone, connect() is never called
+    return SyncEngine(dict({'local': "/local", 'remote': "remote:", 'prevfile': "/nonexistent"}, **config), backend=rc)
+
 class TestCalcActions(unittest.TestCase):
     maxDiff = None
     def test_calc_actions_not_missing_or_changed(self):
@@ -429,5 +504,1132 @@ class TestCalcDiffs(unittest.TestCase):
         self.assertEqual(f, org)
         self.assertEqual(cf, {'file14' : {'action' : RClone.Action.conflict, 'direction' : RClone.Direction.neither}})
 
+    def test_calc_diffs_changed_L_hash(self):
+        """
+        This tests if a file is marked as changed correctly when a hash other than md5 was negotiated (Local Changed)
+        Results: f[name]['changed'] == 'sha1sum'
+        """
+        f = {'file15': {'local': {'sha1sum': "2", 'time': "2017-12-20 15:43:27.776000000", 'size': 3},
+                       'previous': {'sha1sum': "1", 'time': "2017-12-20 15:43:27.776000000", 'size': 3, 'rtime': "2017-12-20 15:43:27.776000000"},
+                       'remote': {'sha1sum': "1", 'time': "2017-12-20 15:43:27.776000000", 'size': 3, 'gdoc': False}}}
+        org = copy.deepcopy(f)
+
+        cf = calc_diffs(f, 'sha1sum')
+
+        org['file15']['changed'] = 'sha1sum'
+        org['file15']['which'] = 1
+        self.assertEqual(f, org)
+        self.assertEqual(cf, {'file15' : {'action' : RClone.Action.copyto, 'direction' : RClone.Direction.remote}})
+
+    def test_calc_diffs_no_hash(self):
+        """
+        This tests that with no shared hash type only size & time are compared
+        Results: No changes
+        """
+        f = {'file16': {'local': {'time': "2017-12-20 15:43:27.776000000", 'size': 3},
+                       'previous': {'md5sum': "1", 'time': "2017-12-20 15:43:27.776000000", 'size': 3, 'rtime': "2017-12-20 15:43:27.776000000"},
+                       'remote': {'time': "2017-12-20 15:43:27.776000000", 'size': 3, 'gdoc': False}}}
+        org = copy.deepcopy(f)
+
+        cf = calc_diffs(f, None)
+
+        self.assertEqual(f, org)
+        self.assertEqual(cf, {})
+
+    def test_calc_diffs_time_window(self):
+        """
+        This tests that time differences within the backends' precision are ignored
+        Results: No changes with a 1s window, a change without one
+        """
+        f = {'file17': {'local': {'md5sum': "1", 'time': "2017-12-20 15:43:27.776000", 'size': 3},
+                       'previous': {'md5sum': "1", 'time': "2017-12-20 15:43:27.000000", 'size': 3, 'rtime': "2017-12-20 15:43:27.000000"},
+                       'remote': {'md5sum': "1", 'time': "2017-12-20 15:43:27.000000", 'size': 3, 'gdoc': False}}}
+        org = copy.deepcopy(f)
+
+        cf = calc_diffs(f, 'md5sum', window=1)
+        self.assertEqual(f, org)
+        self.assertEqual(cf, {})
+
+        cf = calc_diffs(f, 'md5sum', window=0.001)
+        self.assertEqual(cf, {'file17' : {'action' : RClone.Action.copyto, 'direction' : RClone.Direction.remote}})
+
+    def test_calc_diffs_time_window_per_side(self):
+        """
+        This tests a same size local edit within the remote's (coarse) precision
+        Results: No change with one 60s window, a change with 0s locally and 60s on the remote
+        """
+        f = {'file17': {'local': {'time': "2017-12-20 15:43:57.000000", 'size': 3},
+                        'previous': {'time': "2017-12-20 15:43:27.000000", 'size': 3, 'rtime': "2017-12-20 15:43:00.000000"},
+                        'remote': {'time': "2017-12-20 15:43:00.000000", 'size': 3, 'gdoc': False}}}
+
+        self.assertEqual(calc_diffs(copy.deepcopy(f), None, window=60), {})
+        cf = calc_diffs(f, None, window=(0, 60))
+        self.assertEqual(cf, {'file17' : {'action' : RClone.Action.copyto, 'direction' : RClone.Direction.remote}})
+
+    def test_calc_diffs_settime(self):
+        """
+        This tests a time only change where local and remote contents match
+        Results: Only the modtime is set on the remote
+        """
+        f = {'file18': {'local': {'md5sum': "1", 'time': "2017-12-20 15:43:28.000000", 'size': 3},
+                       'previous': {'md5sum': "1", 'time': "2017-12-20 15:43:27.000000", 'size': 3, 'rtime': "2017-12-20 15:43:27.000000"},
+                       'remote': {'md5sum': "1", 'time': "2017-12-20 15:43:27.000000", 'size': 3, 'gdoc': False}}}
+
+        cf = calc_diffs(f, 'md5sum', settime=True)
+        self.assertEqual(cf, {'file18' : {'action' : RClone.Action.settime, 'direction' : RClone.Direction.remote}})
+
+    def test_calc_diffs_settime_no_hash(self):
+        """
+        This tests a time only change when there are no hashes to prove the contents match
+        Results: The file is copied
+        """
+        f = {'file19': {'local': {'time': "2017-12-20 15:43:28.000000", 'size': 3},
+                       'previous': {'time': "2017-12-20 15:43:27.000000", 'size': 3, 'rtime': "2017-12-20 15:43:27.000000"},
+                       'remote': {'time': "2017-12-20 15:43:27.000000", 'size': 3, 'gdoc': False}}}
+
+        cf = calc_diffs(f, None, settime=True)
+        self.assertEqual(cf, {'file19' : {'action' : RClone.Action.copyto, 'direction' : RClone.Direction.remote}})
+
+class TestTreeDigests(unittest.TestCase):
+    def setUp(self):
+        self.records = {'a': {'md5sum': "1", 'time': "2017-12-20 15:43:27.776000", 'size': 3},
+                        'd1/b': {'md5sum': "2", 'time': "2017-12-20 15:43:27.776000", 'size': 3},
+                        'd1/d2/c': {'md5sum': "3", 'time': "2017-12-20 15:43:27.776000", 'size': 3},
+                        'd3/d4/e': {'md5sum': "4", 'time': "2017-12-20 15:43:27.776000", 'size': 3}}
+
+    def test_tree_digests_dirs(self):
+        """
+        This tests that every dir (and the root) gets a digest
+        Results: digests for '', d1, d1/d2, d3, d3/d4
+        """
+        t = tree_digests(self.records, 'md5sum')
+        self.assertEqual(sorted(t), ['', 'd1', 'd1/d2', 'd3', 'd3/d4'])
+
+    def test_tree_digests_change(self):
+        """
+        This tests that a change deep in the tree only changes the digests of its parents
+        Results: d1/d2, d1 and the root change, d3 and d3/d4 don't
+        """
+        t1 = tree_digests(self.records, 'md5sum')
+        self.records['d1/d2/c']['md5sum'] = "5"
+        t2 = tree_digests(self.records, 'md5sum')
+
+        self.assertEqual([d for d in sorted(t1) if t1[d] != t2[d]], ['', 'd1', 'd1/d2'])
+
+    def test_tree_digests_order(self):
+        """
+        This tests that the digests don't depend on the listing order
+        Results: the same digests
+        """
+        r = dict(reversed(list(self.records.items())))
+        self.assertEqual(tree_digests(self.records, 'md5sum'), tree_digests(r, 'md5sum'))
+
+    def test_unchanged_dirs(self):
+        """
+        This tests which dirs are identical on both sides compared to the previous sync
+        Results: d3, d3/d4 are unchanged, d1 only changed locally so isn't
+        """
+        prev = tree_digests(self.records, 'md5sum')
+        remote = dict(prev)
+        self.records['d1/b']['size'] = 4
+        local = tree_digests(self.records, 'md5sum')
+
+        self.assertEqual(unchanged_dirs({'local': prev, 'remote': prev}, local, remote), {'d3', 'd3/d4', 'd1/d2'})
+
+    def test_calc_diffs_skip(self):
+        """
+        This tests that calc_diffs skips subtrees marked as unchanged
+        Results: only d1/b is looked at
+        """
+        f = {'d1/b': {'local': {'md5sum': "2", 'time': "2017-12-20 15:43:27.776000000", 'size': 3}},
+             'd3/d4/e': {'local': {'md5sum': "4", 'time': "2017-12-20 15:43:27.776000000", 'size': 3}}}
+
+        cf = calc_diffs(f, 'md5sum', {'d3'})
+        self.assertEqual(cf, {'d1/b' : {'action' : RClone.Action.copyto, 'direction' : RClone.Direction.remote}})
+
+        cf = calc_diffs(f, 'md5sum', {''})
+        self.assertEqual(cf, {})
+
+class TestSizeClass(unittest.TestCase):
+    def test_size_class(self):
+        """
+        This tests files are split into the small/medium/large transfer classes
+        Results: < smallsize is small, >= largesize is large, the rest medium
+        """
+        tconf = {'smallsize': "1M", 'largesize': "256M"}
+        self.assertEqual(size_class(0, tconf), "small")
+        self.assertEqual(size_class(1024 * 1024 - 1, tconf), "small")
+        self.assertEqual(size_class(1024 * 1024, tconf), "medium")
+        self.assertEqual(size_class(256 * 1024 * 1024, tconf), "large")
+
+class TestApplyChanges(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rclone_bisync.RETRYDELAY = 0
+        self.engine = new_engine(FakeRClone({}), failfile=self.tmp.name + "/profile.failures")
+        self.engine.files.update({'a': {'local': {'size': 10}}, 'b': {'local': {'size': 10}},
+                                  'c': {'remote': {'size': 10}}, 'd': {'previous': {'size': 10}, 'local': {'size': 10}}})
+        self.changes = {'a': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'b': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'c': {'action': RClone.Action.copyto, 'direction': RClone.Direction.local},
+                        'd': {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.local}}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ApplyChanges_retry(self):
+        """
+        This tests a failure that goes away on retry
+        Results: Nothing is reported as failed
+        """
+        self.engine.rclone = FakeRClone({'b': 1, 'd': 1})
+        (failed, deferred) = self.engine.apply_changes(self.changes)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(deferred, set())
+        self.assertEqual(sorted(self.engine.rclone.done), ['a', 'b', 'c', 'd'])
+
+    def test_ApplyChanges_permanent(self):
+        """
+        This tests a failure that keeps failing doesn't stop the other changes
+        Results: Only 'd' is reported as failed and left pending
+        """
+        self.engine.rclone = FakeRClone({'d': 5})
+        (failed, deferred) = self.engine.apply(self.changes)
+
+        self.assertEqual(failed, {'d': 'ERROR : some error'})
+        self.assertEqual(sorted(self.engine.rclone.done), ['a', 'b', 'c'])
+        self.assertEqual(self.engine.pending, {'d'})
+
+        with open(self.tmp.name + "/profile.failures") as f:
+            self.assertEqual(json.load(f), {'d': {'action': 'deletefrom', 'direction': 'local', 'error': 'ERROR : some error'}})
+
+    def test_ApplyChanges_budget(self):
+        """
+        This tests that changes that don't fit in the time budget are deferred
+        Results: everything after the 1st unit is deferred
+        """
+        class SlowRClone(FakeRClone):
+            def copyfiles(self, names, direction, extraargs=()):
+                time.sleep(0.05)
+                FakeRClone.copyfiles(self, names, direction, extraargs)
+
+        self.engine.rclone = SlowRClone({})
+        self.engine.config['timebudget'] = 0.01
+        (failed, deferred) = self.engine.apply_changes(self.changes)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(self.engine.rclone.done, ['a', 'b'])
+        self.assertEqual(deferred, {'c', 'd'})
+
+    def test_ApplyChanges_cutoff(self):
+        """
+        This tests a batch rclone stops part way through as the budget runs out
+        Results: rclone is given the time left, only what didn't make it is deferred
+        """
+        class CutoffRClone(FakeRClone):
+            def copyfiles(self, names, direction, extraargs=()):
+                self.args = list(extraargs)
+                self.listing[direction]['a'] = {'size': 10}
+                raise subprocess.CalledProcessError(RClone.DURATIONEXCEEDED, ["rclone"], b'', b'ERROR : Max duration reached\n')
+
+        self.engine.rclone = CutoffRClone({})
+        self.engine.config['timebudget'] = 60
+        self.engine.config['transfer'] = dict(self.engine.config['transfer'], adaptive=False)
+        (failed, deferred) = self.engine.apply_changes(self.changes)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(deferred, {'b', 'c'})
+        self.assertEqual(self.engine.rclone.done, ['d'])
+        self.assertEqual(self.engine.rclone.args[-4], "--max-duration")
+        self.assertIn(self.engine.rclone.args[-3], ("59s", "60s"))
+        self.assertEqual(self.engine.rclone.args[-2:], ["--cutoff-mode", "soft"])
+
+    def test_ApplyChanges_dupcopy(self):
+        """
+        This tests a copy within the target side is applied (and retried) on its own
+        Results: 'a' is copied from 'x'
+        """
+        self.engine.config['settime'] = True
+        self.engine.files['a']['local']['time'] = "2017-12-20 15:43:27.776000"
+        self.changes['a'] = {'action': RClone.Action.dupcopy, 'direction': RClone.Direction.remote, 'source': 'x'}
+        self.engine.rclone = FakeRClone({'x>a': 1})
+        (failed, deferred) = self.engine.apply_changes(self.changes)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(sorted(self.engine.rclone.done), ['b', 'c', 'd', 'x>a'])
+
+    def test_ApplyChanges_dirs(self):
+        """
+        This tests that collapsed dirs are done in one op and fall back to per file ops on failure
+        Results: 'n/' is copied as a dir, 'g/' fails and its files are deleted one by one
+        """
+        self.engine.files.update({'n/1': {'local': {'size': 1}}, 'n/2': {'local': {'size': 1}},
+                                  'g/1': {'previous': {'size': 1}, 'local': {'size': 1}},
+                                  'g/2': {'previous': {'size': 1}, 'local': {'size': 1}}})
+        for name in ('n/1', 'n/2'):
+            self.changes[name] = {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}
+        for name in ('g/1', 'g/2'):
+            self.changes[name] = {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.local}
+
+        dirs = collapse_dirs(self.changes, self.engine.files)
+        self.engine.rclone = FakeRClone({'g/': 1})
+        (failed, deferred) = self.engine.apply_changes(self.changes, dirs)
+
+        self.assertEqual(failed, {})
+        #in listing order like the rest, the purge with the deletes
+        self.assertEqual(self.engine.rclone.done, ['a', 'b', 'c', 'n/', 'd', 'g/1', 'g/2'])
+
+    def test_ApplyChanges_purge_relist(self):
+        """
+        This tests a dir to be purged is listed again 1st and anything new or changed in it is spared
+        Results: 'g/' isn't purged, 'g/1' is deleted, 'g/2' (changed) is deferred and 'g/new' left alone
+        """
+        t = "2017-12-20 15:43:27.776000"
+        self.engine.files.update({'g/1': {'previous': {'size': 1, 'time': t}, 'local': {'size': 1, 'time': t}},
+                                  'g/2': {'previous': {'size': 1, 'time': t}, 'local': {'size': 1, 'time': t}}})
+        for name in ('g/1', 'g/2'):
+            self.changes[name] = {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.local}
+
+        dirs = collapse_dirs(self.changes, self.engine.files)
+        self.engine.rclone = FakeRClone({})
+        self.engine.rclone.listing[RClone.Direction.local] = {'g/1': {'size': 1, 'time': t}, 'g/2': {'size': 2, 'time': t},
+                                                              'g/new': {'size': 1, 'time': t}}
+        (failed, deferred) = self.engine.apply_changes(self.changes, dirs)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(deferred, {'g/2'})
+        self.assertEqual(self.engine.rclone.done, ['a', 'b', 'c', 'd', 'g/1'])
+
+    def test_ApplyChanges_adaptive(self):
+        """
+        This tests small copies go out in waves with --transfers set by the controller
+        Results: waves of 1*4 then 2*4 files, both in the concurrency trace
+        """
+        class Transfers(FakeRClone):
+            def copyfiles(self, names, direction, extraargs=()):
+                self.done.append((len(names), flag_value(extraargs, "--transfers")))
+
+        self.engine.files.update({"s%d" % i: {'local': {'size': 10}} for i in range(12)})
+        changes = {"s%d" % i: self.changes['a'] for i in range(12)}
+        self.engine.config['transfer'].update({'smallargs': ["--transfers", "1"], 'maxtransfers': 2})
+        self.engine.rclone = Transfers({})
+        (failed, deferred) = self.engine.apply_changes(changes)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(self.engine.rclone.done, [(4, "1"), (8, "2")])
+        self.assertEqual([t['value'] for t in self.engine.metrics.extra['concurrency']['small']['trace']], [1, 2])
+
+    def test_ApplyChanges_pool(self):
+        """
+        This tests medium files keep every worker busy while one of them is slow
+        Results: the other files all finish while 'm0' is still going, never more than 2 at once
+        """
+        others = threading.Event()
+        lock = threading.Lock()
+        busy = [0, 0]
+
+        class Straggler(FakeRClone):
+            def copyto(self, name, direction, extraargs=()):
+                with lock:
+                    busy[0] += 1
+                    busy[1] = max(busy)
+                if(name == "m0"):
+                    self.waited = others.wait(5)
+                with lock:
+                    busy[0] -= 1
+                self._apply(name)
+                if(len(self.done) == 8):
+                    others.set()
+
+        self.engine.files.update({"m%d" % i: {'local': {'size': 2 << 20}} for i in range(9)})
+        changes = {"m%d" % i: self.changes['a'] for i in range(9)}
+        self.engine.config['transfer'].update({'workers': 2, 'maxworkers': 2})
+        self.engine.rclone = Straggler({})
+        (failed, deferred) = self.engine.apply_changes(changes)
+
+        self.assertEqual(failed, {})
+        self.assertTrue(self.engine.rclone.waited)
+        self.assertEqual(self.engine.rclone.done[-1], "m0")
+        self.assertEqual(busy[1], 2)
+
+    def test_ApplyChanges_threads(self):
+        """
+        This tests engines running side by side in threads don't share any state
+        Results: each engine applied its own changes to its own backend
+        """
+        engines = [new_engine(FakeRClone({})) for i in range(4)]
+        for (i, e) in enumerate(engines):
+            e.files.update({"f%d" % i: {'local': {'size': 1}}})
+        threads = [threading.Thread(target=e.apply_changes, args=({name: self.changes['a'] for name in e.files},)) for e in engines]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for (i, e) in enumerate(engines):
+            self.assertEqual(e.rclone.done, ["f%d" % i])
+
+class TestFindDups(unittest.TestCase):
+    def setUp(self):
+        self.f = {'new': {'local': {'size': 10, 'md5sum': "1"}},
+                  'old': {'previous': {'size': 10, 'md5sum': "1"}, 'local': {'size': 10, 'md5sum': "1"}, 'remote': {'size': 10, 'md5sum': "1"}},
+                  'dl': {'remote': {'size': 5, 'md5sum': "2"}},
+                  'had': {'previous': {'size': 5, 'md5sum': "2"}, 'local': {'size': 5, 'md5sum': "2"}, 'remote': {'size': 5, 'md5sum': "2"}},
+                  'tiny': {'local': {'size': 1, 'md5sum': "3"}},
+                  'tinyold': {'previous': {'size': 1, 'md5sum': "3"}, 'local': {'size': 1, 'md5sum': "3"}, 'remote': {'size': 1, 'md5sum': "3"}}}
+        self.changes = {'new': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'dl': {'action': RClone.Action.copyto, 'direction': RClone.Direction.local},
+                        'tiny': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}}
+
+    def test_find_dups(self):
+        """
+        This tests copies of contents already on the target side are found
+        Results: 'new' and 'dl' become copies, 'tiny' is too small
+        """
+        n = find_dups(self.changes, self.f, 'md5sum', [RClone.Direction.local, RClone.Direction.remote], 2)
+        self.assertEqual(n, 2)
+        self.assertEqual(self.changes['new'], {'action': RClone.Action.dupcopy, 'direction': RClone.Direction.remote, 'source': 'old'})
+        self.assertEqual(self.changes['dl'], {'action': RClone.Action.dupcopy, 'direction': RClone.Direction.local, 'source': 'had'})
+        self.assertEqual(self.changes['tiny']['action'], RClone.Action.copyto)
+
+    def test_find_dups_busy(self):
+        """
+        This tests a file being deleted or without server side copy isn't used
+        Results: only the local side copy is found
+        """
+        self.changes['old'] = {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.remote}
+        n = find_dups(self.changes, self.f, 'md5sum', [RClone.Direction.local, RClone.Direction.remote])
+        self.assertEqual(n, 2)
+        self.assertEqual(self.changes['new']['action'], RClone.Action.copyto)
+        self.assertEqual(self.changes['tiny']['source'], 'tinyold')
+
+        self.assertEqual(find_dups(self.changes, self.f, None, [RClone.Direction.local]), 0)
+
+class TestCollapseDirs(unittest.TestCase):
+    def test_collapse_dirs(self):
+        """
+        This tests which dirs can be done as a single copy/purge
+        Results: new/ (not new/sub as new/ covers it) is copied, old/ is purged, mixed/ is left alone
+        """
+        up = {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}
+        rm = {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.remote}
+        f = {'new/a': {}, 'new/sub/b': {}, 'new/sub/c': {}, 'old/a': {}, 'old/b': {},
+             'mixed/a': {}, 'mixed/b': {}, 'one/a': {}, 'top': {}}
+        cf = {'new/a': up, 'new/sub/b': up, 'new/sub/c': up, 'old/a': rm, 'old/b': rm,
+              'mixed/a': up, 'one/a': up, 'top': up}
+
+        dirs = collapse_dirs(cf, f)
+        self.assertEqual(dirs, {'new': {'action': RClone.Action.copydir, 'direction': RClone.Direction.remote, 'dir': 'new',
+                                        'names': ['new/a', 'new/sub/b', 'new/sub/c']},
+                                'old': {'action': RClone.Action.purge, 'direction': RClone.Direction.remote, 'dir': 'old',
+                                        'names': ['old/a', 'old/b']}})
+
+    def test_collapse_dirs_mixed_direction(self):
+        """
+        This tests a dir with files going both ways isn't collapsed
+        Results: nothing collapsed
+        """
+        f = {'d/a': {}, 'd/b': {}}
+        cf = {'d/a': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+              'd/b': {'action': RClone.Action.copyto, 'direction': RClone.Direction.local}}
+
+        self.assertEqual(collapse_dirs(cf, f), {})
+
+class TestOrderChanges(unittest.TestCase):
+    def setUp(self):
+        self.f = {}
+        self.f.update({'x/big': {'local': {'size': 1000}}, 'a/small': {'local': {'size': 1}},
+                                    'x/mid': {'remote': {'size': 50}}, 'a/gone': {'previous': {'size': 10}}})
+        self.changes = {'x/big': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'a/small': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'x/mid': {'action': RClone.Action.copyto, 'direction': RClone.Direction.local},
+                        'a/gone': {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.local}}
+
+    def test_order_changes(self):
+        """
+        This tests the different orders changes can be applied in
+        Results: the names in the expected order
+        """
+        self.assertEqual(order_changes(self.changes, self.f, "listing"), ['x/big', 'a/small', 'x/mid', 'a/gone'])
+        self.assertEqual(order_changes(self.changes, self.f, "smallest"), ['a/gone', 'a/small', 'x/mid', 'x/big'])
+        self.assertEqual(order_changes(self.changes, self.f, "largest"), ['x/big', 'x/mid', 'a/small', 'a/gone'])
+        self.assertEqual(order_changes(self.changes, self.f, "locality"), ['a/gone', 'a/small', 'x/big', 'x/mid'])
+        self.assertEqual(order_changes(self.changes, self.f, "priority", ["*/mid", "/a/**"]), ['x/mid', 'a/small', 'a/gone', 'x/big'])
+
+    def test_order_changes_dirs(self):
+        """
+        This tests a collapsed dir is ordered by the total size of its files and
+        becomes one unit where they would have been
+        Results: 'd/' (60 bytes) between 'x/mid' and 'x/big' for both orders
+        """
+        for n in ('d/1', 'd/2'):
+            self.f[n] = {'local': {'size': 30}}
+            self.changes[n] = {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}
+        dirs = {'d': {'action': RClone.Action.copydir, 'direction': RClone.Direction.remote, 'dir': "d", 'names': ['d/1', 'd/2']}}
+        tconf = {'smallsize': "10", 'largesize': "100", 'batchsize': 10, 'adaptive': False}
+
+        names = order_changes(self.changes, self.f, "largest", dirs=dirs)
+        self.assertEqual(names, ['x/big', 'd/1', 'd/2', 'x/mid', 'a/small', 'a/gone'])
+        units = plan_units(names, self.changes, self.f, tconf, dirs)
+        self.assertEqual([u[2] for u in units], [['x/big'], ['d'], ['x/mid'], ['a/small'], ['a/gone']])
+
+        names = order_changes(self.changes, self.f, "smallest", dirs=dirs)
+        units = plan_units(names, self.changes, self.f, tconf, dirs)
+        self.assertEqual([u[2] for u in units], [['a/small'], ['x/mid'], ['d'], ['x/big'], ['a/gone']])
+
+    def test_plan_units(self):
+        """
+        This tests that runs of small copies are batched and deletes go last
+        Results: one batch for the 2 small uploads
+        """
+        self.f['a/small2'] = {'local': {'size': 2}}
+        self.changes['a/small2'] = {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}
+        names = order_changes(self.changes, self.f, "smallest")
+        units = plan_units(names, self.changes, self.f, {'smallsize': "10", 'largesize': "100", 'batchsize': 10, 'adaptive': False})
+
+        self.assertEqual(units, [("small", RClone.Direction.remote, ['a/small', 'a/small2']),
+                                 ("medium", RClone.Direction.local, ['x/mid']),
+                                 ("large", RClone.Direction.remote, ['x/big']),
+                                 (None, RClone.Direction.local, ['a/gone'])])
+
+    def test_plan_units_adaptive(self):
+        """
+        This tests that with adaptive concurrency runs of medium copies are grouped too
+        Results: one unit for the 2 medium downloads
+        """
+        self.f['x/mid2'] = {'remote': {'size': 60}}
+        self.changes['x/mid2'] = {'action': RClone.Action.copyto, 'direction': RClone.Direction.local}
+        names = order_changes(self.changes, self.f, "smallest")
+        units = plan_units(names, self.changes, self.f, {'smallsize': "10", 'largesize': "100", 'batchsize': 10, 'adaptive': True})
+
+        self.assertEqual(units[1], ("medium", RClone.Direction.local, ['x/mid', 'x/mid2']))
+
+class TestAIMD(unittest.TestCase):
+    def test_AIMD(self):
+        """
+        This tests the concurrency climbs while throughput holds and halves on trouble
+        Results: 4 -> 5 -> 6 -> 3 (errors) -> 4 (bigger, slower files) -> 4 (throughput fell) and every batch traced
+        """
+        ctl = AIMD(4, hi=6)
+        ctl.feed(4000, 4, 1.0, 0)
+        ctl.feed(5000, 5, 1.0, 0)
+        self.assertEqual(ctl.value, 6)
+        ctl.feed(6000, 6, 1.0, 0)
+        self.assertEqual(ctl.value, 6)
+        ctl.feed(6000, 6, 1.0, 2)
+        self.assertEqual(ctl.value, 3)
+        #3x the time per file, but for 100x the bytes
+        ctl.feed(600000, 3, 3.0, 0)
+        self.assertEqual(ctl.value, 4)
+        ctl.feed(6000, 4, 1.0, 0)
+        self.assertEqual(ctl.value, 4)
+        self.assertEqual([t['value'] for t in ctl.trace], [4, 5, 6, 6, 3, 4])
+        self.assertEqual(ctl.trace[-1]['bytespersec'], 6000.0)
+
+    def test_set_flag(self):
+        self.assertEqual(set_flag(["--transfers", "32", "--checkers", "64"], "--transfers", 8), ["--transfers", "8", "--checkers", "64"])
+        self.assertEqual(set_flag([], "--transfers", 8), ["--transfers", "8"])
+        self.assertEqual(flag_value(["--transfers", "32"], "--transfers"), "32")
+        self.assertEqual(flag_value([], "--transfers", 4), 4)
+
+class TestPlanFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prevfile = self.tmp.name + "/profile.previous"
+        self.plan = self.tmp.name + "/plan"
+        self.engine = new_engine(FakeRClone({}), prevfile=self.prevfile)
+        self.engine.runfingerprint = {'local': "L", 'remote': "R"}
+        with open(self.prevfile, "w") as f:
+            json.dump({'version': VersionAsInt(), 'hashtype': "md5", 'files': {}}, f)
+        self.engine.files.update({'a': {'local': {'size': 10, 'time': "2017-12-20 15:43:27.776000", 'md5sum': "1"}},
+                                  'b': {'previous': {'size': 5, 'time': "2017-12-20 15:43:27.776000", 'md5sum': "2"},
+                                        'remote': {'size': 5, 'time': "2017-12-20 15:43:27.776000", 'md5sum': "2", 'gdoc': False}}})
+        self.changes = {'a': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'b': {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.remote}}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_record(self):
+        """
+        This tests the record comparison used for the staleness checks
+        Results: missing on both sides or same size/time(/hash) is the same
+        """
+        a = {'size': 1, 'time': "2017-12-20 15:43:27.776000", 'md5sum': "1"}
+        self.assertTrue(same_record(None, None))
+        self.assertFalse(same_record(a, None))
+        self.assertTrue(same_record(a, {'size': 1, 'time': "2017-12-20 15:43:27.776000"}, 'md5sum'))
+        self.assertFalse(same_record(a, dict(a, md5sum="2"), 'md5sum'))
+        self.assertFalse(same_record(a, dict(a, size=2)))
+
+    def test_plan_roundtrip(self):
+        """
+        This tests a written plan is read back unchanged when nothing changed since
+        Results: the same changes and records
+        """
+        org = copy.deepcopy(self.engine.files)
+        self.engine.write_plan(self.plan, self.changes, {})
+
+        rc = FakeRClone({})
+        rc.listing[RClone.Direction.remote]['b'] = org['b']['remote']
+        e = new_engine(rc, prevfile=self.prevfile)
+        (cf, dirs) = e.load_plan(self.plan)
+        self.assertEqual(cf, self.changes)
+        self.assertEqual(dirs, {})
+        self.assertEqual(e.files, org)
+        self.assertEqual(e.pending, set())
+
+    def test_plan_remote_edit(self):
+        """
+        This tests a remote file edited since the plan was made is found even though
+        the remote's fingerprint (which only sees sizes) didn't change
+        Results: the change to it is dropped
+        """
+        org = copy.deepcopy(self.engine.files)
+        self.engine.write_plan(self.plan, self.changes, {})
+
+        rc = FakeRClone({})
+        rc.listing[RClone.Direction.remote]['b'] = dict(org['b']['remote'], md5sum="9")
+        e = new_engine(rc, prevfile=self.prevfile)
+        (cf, dirs) = e.load_plan(self.plan)
+        self.assertEqual(list(cf), ['a'])
+        self.assertEqual(e.pending, {'b'})
+
+    def test_plan_previous_changed(self):
+        """
+        This tests a plan is refused when another sync ran after it was made
+        Results: SyncError
+        """
+        self.engine.write_plan(self.plan, self.changes, {})
+        with open(self.prevfile, "a") as f:
+            f.write(" ")
+
+        with self.assertRaises(SyncError):
+            new_engine(FakeRClone({}), prevfile=self.prevfile).load_plan(self.plan)
+
+class TestVerifyChanges(unittest.TestCase):
+    def setUp(self):
+        self.engine = new_engine(FakeRClone({}))
+        self.engine.pending = {'p'}
+        self.engine.files.update({'a': {'local': {'size': 10, 'md5sum': "1"}},
+                                  'b': {'previous': {'size': 5, 'md5sum': "2"}, 'remote': {'size': 5, 'md5sum': "2"}},
+                                  'c': {'local': {'size': 3, 'md5sum': "3"}},
+                                  'p': {'local': {'size': 1, 'md5sum': "4"}},
+                                  'x': {'local': {'size': 1, 'md5sum': "5"}, 'remote': {'size': 2, 'md5sum': "6"}}})
+        self.changes = {'a': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'b': {'action': RClone.Action.deletefrom, 'direction': RClone.Direction.remote},
+                        'c': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'p': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote},
+                        'x': {'action': RClone.Action.conflict, 'direction': RClone.Direction.neither}}
+
+    def test_VerifyChanges(self):
+        """
+        This tests only the applied changes are re-listed and checked
+        Results: 'a' gets its new records, 'b' is gone from both sides, 'c' came out different
+        """
+        self.engine.rclone.listing[RClone.Direction.local].update({'a': {'size': 10, 'md5sum': "1"}, 'c': {'size': 3, 'md5sum': "3"}})
+        self.engine.rclone.listing[RClone.Direction.remote].update({'a': {'size': 10, 'md5sum': "1"}, 'c': {'size': 3, 'md5sum': "9"},
+                                                                    'x': {'size': 2, 'md5sum': "6"}})
+
+        self.assertEqual(self.engine.verify(self.changes), ['c'])
+        self.assertEqual(self.engine.files['a'], {'local': {'size': 10, 'md5sum': "1"}, 'remote': {'size': 10, 'md5sum': "1"}})
+        self.assertEqual(self.engine.files['b'], {'previous': {'size': 5, 'md5sum': "2"}})
+        #pending and conflicts aren't touched
+        self.assertEqual(self.engine.files['p'], {'local': {'size': 1, 'md5sum': "4"}})
+        self.assertEqual(self.engine.files['x']['remote'], {'size': 2, 'md5sum': "6"})
+
+    def test_VerifyChanges_dirs(self):
+        """
+        This tests the files of a dir done in one op are checked from one listing of it
+        Results: 'd' listed once per side, just 'a' and 'c' looked up by name
+        """
+        rc = self.engine.rclone
+        for name in ('d/1', 'd/2'):
+            self.engine.files[name] = {'local': {'size': 4, 'md5sum': "7"}}
+            self.changes[name] = {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}
+            rc.listing[RClone.Direction.local][name] = {'size': 4, 'md5sum': "7"}
+            rc.listing[RClone.Direction.remote][name] = {'size': 4, 'md5sum': "7"}
+        for side in (RClone.Direction.local, RClone.Direction.remote):
+            rc.listing[side].update({'a': {'size': 10, 'md5sum': "1"}, 'c': {'size': 3, 'md5sum': "3"}})
+        self.engine.dirs = {'d': {'action': RClone.Action.copydir, 'direction': RClone.Direction.remote,
+                                  'dir': "d", 'names': ['d/1', 'd/2']}}
+        calls = []
+        lsjson = rc.lsjson
+        rc.lsjson = lambda direction, includegdocs=False, names=None, path=None: \
+            calls.append((path, names and sorted(names))) or lsjson(direction, includegdocs, names, path)
+
+        self.assertEqual(self.engine.verify(self.changes), [])
+        self.assertEqual(self.engine.files['d/2'], {'local': {'size': 4, 'md5sum': "7"}, 'remote': {'size': 4, 'md5sum': "7"}})
+        self.assertEqual(calls, [("d", None), ("d", None), (None, ['a', 'b', 'c']), (None, ['a', 'b', 'c'])])
+
+    def test_VerifyChanges_nothing_applied(self):
+        """
+        This tests nothing is listed when only conflicts/pending were planned
+        Results: no failures and files left as is
+        """
+        org = copy.deepcopy(self.engine.files)
+        self.assertEqual(self.engine.verify({'x': self.changes['x'], 'p': self.changes['p']}), [])
+        self.assertEqual(self.engine.files, org)
+
+class TestPathSync(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prevfile = self.tmp.name + "/profile.previous"
+        t = "2017-12-20 15:43:27.776000"
+        self.rec = {'size': 1, 'time': t, 'md5sum': "1"}
+        prev = {'size': 1, 'time': t, 'rtime': t, 'md5sum': "1"}
+        with open(self.prevfile, "w") as f:
+            json.dump({'version': VersionAsInt(), 'hashtype': "md5", 'fingerprint': None,
+                       'files': {'p/a': {'previous': prev}, 'p/sub/b': {'previous': prev},
+                                 'pa': {'previous': prev}, 'q/c': {'previous': prev}}}, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_prefix_names(self):
+        names = sorted(["p", "p/a", "p/sub/b", "p.txt", "pa", "p0", "q/c"])
+        self.assertEqual(prefix_names(names, "p/"), ["p/a", "p/sub/b"])
+        self.assertEqual(prefix_names(names, "x/"), [])
+        self.assertEqual(prefix_names(names, ""), names)
+        self.assertEqual(sync_prefix("/p/sub/"), "p/sub/")
+        self.assertEqual(sync_prefix("/"), "")
+        with self.assertRaises(SyncError):
+            sync_prefix("p/../q")
+
+    def test_collapse_dirs_top(self):
+        #f only knows about p/sub, p may have other files
+        f = {'p/sub/a': {'local': {}}, 'p/sub/b': {'local': {}}}
+        changes = {name: {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote} for name in f}
+        self.assertEqual(list(collapse_dirs(changes, f)), ['p'])
+        self.assertEqual(list(collapse_dirs(changes, f, top="p/sub/")), ['p/sub'])
+        self.assertEqual(collapse_dirs(changes, f, top="p/sub/a/"), {})
+
+    def test_path_sync(self):
+        """
+        This tests a --path sync only lists, plans and saves the subtree
+        Results: 'p/a' is copied, 'q/c' (gone remotely) isn't touched and its row is kept
+        """
+        rc = FakeRClone({})
+        new = dict(self.rec, size=2)
+        rc.listing[RClone.Direction.local].update({'p/a': new, 'p/sub/b': self.rec, 'pa': self.rec, 'q/c': self.rec})
+        rc.listing[RClone.Direction.remote].update({'p/a': dict(self.rec, gdoc=False), 'p/sub/b': dict(self.rec, gdoc=False),
+                                                    'pa': dict(self.rec, gdoc=False)})
+        e = new_engine(rc, prevfile=self.prevfile, path="/p/")
+
+        (changes, dirs) = e.plan()
+        self.assertEqual(list(changes), ['p/a'])
+        self.assertEqual(sorted(e.files), ['p/a', 'p/sub/b'])
+
+        #the copy landed
+        rc.listing[RClone.Direction.remote]['p/a'] = dict(new, gdoc=False)
+        e.apply(changes, dirs)
+        e.save()
+        self.assertEqual(rc.done, ['p/a'])
+
+        with open(self.prevfile) as f:
+            files = json.load(f)['files']
+        self.assertEqual(sorted(files), ['p/a', 'p/sub/b', 'pa', 'q/c'])
+        self.assertEqual(files['p/a']['previous']['size'], 2)
+        self.assertEqual(files['q/c']['previous']['size'], 1)
+
+    def test_path_is_file(self):
+        """
+        This tests a --path naming a file is refused, a dir holding a file of its own name isn't
+        Results: SyncError for 'p/f.txt', 'p/d' lists 'p/d/d'
+        """
+        class FileRClone(FakeRClone):
+            def lsjson(self, direction, includegdocs=False, names=None, path=None):
+                #rclone lists a file as itself
+                if(path in self.listing[direction]):
+                    return {path + "/" + path.rsplit("/", 1)[-1]: self.listing[direction][path]}
+                return FakeRClone.lsjson(self, direction, includegdocs, names, path)
+
+        rc = FileRClone({})
+        rc.listing[RClone.Direction.local].update({'p/f.txt': self.rec, 'p/d/d': self.rec})
+        with self.assertRaises(SyncError):
+            new_engine(rc, prevfile=self.prevfile, path="p/f.txt").plan()
+
+        e = new_engine(rc, prevfile=self.prevfile, path="p/d")
+        (changes, dirs) = e.plan()
+        self.assertEqual(list(changes), ['p/d/d'])
+
+class TestDuplicates(unittest.TestCase):
+    def setUp(self):
+        t = "2017-12-20 15:43:27.776000"
+        self.rc = FakeRClone({})
+        self.old = {'size': 1, 'time': t, 'id': "old", 'gdoc': False}
+        self.new = {'size': 2, 'time': "2017-12-21 15:43:27.776000", 'id': "new", 'gdoc': False}
+        self.rc.listing[RClone.Direction.remote].update({'d/a': dict(self.new, dups=[self.old]), 'd/b': dict(self.old, id="b")})
+        self.engine = new_engine(self.rc)
+        self.engine.files['d/a'] = {'previous': {'size': 1, 'time': t, 'rtime': t, 'rid': "old"}}
+
+    def test_list_remote_previous_id(self):
+        """
+        This tests the duplicate the last sync was of is the one that's synced again
+        Results: 'old' is picked for 'd/a' even though 'new' is newer, all ids are indexed
+        """
+        self.engine.list_remote()
+        self.assertEqual(self.engine.files['d/a']['remote']['id'], "old")
+        self.assertEqual(self.engine.remoteids, {'old': 'd/a', 'new': 'd/a', 'b': 'd/b'})
+
+        self.engine.duplicates()
+        self.assertEqual(self.rc.done, [])
+        self.assertEqual(self.engine.metrics.extra['dupnames'], 1)
+
+    def test_duplicates_dedupe(self):
+        """
+        This tests a dedupe mode runs 'rclone dedupe' on the dir and re-lists it
+        Results: 'd/a' has just the one file afterwards, 'new' was renamed
+        """
+        class Dedupe(FakeRClone):
+            def dedupe(self, name, mode):
+                self.done.append((name, mode))
+                self.listing[RClone.Direction.remote]['d/a'] = self.listing[RClone.Direction.remote]['d/a']['dups'][0]
+                self.listing[RClone.Direction.remote]['d/a-1'] = self.new
+
+        self.rc = Dedupe({})
+        self.rc.new = self.new
+        self.rc.listing[RClone.Direction.remote].update({'d/a': dict(self.new, dups=[self.old]), 'd/b': dict(self.old, id="b")})
+        self.engine.rclone = self.rc
+        self.engine.config['dupnames'] = "rename"
+        self.engine.list_remote()
+        self.engine.duplicates()
+
+        self.assertEqual(self.rc.done, [("d", "rename")])
+        self.assertEqual(self.engine.files['d/a']['remote'], self.old)
+        self.assertEqual(self.engine.remoteids['new'], 'd/a-1')
+
+class TestAudit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prevfile = self.tmp.name + "/profile.previous"
+        self.t = "2017-12-20 15:43:27.776000"
+        self.rc = FakeRClone({})
+        files = {}
+        for i in range(10):
+            name = "d/f%d" % i
+            rec = {'size': 1, 'time': self.t, 'md5sum': str(i)}
+            files[name] = {'previous': dict(rec, rtime=self.t)}
+            self.rc.listing[RClone.Direction.local][name] = dict(rec)
+            self.rc.listing[RClone.Direction.remote][name] = dict(rec, gdoc=False)
+        with open(self.prevfile, "w") as f:
+            json.dump({'version': VersionAsInt(), 'hashtype': "md5", 'fingerprint': None, 'files': files}, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_fast(self):
+        #full, the fingerprints would find nothing changed and skip the listing (and audit)
+        e = new_engine(self.rc, prevfile=self.prevfile, full=True, audit={'fast': True, 'fraction': 0.3})
+        p = e.plan()
+        if(p[0]):
+            e.apply(*p)
+        e.save()
+        with open(self.prevfile) as f:
+            return (e, p[0], json.load(f))
+
+    def test_audit_rotates(self):
+        """
+        This tests each fast run hashes the next 30% of the files, wrapping around
+        Results: the 4th run finishes cycle 1 and starts cycle 2, stored hashes are kept
+        """
+        for i in range(3):
+            (e, changes, j) = self.run_fast()
+            self.assertEqual(changes, {})
+            self.assertEqual(j['audit']['cursor'], "d/f%d" % (3 * i + 2))
+        self.assertEqual(j['audit']['coverage'], 0.9)
+
+        (e, changes, j) = self.run_fast()
+        self.assertEqual(j['audit']['cycle'], 2)
+        self.assertEqual(j['audit']['cursor'], "d/f1")
+        self.assertEqual(j['audit']['audited'], 2)
+        #nothing was hashed in the listings but the hashes are still there
+        self.assertEqual(j['files']['d/f5']['previous']['md5sum'], "5")
+        self.assertEqual(j['tree']['key'], None)
+
+    def test_audit_mismatch(self):
+        """
+        This tests an edit that kept the size and modtime is found by the audit
+        Results: only the audited file is copied, the other one is missed until its turn
+        """
+        self.rc.listing[RClone.Direction.local]['d/f1']['md5sum'] = "x"
+        self.rc.listing[RClone.Direction.local]['d/f7']['md5sum'] = "x"
+        (e, changes, j) = self.run_fast()
+
+        self.assertEqual(e.auditbad, {'d/f1'})
+        self.assertEqual(list(changes), ['d/f1'])
+        self.assertEqual(changes['d/f1']['direction'], RClone.Direction.remote)
+        self.assertEqual(self.rc.done, ['d/f1'])
+
+    def test_audit_noop(self):
+        """
+        This tests a run the fingerprints find nothing changed in still audits its slice
+        Results: 1st run is a no-op that moves the cursor on, the 2nd finds 'd/f4' and does a full run
+        """
+        with open(self.prevfile) as f:
+            j = json.load(f)
+        j['fingerprint'] = {'local': "L", 'remote': "R", 'time': time.time()}
+        with open(self.prevfile, "w") as f:
+            json.dump(j, f)
+
+        e = new_engine(self.rc, prevfile=self.prevfile, audit={'fast': True, 'fraction': 0.3})
+        self.assertIsNone(e.plan())
+        mtime = os.stat(self.prevfile).st_mtime_ns
+        e.save()
+        #the cursor is kept in the status file, the previous file isn't touched
+        self.assertEqual(os.stat(self.prevfile).st_mtime_ns, mtime)
+        with open(self.prevfile + ".status") as f:
+            j = json.load(f)
+        self.assertEqual(j['audit']['cursor'], "d/f2")
+
+        self.rc.listing[RClone.Direction.local]['d/f4']['md5sum'] = "x"
+        e = new_engine(self.rc, prevfile=self.prevfile, audit={'fast': True, 'fraction': 0.3})
+        (changes, dirs) = e.plan()
+        self.assertEqual(list(changes), ['d/f4'])
+        self.assertEqual(e.auditstate['cursor'], "d/f5")
+        self.assertEqual(e.metrics.extra['audited'], 3)
+
+class DirRemote():
+    #a local dir as the remote, with the same file ops RClone.rclone has for it
+    def __init__(self, path):
+        self.path = path
+
+    def readfile(self, name):
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def writefile(self, name, data):
+        #the new contents show up all at once, same as an upload
+        tmp = os.path.join(self.path, "%s.%d.tmp" % (name, threading.get_ident()))
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def deletefile(self, name):
+        os.remove(os.path.join(self.path, name))
+
+class TestRemoteLease(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.remote = DirRemote(self.tmp.name)
+        self.lockfile = os.path.join(self.tmp.name, LOCKFILE % "docs")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lease_acquire_release(self):
+        """
+        This tests a lease shows up on the remote while held and keeps others out
+        Results: the 2nd lease gets a SyncError, the lock file is gone after release
+        """
+        a = RemoteLease(self.remote, "docs", ttl=60, settle=0)
+        a.acquire()
+        with open(self.lockfile) as f:
+            self.assertEqual(json.load(f)['owner'], a.owner)
+
+        with self.assertRaises(SyncError):
+            RemoteLease(self.remote, "docs", ttl=60, settle=0).acquire()
+        #a different key isn't held up
+        other = RemoteLease(self.remote, "photos", ttl=60, settle=0)
+        other.acquire()
+        other.release()
+
+        a.release()
+        self.assertFalse(os.path.exists(self.lockfile))
+
+    def test_lease_filter(self):
+        """
+        This tests an engine using a lease keeps the lock files out of the sync without the CLI's help
+        Results: the lock rule comes 1st, followed by the engine's own filter rules
+        """
+        prevfile = self.tmp.name + "/profile.previous"
+        self.assertIsNone(new_engine(None, prevfile=prevfile).filterfile())
+
+        e = new_engine(None, prevfile=prevfile, lock={'enabled': True})
+        with open(e.filterfile()) as f:
+            self.assertEqual(f.read(), LOCKRULE + "\n")
+
+        ff = WriteFilterFile(self.tmp.name + "/profile", ["- *.tmp"])
+        e = new_engine(None, prevfile=prevfile, lock={'enabled': True}, filterfile=ff)
+        self.assertEqual(ReadFilterRules(e.filterfile()), [LOCKRULE, "- *.tmp"])
+        self.assertEqual(ReadFilterRules(ff), ["- *.tmp"])
+
+    def test_lease_expired(self):
+        """
+        This tests a lease that wasn't renewed (ie the run crashed) is taken over
+        Results: the 2nd lease gets it
+        """
+        self.remote.writefile(LOCKFILE % "docs", json.dumps({'owner': "gone:1:x", 'expires': time.time() - 1}).encode())
+        b = RemoteLease(self.remote, "docs", ttl=60, settle=0)
+        b.acquire()
+        b.release()
+
+    def test_lease_heartbeat(self):
+        """
+        This tests a held lease is renewed past its ttl and a lost one is noticed
+        Results: still held after 2 ttls, lost once someone else overwrites it
+        """
+        a = RemoteLease(self.remote, "docs", ttl=0.15, settle=0)
+        a.acquire()
+        try:
+            time.sleep(0.3)
+            with self.assertRaises(SyncError):
+                RemoteLease(self.remote, "docs", ttl=0.15, settle=0).acquire()
+
+            self.remote.writefile(LOCKFILE % "docs", json.dumps({'owner': "thief:1:x", 'expires': time.time() + 60}).encode())
+            time.sleep(0.15)
+            self.assertEqual(a.lost, "thief:1:x")
+        finally:
+            a.release()
+        #not ours to delete
+        self.assertTrue(os.path.exists(self.lockfile))
+
+    def test_lease_serialize(self):
+        """
+        This tests runs that start together take turns
+        Results: the holders never overlap
+        """
+        held = []
+        overlap = []
+
+        def run():
+            lease = RemoteLease(self.remote, "docs", ttl=60, settle=0.02)
+            lease.acquire(wait=10)
+            held.append(lease.owner)
+            if(len(held) > 1):
+                overlap.append(list(held))
+            time.sleep(0.05)
+            held.remove(lease.owner)
+            lease.release()
+
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlap, [])
+
+    def test_lost_lease_defers(self):
+        """
+        This tests nothing more is applied once the lease is lost
+        Results: every change is deferred
+        """
+        e = new_engine(FakeRClone({}))
+        e.files.update({'a': {'local': {'size': 10}}})
+        e.lease = RemoteLease(self.remote, "docs")
+        e.lease.lost = "thief:1:x"
+        (failed, deferred) = e.apply_changes({'a': {'action': RClone.Action.copyto, 'direction': RClone.Direction.remote}})
+        self.assertEqual(deferred, {'a'})
+        self.assertEqual(e.rclone.done, [])
+
+class TestStatus(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.conffile = self.tmp.name + "/profile"
+        self.prevfile = self.conffile + ".previous"
+        with open(self.conffile, "w") as f:
+            json.dump({'local': "/local", 'remote': "remote:", 'gdocs': False, 'prevfile': self.prevfile, 'version': VersionAsInt()}, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def show(self, argv):
+        out = io.StringIO()
+        argv0 = sys.argv
+        sys.argv = ["rclone_bisync.py"] + argv
+        try:
+            with contextlib.redirect_stdout(out):
+                rc = main()
+        finally:
+            sys.argv = argv0
+        return (rc, out.getvalue())
+
+    def test_StatusArgs(self):
+        self.assertEqual(StatusArgs(["--status", "--configfile", "/c"]), "/c")
+        self.assertEqual(StatusArgs(["--configfile=/c", "--status"]), "/c")
+        self.assertTrue(StatusArgs(["-P", "p", "--status"]).endswith("/rclone_bisync/p"))
+        self.assertIsNone(StatusArgs(["-P", "p"]))
+        self.assertIsNone(StatusArgs(["--status", "-P", "p", "--full"]))
+
+    def test_save_writes_status(self):
+        engine = new_engine(FakeRClone({}), prevfile=self.prevfile, dryrun=True)
+        engine.noop = True
+        engine.save()
+        self.assertEqual(self.show(["--status", "--configfile", self.conffile]), (1, "'remote:' has no sync recorded yet\n"))
+
+        engine = new_engine(FakeRClone({}), prevfile=self.prevfile)
+        engine.noop = True
+        engine.files = {'a': {}, 'b': {}}
+        engine.save()
+        (rc, out) = self.show(["--status", "--configfile", self.conffile])
+        self.assertEqual(rc, 0)
+        self.assertIn("nothing changed, 2 file(s)", out)
+        self.assertFalse(os.path.exists(self.prevfile))
+
+        engine.noop = False
+        engine.pending = {'a'}
+        engine.metrics.inc('failed')
+        engine.write_status()
+        (rc, out) = self.show(["--status", "--configfile", self.conffile])
+        self.assertEqual(rc, 2)
+        self.assertIn("1 change(s) left for the next run (1 failed, 0 deferred)", out)
+
+    def test_startup(self):
+        #a --status query should be answered without loading what a sync needs,
+        #startup_report.py prints how long it takes
+        with open(status_path(self.prevfile), "w") as f:
+            json.dump({'time': time.time(), 'duration': 1.0, 'noop': True, 'path': None, 'files': 3,
+                       'pending': 0, 'failed': 0, 'deferred': 0, 'coverage': None, 'version': VersionAsInt()}, f)
+        heavy = ("argparse", "multiprocessing", "concurrent.futures", "socket", "uuid", "tempfile", "hashlib", "selectors")
+        code = ("import sys, rclone_bisync\n"
+                "sys.argv[1:] = ['--status', '--configfile', %r]\n"
+                "rc = rclone_bisync.main()\n"
+                "print([m for m in %r if m in sys.modules])\n"
+                "sys.exit(rc)\n" % (self.conffile, heavy))
+        rv = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertIn("nothing changed, 3 file(s)", rv.stdout)
+        self.assertTrue(rv.stdout.endswith("[]\n"), rv.stdout)
+
+class TestFanout(unittest.TestCase):
+    def setUp(self):
+        self.worker = rclone_bisync.FanoutWorker
+        self.profile = {'remote': "gdrive:", 'prevfile': "/tmp/p",
+                        'fanout': [{'remote': "s3:backup", 'prevfile': "/tmp/p.1"}]}
+
+    def tearDown(self):
+        rclone_bisync.FanoutWorker = self.worker
+
+    def test_fanout_path(self):
+        self.assertEqual(fanout_path("/var/lib/node/sync.prom", 1), "/var/lib/node/sync.1.prom")
+        self.assertEqual(fanout_path("metrics", 2), "metrics.2")
+
+    def test_RunFanout_shared_listing(self):
+        """
+        This tests the local tree is listed once for all the remotes
+        Results: both workers get the same listing from a single lsjson
+        """
+        class CountingRClone(FakeRClone):
+            def lsjson(self, direction, includegdocs=False, names=None, path=None):
+                self.done.append(direction)
+                return {'a': {'size': 1}}
+
+        def worker(i, args, profile, filterfile, conn):
+            link = FanoutLink(conn)
+            try:
+                if(link.list("md5") != {'a': {'size': 1}} or link.list("md5") != {'a': {'size': 1}}):
+                    sys.exit(2)
+            finally:
+                link.done()
+
+        engine = new_engine(CountingRClone({}))
+        rclone_bisync.FanoutWorker = worker
+        self.assertEqual(RunFanout(engine, None, self.profile, None), 0)
+        self.assertEqual(engine.rclone.done, [RClone.Direction.local])
+
 if(__name__ == '__main__'):
     unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+#################################################################################
+## Imports
+#################################################################################
+#prints what starting rclone_bisync costs, for keeping an eye on the --status
+#fast path by hand (the unittests only check what it loads, timings vary too
+#much from box to box to assert on)
+#
+#   startup_report.py [RUNS] [--status args, ie -P name]
+#
+#without --status args a throw away profile with one recorded run is used
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+#################################################################################
+## Reports
+#################################################################################
+def ImportTime():
+    #(own, cumulative) microseconds of 'import rclone_bisync' per -X importtime,
+    #compiling rclone_bisync itself is in own when there's no cached bytecode
+    rv = subprocess.run([sys.executable, "-X", "importtime", "-c", "import rclone_bisync"], cwd=HERE,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    (own, total) = next(l.split("|")[:2] for l in rv.stderr.splitlines() if l.endswith("| rclone_bisync"))
+    return (int(own.split(":")[1]), int(total))
+
+def StatusTime(args):
+    #wall time of a whole '--status' run, interpreter start up included
+    start = time.perf_counter()
+    rv = subprocess.run([sys.executable, os.path.join(HERE, "rclone_bisync.py"), "--status"] + args,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return (time.perf_counter() - start, rv.returncode)
+
+def TestProfile(tmp):
+    #a config with one remote and a status file as a no-op run leaves it
+    conffile = os.path.join(tmp, "profile")
+    prevfile = conffile + ".previous"
+    with open(conffile, "w") as f:
+        json.dump({'remote': "remote:", 'prevfile': prevfile}, f)
+    with open(prevfile + ".status", "w") as f:
+        json.dump({'time': time.time(), 'duration': 1.0, 'noop': True, 'path': None, 'files': 3,
+                   'pending': 0, 'failed': 0, 'deferred': 0, 'coverage': None}, f)
+    return ["--configfile", conffile]
+
+
+#################################################################################
+## main
+#################################################################################
+def main():
+    argv = sys.argv[1:]
+    runs = int(argv.pop(0)) if argv and argv[0].isdigit() else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args = argv or TestProfile(tmp)
+
+        imports = [ImportTime() for i in range(runs)]
+        print("import rclone_bisync (-X importtime, best of %d):" % runs)
+        print("    %6.1fms in total, %6.1fms of it in rclone_bisync itself" % (min(t for (o, t) in imports) / 1e3,
+                                                                          min(o for (o, t) in imports) / 1e3))
+
+        times = [StatusTime(args) for i in range(runs)]
+        secs = sorted(s for (s, rc) in times)
+        print("rclone_bisync.py --status %s (%d runs, exit code %d):" % (" ".join(args), runs, times[-1][1]))
+        print("    %6.1fms best, %6.1fms median" % (secs[0] * 1e3, secs[len(secs) // 2] * 1e3))
+    return 0
+
+if(__name__ == '__main__'):
+    sys.exit(main())